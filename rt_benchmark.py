@@ -0,0 +1,432 @@
+"""
+Benchmarks for the real-time pipeline.
+
+Everything runs against a synthetic GE-like EPI series written to a
+scratch directory, served by the SFTP test server (rt_sftp_test_server.py)
+in this process. Results are written as JSON, with the commit they were
+run on, so runs can be compared across commits:
+
+    python rt_benchmark.py -o before.json
+    (change things)
+    python rt_benchmark.py -o after.json --compare before.json
+"""
+from __future__ import print_function, division
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import optparse
+import tempfile
+import textwrap
+import platform
+import threading
+import subprocess
+from datetime import datetime
+
+import numpy as np
+import nibabel as nib
+import pydicom
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.uid import ExplicitVRLittleEndian
+from scipy import ndimage
+
+from rtfmri.queuemanagers import Volumizer
+
+
+BENCHMARKS = ["list_dir", "retrieve_dicom", "slice_buffer",
+              "assemble_volume", "reduce_volume", "compute_registration",
+              "pipeline"]
+
+
+def make_phantom(shape, seed=0):
+    """Return a smooth head-like volume to register and mask."""
+    rng = np.random.RandomState(seed)
+    grid = np.indices(shape).astype(float)
+    center = (np.array(shape) - 1) / 2.
+    radius = np.array(shape) * 0.4
+    dist = np.sqrt(sum(((g - c) / r) ** 2
+                       for g, c, r in zip(grid, center, radius)))
+    head = 800 * (dist < 1) + 400 * (dist < 0.6)
+    head = ndimage.gaussian_filter(head + rng.normal(0, 20, shape), 1)
+    return head
+
+
+def make_series(series_dir, n_vols=10, n_slices=30, shape=(64, 64),
+                tr=2000):
+    """Write a synthetic GE-like EPI series with a little motion in it.
+
+    Returns the slice paths in instance number order.
+    """
+    os.makedirs(series_dir)
+    phantom = make_phantom(shape + (n_slices,))
+    paths = []
+    for v in range(n_vols):
+        moved = ndimage.shift(phantom, (0.1 * v, -0.05 * v, 0), order=1)
+        moved = np.clip(moved, 0, 32767).astype(np.int16)
+        for z in range(n_slices):
+            inst = v * n_slices + z + 1
+            uid = "1.2.840.113619.2.283.4120.7575399.15401.1363019204.{}" \
+                .format(inst)
+            meta = Dataset()
+            meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+            meta.MediaStorageSOPInstanceUID = uid
+            meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            name = os.path.join(series_dir, "MR.{}.dcm".format(uid))
+
+            ds = FileDataset(name, {}, file_meta=meta, preamble=b"\0" * 128)
+            ds.is_implicit_VR = False
+            ds.is_little_endian = True
+            ds.SOPClassUID = meta.MediaStorageSOPClassUID
+            ds.SOPInstanceUID = uid
+            ds.Modality = "MR"
+            ds.PatientID = "bench"
+            ds.SeriesDescription = "synthetic epi"
+            ds.StudyID, ds.SeriesNumber, ds.AcquisitionNumber = "1", "1", "1"
+            ds.InstanceNumber = str(inst)
+            ds.AcquisitionTime = ds.ContentTime = "1200{:02d}.{:03d}".format(
+                v * tr // 1000 % 60, z)
+            ds.RepetitionTime = str(tr)
+            ds.TriggerTime = str(z * tr // n_slices)
+            ds.NumberOfTemporalPositions = str(n_vols)
+            ds.SliceThickness = "3"
+            ds.SliceLocation = str(3 * z)
+            ds.ImagePositionPatient = ["-96", "-96", str(3 * z)]
+            ds.ImageOrientationPatient = ["1", "0", "0", "0", "1", "0"]
+            ds.add_new((0x0020, 0x0100), "IS", str(v + 1))
+            ds.add_new((0x0020, 0x9057), "UL", z + 1)
+            ds.add_new((0x0021, 0x0010), "LO", "GEMS_RELA_01")
+            ds.add_new((0x0021, 0x104f), "SS", n_slices)
+            ds.SamplesPerPixel = 1
+            ds.PhotometricInterpretation = "MONOCHROME2"
+            ds.Rows, ds.Columns = shape
+            ds.PixelSpacing = ["3", "3"]
+            ds.BitsAllocated, ds.BitsStored, ds.HighBit = 16, 16, 15
+            ds.PixelRepresentation = 1
+            ds.add_new((0x0028, 0x0107), "SS", 1000)
+            ds.WindowCenter, ds.WindowWidth = "500", "1000"
+            ds.PixelData = moved[:, :, z].T.tobytes()
+            ds.save_as(name)
+            paths.append(name)
+    return paths
+
+
+def summarize(times):
+    """Return summary statistics of a list of timings, in seconds."""
+    times = np.array(times)
+    return dict(n=len(times), mean=times.mean(), median=np.median(times),
+                min=times.min(), max=times.max(), std=times.std())
+
+
+def measure(func, repeat=10, setup=None):
+    """Time `repeat` calls of `func`, running `setup` before each."""
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        tic = time.time()
+        func()
+        times.append(time.time() - tic)
+    return summarize(times)
+
+
+class BenchmarkSuite(object):
+    """Set up the data and run the benchmarks on it."""
+
+    def __init__(self, work_dir, port=2125, repeat=10, n_vols=10,
+                 n_slices=30, shape=(64, 64)):
+        self.work_dir = work_dir
+        self.port = port
+        self.repeat = repeat
+        self.series_dir = os.path.join("data", "p1", "e1", "s1")
+        self.paths = [os.path.relpath(p, work_dir) for p in make_series(
+            os.path.join(work_dir, self.series_dir), n_vols, n_slices,
+            shape)]
+        self.n_vols = n_vols
+        self.n_slices = n_slices
+        self.server_started = False
+
+        # Volumes to assemble, mask and register
+        slices = [pydicom.read_file(os.path.join(work_dir, p))
+                  for p in self.paths]
+        self.volume_slices = [slices[i:i + n_slices]
+                              for i in range(0, len(slices), n_slices)]
+        volumizer = Volumizer(None, None, keep_vols=False)
+        self.images = [volumizer.assemble_volume(s)["image"]
+                       for s in self.volume_slices[:2]]
+
+    def start_server(self):
+        """Serve the work directory with the SFTP test server."""
+        if self.server_started:
+            return
+        import rt_sftp_test_server as server
+        server.StubSFTPServer.ROOT = self.work_dir
+        key = os.path.join(self.work_dir, "test.key")
+        cwd = os.getcwd()
+        os.chdir(self.work_dir)
+        try:
+            server.get_test_key()
+        finally:
+            os.chdir(cwd)
+
+        thread = threading.Thread(target=server.start_server,
+                                  args=("localhost", self.port, key,
+                                        "WARNING"))
+        thread.daemon = True
+        thread.start()
+        for _ in range(50):
+            try:
+                socket.create_connection(("localhost", self.port)).close()
+                break
+            except socket.error:
+                time.sleep(0.1)
+        self.server_started = True
+
+    def client(self, **kwargs):
+        from rtfmri.client import ScannerClient
+        self.start_server()
+        return ScannerClient(hostname="localhost", port=self.port,
+                             base_dir="data", **kwargs)
+
+    def bench_list_dir(self):
+        """List directories of 100 to 10000 files, cold and cached."""
+        client = self.client()
+        # The directories are brand new; trust their cached listings
+        # right away (see ScannerClient._cached_listing)
+        client.listing_settle_time = 0
+        results = {}
+        for n in [100, 1000, 10000]:
+            path = os.path.join("data", "listing_{}".format(n))
+            os.makedirs(os.path.join(self.work_dir, path))
+            for i in range(n):
+                open(os.path.join(self.work_dir, path,
+                                  "i{}.MRDC.{}".format(i, i)), "w").close()
+            results["cold_{}".format(n)] = measure(
+                lambda: client.list_dir(path), self.repeat,
+                setup=client.clear_listing_cache)
+            results["cached_{}".format(n)] = measure(
+                lambda: client.list_dir(path), self.repeat)
+        return results
+
+    def bench_retrieve_dicom(self):
+        """Fetch and parse a slice, with and without the fast decoder."""
+        results = {}
+        for fast_decode in [False, True]:
+            client = self.client(fast_decode=fast_decode)
+            paths = iter(self.paths * self.repeat)
+            results["fast_decode" if fast_decode else "pydicom"] = measure(
+                lambda: client.retrieve_dicom(next(paths)),
+                min(self.repeat * 10, len(self.paths)))
+        return results
+
+    def bench_slice_buffer(self, n_vols=20):
+        """Track the slices of a run with a SliceBuffer, by volume size.
+
+        Each run adds every slice of `n_vols` volumes, shuffled within
+        their volume, and pops each volume as it completes; "per_slice"
+        is the median time per slice. The "_lists" runs do the same with
+        the lists and set comparison the Volumizer used before SliceBuffer.
+        """
+        from rtfmri.buffers import SliceBuffer
+        rng = np.random.RandomState(0)
+        results = {}
+        for n_slices in [40, 128, 256]:
+            numbers = np.concatenate(
+                [rng.permutation(n_slices) + 1 + i * n_slices
+                 for i in range(n_vols)]).tolist()
+
+            def track():
+                buf = SliceBuffer(n_slices)
+                for number in numbers:
+                    buf.add(number, None)
+                    while buf.complete:
+                        buf.pop_volume()
+
+            def track_lists():
+                needed = np.arange(n_slices) + 1
+                gathered = []
+                slices = []
+                for number in numbers:
+                    gathered.append(number)
+                    slices.append(None)
+                    if set(needed) <= set(gathered):
+                        for slice_number in needed:
+                            index = gathered.index(slice_number)
+                            slices.pop(index)
+                            gathered.pop(index)
+                        needed += n_slices
+
+            for name, func in [("", track), ("_lists", track_lists)]:
+                timing = measure(func, self.repeat)
+                timing["per_slice"] = timing["median"] / len(numbers)
+                results["{}_slices{}".format(n_slices, name)] = timing
+        return results
+
+    def bench_assemble_volume(self):
+        """Assemble a volume with DicomStack and with the cached layout."""
+        results = {}
+        slices = self.volume_slices[1]
+        for fast_assembly in [False, True]:
+            volumizer = Volumizer(None, None, keep_vols=False,
+                                  fast_assembly=fast_assembly)
+            volumizer.assemble_volume(self.volume_slices[0])
+            name = "fast_assembly" if fast_assembly else "dicomstack"
+            results[name] = measure(
+                lambda: volumizer.assemble_volume(slices), self.repeat)
+        return results
+
+    def bench_reduce_volume(self):
+        """Average a volume over a spherical ROI."""
+        from rtfmri.masker import Masker
+        image = self.images[1]
+        mask = make_phantom(image.shape) > 1000
+        mask_file = os.path.join(self.work_dir, "mask.nii.gz")
+        nib.save(nib.Nifti1Image(mask.astype(np.int8), image.affine),
+                 mask_file)
+        masker = Masker(mask_file)
+        volume = dict(image=image)
+        return dict(mean=measure(lambda: masker.reduce_volume(volume),
+                                 self.repeat))
+
+    def bench_compute_registration(self):
+        """Register one volume to another with each engine and mode."""
+        from rtfmri.analyzers import MotionAnalyzer, brain_mask
+        analyzer = MotionAnalyzer(None, None, fast=True)
+        fixed, moving = self.images
+        mask = brain_mask(fixed)
+        # The Gauss-Newton engine is set up once per reference, so only
+        # time registering a volume to it
+        gauss_newton = MotionAnalyzer(None, None, engine="gauss_newton")
+        gauss_newton_fast = MotionAnalyzer(None, None, fast=True,
+                                           engine="gauss_newton")
+        engines = [a.make_engine(fixed)
+                   for a in [gauss_newton, gauss_newton_fast]]
+        return dict(
+            histogram=measure(
+                lambda: analyzer.compute_registration(moving, fixed),
+                self.repeat),
+            fast=measure(
+                lambda: analyzer.compute_fast_registration(moving, fixed,
+                                                           mask=mask),
+                self.repeat),
+            gauss_newton=measure(lambda: engines[0].register(moving),
+                                 self.repeat),
+            gauss_newton_fast=measure(lambda: engines[1].register(moving),
+                                      self.repeat),
+        )
+
+    def bench_pipeline(self):
+        """Time the whole series through a ScannerInterface."""
+        from rtfmri.interface import ScannerInterface
+        self.start_server()
+        times = []
+        for _ in range(max(1, self.repeat // 5)):
+            scanner = ScannerInterface(hostname="localhost", port=self.port,
+                                       base_dir="data",
+                                       use_series_finder=False)
+            tic = time.time()
+            scanner.start()
+            scanner.use_series(self.series_dir)
+            for _ in range(self.n_vols):
+                scanner.get_volume(timeout=60)
+            times.append(time.time() - tic)
+            latency = scanner.latency_stats()
+            scanner.shutdown()
+        result = summarize(times)
+        result["volumes_per_second"] = self.n_vols / result["median"]
+        result["latency"] = latency["stages"]
+        return dict(series=result)
+
+    def run(self, names):
+        """Run the named benchmarks and return their results."""
+        results = {}
+        for name in names:
+            print("Running {}...".format(name), file=sys.stderr)
+            try:
+                results[name] = getattr(self, "bench_" + name)()
+            except Exception as e:
+                print("  {} failed: {}".format(name, e), file=sys.stderr)
+                results[name] = dict(error="{}: {}".format(
+                    type(e).__name__, e))
+        return results
+
+
+def git_commit():
+    """Return the commit the benchmarks ran on, if we are in a checkout."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline):
+    """Print the median times of `results` against a baseline run."""
+    print("{:45s} {:>10s} {:>10s} {:>7s}".format("benchmark", "before",
+                                                 "after", "ratio"))
+    for name, cases in sorted(results["results"].items()):
+        for case, stats in sorted(cases.items()):
+            old = baseline["results"].get(name, {}).get(case, {})
+            if "median" not in stats or "median" not in old:
+                continue
+            print("{:45s} {:10.5f} {:10.5f} {:7.2f}".format(
+                name + "." + case, old["median"], stats["median"],
+                stats["median"] / old["median"]))
+
+
+def main():
+    usage = """\
+    usage: python rt_benchmark.py [options]
+    """
+    parser = optparse.OptionParser(usage=textwrap.dedent(usage))
+    parser.add_option(
+        '-o', '--output', dest='output', metavar='FILE',
+        help='write the results to FILE as JSON [default: stdout]'
+        )
+    parser.add_option(
+        '--compare', dest='compare', metavar='FILE',
+        help='compare the results with an earlier run saved in FILE'
+        )
+    parser.add_option(
+        '--only', dest='only', action='append', choices=BENCHMARKS,
+        help='run only this benchmark (repeatable): ' + ', '.join(BENCHMARKS)
+        )
+    parser.add_option(
+        '-r', '--repeat', dest='repeat', type='int', default=10,
+        help='times to repeat each measurement [default: %default]'
+        )
+    parser.add_option(
+        '-p', '--port', dest='port', type='int', default=2125,
+        help='port for the SFTP test server [default: %default]'
+        )
+    options, args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="rtfmri_bench_")
+    try:
+        suite = BenchmarkSuite(work_dir, port=options.port,
+                               repeat=options.repeat)
+        results = dict(
+            commit=git_commit(),
+            time=datetime.now().isoformat(),
+            python=platform.python_version(),
+            results=suite.run(options.only or BENCHMARKS),
+        )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,17 +3,26 @@ A test sftp server. Will get test data if we don't have it.
 The server will create a new thread to handle each new socket.
 Implementation of the server modified from
 https://gist.github.com/Girgitt/2df036f9e26dba1baaddf4c5845a20a2
+
+With --emulate, the server also plays a scanner: it acquires a copy of
+a source series into the served tree slice by slice at the series TR,
+so the whole pipeline can be timed without a scanner. --latency and
+--bandwidth slow the SFTP connection down like a real network would.
 """
 import os
+import re
 import time
+import shlex
 import socket
 import optparse
 import sys
 import textwrap
 import threading
 from glob import glob
+from io import BytesIO
 
 import paramiko
+import pydicom
 from sftpserver.stub_sftp import StubServer, StubSFTPServer
 
 HOST, PORT = 'localhost', 2124
@@ -73,28 +82,249 @@ def get_test_data(data_dir='test_data', url='http://cni.stanford.edu/download/rt
 
 
 
+class FakeWatcherThd(threading.Thread):
+    """Stand-in for the watcher ScannerClient.watch_dir runs on the scanner.
+
+    Writes the name of each new file in a directory to the channel,
+    one per line, until the client closes it.
+    """
+    def __init__(self, channel, path, interval=.02):
+        threading.Thread.__init__(self)
+        self._channel = channel
+        self._path = path
+        self._interval = interval
+
+    def run(self):
+        seen = set(os.listdir(self._path))
+        try:
+            while not self._channel.closed:
+                current = set(os.listdir(self._path))
+                new = sorted(current - seen)
+                if new:
+                    self._channel.sendall("".join(n + "\n" for n in new))
+                seen = current
+                time.sleep(self._interval)
+        except (socket.error, EOFError):
+            pass
+
+
+class WatchingStubServer(StubServer):
+    """StubServer that answers watch_dir exec requests with a fake watcher."""
+
+    def check_channel_exec_request(self, channel, command):
+        # The watch command starts with "cd <path> &&"
+        args = shlex.split(command)
+        if len(args) < 2 or args[0] != "cd" or not os.path.isdir(args[1]):
+            return False
+        watcher = FakeWatcherThd(channel, args[1])
+        watcher.setDaemon(True)
+        watcher.start()
+        return True
+
+
+class NetworkLink(object):
+    """A shared link with a fixed latency and bandwidth.
+
+    Transfers queue up behind each other like packets on a real link, so
+    several connections share the bandwidth rather than each getting it.
+    """
+    def __init__(self, latency=0., bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self._lock = threading.Lock()
+        self._busy_until = 0.
+
+    def delay(self, nbytes=0):
+        """Sleep for as long as sending `nbytes` over the link takes."""
+        now = time.time()
+        done = now
+        if self.bandwidth:
+            with self._lock:
+                start = max(now, self._busy_until)
+                self._busy_until = start + nbytes / float(self.bandwidth)
+                done = self._busy_until
+        wait = done - now + self.latency
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledFile(object):
+    """File wrapper that delays each read by the network link."""
+    def __init__(self, fobj, link):
+        self._fobj = fobj
+        self._link = link
+
+    def read(self, size):
+        data = self._fobj.read(size)
+        self._link.delay(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._fobj, name)
+
+
+class ThrottledSFTPServer(StubSFTPServer):
+    """StubSFTPServer whose replies go through a NetworkLink."""
+    def __init__(self, server, link=None, *largs, **kwargs):
+        StubSFTPServer.__init__(self, server, *largs, **kwargs)
+        self.link = link
+
+    def list_folder(self, path):
+        if self.link is not None:
+            self.link.delay()
+        return StubSFTPServer.list_folder(self, path)
+
+    def stat(self, path):
+        if self.link is not None:
+            self.link.delay()
+        return StubSFTPServer.stat(self, path)
+
+    def open(self, path, flags, attr):
+        handle = StubSFTPServer.open(self, path, flags, attr)
+        if self.link is not None:
+            self.link.delay()
+            if hasattr(handle, "readfile"):
+                handle.readfile = ThrottledFile(handle.readfile, self.link)
+        return handle
+
+
+def numbered_key(path):
+    """Sort key that orders file names by the numbers in them."""
+    return [int(part) if part.isdigit() else part
+            for part in re.split(r"(\d+)", os.path.basename(path))]
+
+
+class ScannerEmulator(threading.Thread):
+    """Acquire a source series into the served tree, slice by slice.
+
+    The source slices are written to a new series directory in
+    `exam_dir` as if a scanner were acquiring them: volume v starts at
+    v * TR, and the slices of each volume are written in `slice_order`
+    ("sequential", "reverse" or "interleaved") spread evenly over the TR.
+    Each file is written in `n_chunks` parts `chunk_delay` seconds apart,
+    so readers can catch files half written. With `restamp`, the content
+    and acquisition times in each slice are set to when it was
+    "acquired", so the pipeline's latency records start from there.
+    """
+    def __init__(self, source_dir, exam_dir=None, tr=None,
+                 slice_order="sequential", start_delay=0., n_chunks=1,
+                 chunk_delay=0., restamp=True):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.source_dir = os.path.realpath(source_dir)
+        if exam_dir is None:
+            exam_dir = os.path.dirname(self.source_dir)
+        self.exam_dir = exam_dir
+        self.slice_order = slice_order
+        self.start_delay = start_delay
+        self.n_chunks = n_chunks
+        self.chunk_delay = chunk_delay
+        self.restamp = restamp
+
+        self.files = sorted(glob(os.path.join(self.source_dir, '*')),
+                            key=numbered_key)
+        header = pydicom.read_file(self.files[0], stop_before_pixels=True)
+        if tr is None:
+            tr = float(header.RepetitionTime) / 1000
+        self.tr = tr
+        if (0x0021, 0x104f) in header:
+            self.slices_per_volume = int(header[(0x0021, 0x104f)].value)
+        else:
+            self.slices_per_volume = int(header.ImagesInAcquisition)
+
+    def new_series_dir(self):
+        """Return the path for the next s<number> series in the exam."""
+        numbers = [int(name[1:]) for name in os.listdir(self.exam_dir)
+                   if re.match(r"^s\d+$", name)]
+        return os.path.join(self.exam_dir, "s{}".format(max(numbers + [0])
+                                                        + 1))
+
+    def acquisition_order(self):
+        """Return the order slices are acquired in within a volume."""
+        spv = self.slices_per_volume
+        if self.slice_order == "reverse":
+            return list(reversed(range(spv)))
+        if self.slice_order == "interleaved":
+            return list(range(0, spv, 2)) + list(range(1, spv, 2))
+        return list(range(spv))
+
+    def schedule(self):
+        """Return (seconds from start, source file) for every slice."""
+        spv = self.slices_per_volume
+        order = self.acquisition_order()
+        events = []
+        for first in range(0, len(self.files), spv):
+            volume = self.files[first:first + spv]
+            v = first // spv
+            for i, k in enumerate(order):
+                if k < len(volume):
+                    when = v * self.tr + (i + 1) * self.tr / len(order)
+                    events.append((when, volume[k]))
+        return sorted(events)
+
+    def slice_data(self, fname, acquired):
+        """Return the bytes to write for a slice acquired at `acquired`."""
+        if not self.restamp:
+            with open(fname, 'rb') as f:
+                return f.read()
+        dcm = pydicom.read_file(fname)
+        stamp = time.localtime(acquired)
+        date = time.strftime("%Y%m%d", stamp)
+        tm = time.strftime("%H%M%S", stamp) + ".%06d" % (acquired % 1 * 1e6)
+        dcm.ContentDate = dcm.AcquisitionDate = date
+        dcm.ContentTime = dcm.AcquisitionTime = tm
+        fobj = BytesIO()
+        dcm.save_as(fobj)
+        return fobj.getvalue()
+
+    def run(self):
+        time.sleep(self.start_delay)
+        series_dir = self.new_series_dir()
+        os.makedirs(series_dir)
+        print("Emulating {} into {} (TR {}s, {} slices per volume)"
+              .format(self.source_dir, series_dir, self.tr,
+                      self.slices_per_volume))
+
+        start = time.time()
+        for offset, fname in self.schedule():
+            acquired = start + offset
+            data = self.slice_data(fname, acquired)
+            time.sleep(max(0, acquired - time.time()))
+
+            out = os.path.join(series_dir, os.path.basename(fname))
+            chunk = -(-len(data) // self.n_chunks)
+            with open(out, 'wb') as f:
+                for i in range(0, len(data), chunk):
+                    if i:
+                        time.sleep(self.chunk_delay)
+                    f.write(data[i:i + chunk])
+                    f.flush()
+        print("Finished emulating {}".format(series_dir))
+
+
 class ConnHandlerThd(threading.Thread):
-    def __init__(self, conn, keyfile):
+    def __init__(self, conn, keyfile, link=None):
         threading.Thread.__init__(self)
         self._conn = conn
         self._keyfile = keyfile
+        self._link = link
 
     def run(self):
         host_key = paramiko.RSAKey.from_private_key_file(self._keyfile)
         transport = paramiko.Transport(self._conn)
         transport.add_server_key(host_key)
         transport.set_subsystem_handler(
-            'sftp', paramiko.SFTPServer, StubSFTPServer)
+            'sftp', paramiko.SFTPServer, ThrottledSFTPServer, self._link)
 
-        server = StubServer()
+        server = WatchingStubServer()
         transport.start_server(server=server)
 
-        channel = transport.accept()
-        while transport.is_active():
-            time.sleep(.00001)
+        # The transport runs in its own thread; wait for it to finish
+        # instead of spinning
+        transport.join()
 
 
-def start_server(host, port, keyfile, level):
+def start_server(host, port, keyfile, level, link=None):
     paramiko_level = getattr(paramiko.common, level)
     paramiko.common.logging.basicConfig(level=paramiko_level)
 
@@ -106,7 +336,7 @@ def start_server(host, port, keyfile, level):
     while True:
         conn, addr = server_socket.accept()
 
-        srv_thd = ConnHandlerThd(conn, keyfile)
+        srv_thd = ConnHandlerThd(conn, keyfile, link)
         srv_thd.setDaemon(True)
         srv_thd.start()
 
@@ -132,6 +362,43 @@ def main():
         '-k', '--keyfile', dest='keyfile', metavar='FILE', default='test.key',
         help='Path to private key, for example /tmp/test_rsa.key'
         )
+    parser.add_option(
+        '--emulate', dest='emulate', metavar='SERIES_DIR',
+        help='acquire a copy of SERIES_DIR slice by slice, like a scanner'
+        )
+    parser.add_option(
+        '--exam-dir', dest='exam_dir', metavar='DIR',
+        help='exam directory to acquire into [default: that of SERIES_DIR]'
+        )
+    parser.add_option(
+        '--tr', dest='tr', type='float',
+        help='seconds per volume [default: the RepetitionTime of the series]'
+        )
+    parser.add_option(
+        '--slice-order', dest='slice_order', default='sequential',
+        choices=['sequential', 'reverse', 'interleaved'],
+        help='sequential, reverse or interleaved [default: %default]'
+        )
+    parser.add_option(
+        '--start-delay', dest='start_delay', type='float', default=5.,
+        help='seconds to wait before acquiring [default: %default]'
+        )
+    parser.add_option(
+        '--chunks', dest='n_chunks', type='int', default=1,
+        help='write each slice in this many parts [default: %default]'
+        )
+    parser.add_option(
+        '--chunk-delay', dest='chunk_delay', type='float', default=0.,
+        help='seconds between the parts of a slice [default: %default]'
+        )
+    parser.add_option(
+        '--latency', dest='latency', type='float', default=0.,
+        help='network latency per SFTP request, in ms [default: %default]'
+        )
+    parser.add_option(
+        '--bandwidth', dest='bandwidth', type='float',
+        help='network bandwidth in MB/s [default: unlimited]'
+        )
 
     options, args = parser.parse_args()
 
@@ -139,7 +406,22 @@ def main():
         parser.print_help()
         sys.exit(-1)
 
-    start_server(options.host, options.port, options.keyfile, options.level)
+    link = None
+    if options.latency or options.bandwidth:
+        bandwidth = options.bandwidth and options.bandwidth * 1e6
+        link = NetworkLink(options.latency / 1000., bandwidth)
+
+    if options.emulate:
+        emulator = ScannerEmulator(options.emulate, options.exam_dir,
+                                   tr=options.tr,
+                                   slice_order=options.slice_order,
+                                   start_delay=options.start_delay,
+                                   n_chunks=options.n_chunks,
+                                   chunk_delay=options.chunk_delay)
+        emulator.start()
+
+    start_server(options.host, options.port, options.keyfile, options.level,
+                 link)
 
 if __name__ == '__main__':
     #get_test_key()
@@ -1,4 +1,4 @@
-from client import ScannerClient
+from client import ScannerClient, ScannerClientPool
 from queuemanagers import SeriesFinder, DicomFinder, Volumizer
 from interface import ScannerInterface, setup_exit_handler
 from analyzers import MotionAnalyzer
@@ -4,15 +4,23 @@ import sys
 import time
 import logging
 import contextlib
+import multiprocessing
 from cStringIO import StringIO
 from Queue import Empty
-from time import sleep
 
 import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from nibabel.affines import apply_affine
 
 from nipy.algorithms.registration import HistogramRegistration, Rigid
+from nipy.algorithms.registration.affine import inverse_affine
+from nipy.algorithms.registration.histogram_registration import (
+    CLAMP_DTYPE, clamp, smallest_bounding_box)
+from nipy.core.image.image_spaces import as_xyz_image, xyz_affine
 
 from .queuemanagers import Finder
+from .timing import stamp
 
 
 logger = logging.getLogger(__name__)
@@ -21,27 +29,63 @@ logger = logging.getLogger(__name__)
 class MotionAnalyzer(Finder):
     """Compute real-time motion statistics for quality control."""
 
-    # Ultimately we'll want to make this more extensible.
-    # Because of how the queues work, you won't be able to run multiple
-    # analyzers at the same time. So if you wanted to, say, run some
-    # real-time GLM analysis and have real-time motion QA, you can't
-    # just have those as two separate objects.
-    # But it should work to be able to do that in an object-oriented
-    # hierarchy sense, where you always get motion QA (and maybe other
-    # stuff, like spike detection) and can optionally do more complicated
-    # or domain-specific stuff on top of that.
-    # For the time-being I'm not putting a ton of thought into that design
-    # though, just because I'm not really sure exactly how you would want
-    # it to look like.
-    def __init__(self, scanner, result_q, skip_vols=4, interval=1):
-        """Initialize the queue."""
+    engines = ("histogram", "gauss_newton")
+
+    # Several analyzers can run at the same time, each on its own
+    # subscription to the scanner's volumes (see ScannerInterface.subscribe),
+    # e.g. real-time motion QA next to a GLM or neurofeedback analysis.
+    def __init__(self, scanner, result_q, skip_vols=4, interval=1,
+                 fast=False, mask_reference=True,
+                 levels=((4, 4, 2), (2, 2, 1)), latency_budget=None,
+                 engine="histogram", catch_up=0, catch_up_backlog=3):
+        """Initialize the queue.
+
+        With `fast`, volumes are registered with compute_fast_registration
+        instead of compute_registration: only voxels in a brain mask of
+        the reference volume are used (if `mask_reference`), and the
+        registration runs coarse to fine over the voxel subsampling
+        `levels`, starting from the previous volume's transform. When a
+        `latency_budget` (in seconds) is given, finer levels are skipped
+        once they would push a volume's registration over budget.
+
+        `engine` chooses how volumes are registered: "histogram" uses
+        nipy's HistogramRegistration (see ReferenceRegistration) and
+        "gauss_newton" a least-squares fit of the intensities (see
+        GaussNewtonRegistration), which is much quicker but assumes the
+        volumes only differ from the reference by motion and noise.
+
+        With `catch_up` set to a number of processes, falling behind the
+        scanner doesn't keep us behind: once `catch_up_backlog` volumes
+        are waiting, they are registered in parallel in a pool of that
+        many processes, each from the last transform we know, and their
+        results are put in the queue in order. The pool is started when
+        each reference volume is assigned (see open_pool).
+        """
+        if engine not in self.engines:
+            raise ValueError("Unknown registration engine: {}".format(engine))
         super(MotionAnalyzer, self).__init__(interval)
         self.scanner = scanner
         self.result_q = result_q
         self.skip_vols = skip_vols
 
-        # The reference volume (first of each acquisition)
+        # Fast registration settings
+        self.fast = fast
+        self.mask_reference = mask_reference
+        self.levels = levels
+        self.latency_budget = latency_budget
+        self.engine_type = engine
+
+        # Catch-up settings and the process pool, started with each reference
+        self.catch_up = catch_up
+        self.catch_up_backlog = catch_up_backlog
+        self.pool = None
+        # Running estimate of how long each level takes
+        self.level_times = [None] * len(levels)
+
+        # The reference volume (first of each acquisition) and the
+        # registration engine set up for it
         self.ref_vol = None
+        self.engine = None
 
         # The previous registration matrix
         # (used for computing the relative deviation)
@@ -75,6 +119,45 @@ class MotionAnalyzer(Finder):
             T = reg.optimize(init)
         return T
 
+    def compute_fast_registration(self, moving, fixed, init=None,
+                                  mask=None, interp="tri"):
+        """Estimate a rigid transform from moving to fixed, quickly.
+
+        Parameters
+        ----------
+        moving : nibabel image object
+            Image to be registered to the reference image.
+        fixed : nibabel image object
+            Reference image.
+        init : transformation object or None
+            Initialization for the transformation, as for
+            compute_registration.
+        mask : boolean array or None
+            Voxels of `fixed` to register on (see brain_mask).
+
+        Returns
+        -------
+        T : nipy Rigid object
+            Rigid matrix giving transform from moving to fixed.
+
+        """
+        engine = ReferenceRegistration(fixed, mask, self.levels,
+                                       self.latency_budget, interp,
+                                       level_times=self.level_times)
+        return engine.register(moving, init)
+
+    def make_engine(self, ref_img):
+        """Return the registration engine for a new reference volume."""
+        if self.engine_type == "gauss_newton":
+            Engine = GaussNewtonRegistration
+        else:
+            Engine = ReferenceRegistration
+        if not self.fast:
+            return Engine(ref_img)
+        mask = brain_mask(ref_img) if self.mask_reference else None
+        return Engine(ref_img, mask, self.levels, self.latency_budget,
+                      level_times=self.level_times)
+
     def compute_rms(self, T1, T2, center=None, R=80):
         """Compute root mean squared displacement between two transform matrices.
 
@@ -131,85 +214,448 @@ class MotionAnalyzer(Finder):
                 return True
         return False
 
-    def run(self):
-        """This function gets looped over repetedly while thread is alive."""
-        vol_number = 0
-        while self.alive:
+    def volume_done(self, vol):
+        """Record that we have finished analyzing a volume."""
+        if hasattr(self.scanner, "volume_done"):
+            self.scanner.volume_done(vol)
+        else:
+            stamp(vol, "analyzed")
+
+    def backlog(self):
+        """Return the volumes waiting for us, up to a catch-up batch."""
+        vols = []
+        while len(vols) < 4 * self.catch_up - 1:
             try:
-                vol = self.scanner.get_volume(timeout=1)
+                vols.append(self.scanner.get_volume(block=False))
             except Empty:
-                sleep(self.interval)
-                continue
-
-            # Check if we need to reset the volume counter
-            if self.new_scanner_run(vol):
-                logger.debug(("Received first volume from new scanner run - "
-                              "exam: {} series: acquisition: {}"
-                              .format(vol["exam"], vol["series"],
-                                      vol["acquisition"])))
-                self.ref_vol = {}
-                vol_number = 0
-
-            # Check if we are outside of the stabilization scans
-            if vol_number < self.skip_vols:
-                # Still too early in the scan, just increment and bail out
-                vol_number += 1
-                continue
-
-            # Check if we need to reset the reference image
-            elif vol_number == self.skip_vols:
-                # Update the reference volume to start here
-                self.ref_vol = vol
-                logger.debug("Assigning new reference volume")
-
-                # Set the previous affine matrix to identity
-                self.pre_T = Rigid(np.eye(4))
-
-                # Put a dictionary of null results in the queue
-                result = dict(rot_x=0, rot_y=0, rot_z=0,
-                              trans_x=0, trans_y=0, trans_z=0,
-                              rms_ref=0, rms_pre=0, vol_number=vol_number,
-                              new_acquisition=True)
-                vol.update(result)
-                self.result_q.put(vol)
-
-                # Increment the volume counter and bail out
-                vol_number += 1
-                continue
-
+                break
+        return vols
+
+    def engine_settings(self):
+        """Return the keyword arguments that set up our engine."""
+        return dict(fast=self.fast, mask_reference=self.mask_reference,
+                    levels=self.levels, latency_budget=self.latency_budget,
+                    engine=self.engine_type)
+
+    def open_pool(self, ref_img):
+        """Start the catch-up process pool for a new reference volume.
+
+        Each worker sets up its own engine for the reference as it starts,
+        so this is done when the reference is assigned rather than once
+        volumes back up. The workers are forked from this thread while
+        the interface's threads are running, and may inherit locks those
+        threads held (Python 2 has no at-fork handlers), so they only
+        run the registration and don't log, fetch or import anything.
+        """
+        self.close_pool()
+        self.pool = multiprocessing.Pool(
+            self.catch_up, initializer=_init_catch_up_worker,
+            initargs=(np.asanyarray(ref_img.dataobj), ref_img.affine,
+                      self.engine_settings()))
+
+    def close_pool(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def register_volumes(self, pending):
+        """Register (vol_number, vol) pairs and put their results in order.
+
+        When there are at least `catch_up_backlog` of them, they are
+        registered at the same time in the catch-up process pool, all
+        starting from the last transform we know. Otherwise they are
+        registered one by one, each starting from the previous one.
+        """
+        if not pending:
+            return
+
+        if self.catch_up and len(pending) >= self.catch_up_backlog:
+            logger.debug("Catching up on {:d} volumes".format(len(pending)))
+            init = self.pre_T.as_affine()
+            args = [(np.asanyarray(vol["image"].dataobj),
+                     vol["image"].affine, init) for _, vol in pending]
+            start = time.time()
+            Ts = [Rigid(T) for T in
+                  self.pool.map(_register_catch_up, args)]
+            end = time.time()
+            logger.debug(("Computed motion for volumes {:d}-{:d} "
+                          "(took {:d} ms)"
+                          .format(pending[0][0], pending[-1][0],
+                                  int((end - start) * 1000))))
+            for (vol_number, vol), T in zip(pending, Ts):
+                self.report_volume(vol, vol_number, T)
+            return
+
+        for vol_number, vol in pending:
             # Compute the transformation to the reference image
             start = time.time()
-            T = self.compute_registration(vol["image"],
-                                          self.ref_vol["image"],
-                                          init=self.pre_T.copy(),
-                                          interp="tri")
+            T = self.engine.register(vol["image"], init=self.pre_T.copy())
             end = time.time()
             logger.debug(("Computed motion for volume {:d} (took {:d} ms)"
                           .format(vol_number, int((end - start) * 1000))))
+            self.report_volume(vol, vol_number, T)
 
-            # Compute the RMS displacement to the reference volume
-            rms_ref = self.compute_rms(Rigid(np.eye(4)), T)
+    def report_volume(self, vol, vol_number, T):
+        """Put the motion results of a registered volume in the queue."""
+        # Compute the RMS displacement to the reference volume
+        rms_ref = self.compute_rms(Rigid(np.eye(4)), T)
 
-            # Compute the RMS displacement from the previous volume
-            rms_pre = self.compute_rms(self.pre_T, T)
+        # Compute the RMS displacement from the previous volume
+        rms_pre = self.compute_rms(self.pre_T, T)
 
-            # Get the realignment parameters
-            rot_x, rot_y, rot_z = np.rad2deg(T.rotation)
-            trans_x, trans_y, trans_z = T.translation
+        # Get the realignment parameters
+        rot_x, rot_y, rot_z = np.rad2deg(T.rotation)
+        trans_x, trans_y, trans_z = T.translation
 
-            # Put the summary information into the result queue
-            result = dict(rot_x=rot_x, rot_y=rot_y, rot_z=rot_z,
-                          trans_x=trans_x, trans_y=trans_y, trans_z=trans_z,
-                          rms_ref=rms_ref, rms_pre=rms_pre,
-                          vol_number=vol_number, new_acquisition=False)
-            vol.update(result)
-            self.result_q.put(vol)
+        # Put the summary information into the result queue
+        result = dict(rot_x=rot_x, rot_y=rot_y, rot_z=rot_z,
+                      trans_x=trans_x, trans_y=trans_y, trans_z=trans_z,
+                      rms_ref=rms_ref, rms_pre=rms_pre,
+                      vol_number=vol_number, new_acquisition=False)
+        vol.update(result)
+        self.volume_done(vol)
+        self.put(self.result_q, vol)
 
-            # Update the previous transformation matrix
-            self.pre_T = T
+        # Update the previous transformation matrix
+        self.pre_T = T
 
-            # Update the volume counter
-            vol_number += 1
+    def run(self):
+        """This function gets looped over repetedly while thread is alive."""
+        vol_number = 0
+        while self.is_alive:
+            try:
+                # Blocks until a volume arrives, so no need to sleep
+                vol = self.scanner.get_volume(timeout=self.interval)
+            except Empty:
+                continue
+
+            # In catch-up mode, take whatever else is waiting as well
+            vols = [vol]
+            if self.catch_up:
+                vols.extend(self.backlog())
+
+            # Volumes of this batch to register to the current reference
+            pending = []
+            for vol in vols:
+
+                # Check if we need to reset the volume counter
+                if self.new_scanner_run(vol):
+                    logger.debug(("Received first volume from new scanner "
+                                  "run - exam: {} series: acquisition: {}"
+                                  .format(vol["exam"], vol["series"],
+                                          vol["acquisition"])))
+                    self.register_volumes(pending)
+                    pending = []
+                    self.ref_vol = {}
+                    vol_number = 0
+
+                # Check if we are outside of the stabilization scans
+                if vol_number < self.skip_vols:
+                    # Still too early in the scan, just increment and bail out
+                    vol_number += 1
+                    continue
+
+                # Check if we need to reset the reference image
+                elif vol_number == self.skip_vols:
+                    # Update the reference volume to start here
+                    self.ref_vol = vol
+                    self.engine = self.make_engine(vol["image"])
+                    if self.catch_up:
+                        self.open_pool(vol["image"])
+                    logger.debug("Assigning new reference volume")
+
+                    # Set the previous affine matrix to identity
+                    self.pre_T = Rigid(np.eye(4))
+
+                    # Put a dictionary of null results in the queue
+                    result = dict(rot_x=0, rot_y=0, rot_z=0,
+                                  trans_x=0, trans_y=0, trans_z=0,
+                                  rms_ref=0, rms_pre=0, vol_number=vol_number,
+                                  new_acquisition=True)
+                    vol.update(result)
+                    self.put(self.result_q, vol)
+
+                    # Increment the volume counter and bail out
+                    vol_number += 1
+                    continue
+
+                pending.append((vol_number, vol))
+
+                # Update the volume counter
+                vol_number += 1
+
+            self.register_volumes(pending)
+
+        self.close_pool()
+
+class ReferenceRegistration(HistogramRegistration):
+    """Rigid registration of a series of volumes to one reference.
+
+    nipy's HistogramRegistration clamps and subsamples the image it
+    samples from whenever it is created. Here the reference is that
+    image, so its side (clamping, masking and the subsampled voxel grid
+    of each level) is set up once, and each volume only replaces the
+    image it is compared against. register() inverts the transform it
+    finds, so it still returns moving -> fixed.
+
+    Without `levels`, the reference is subsampled the way nipy does by
+    default and the registration runs once. Otherwise it runs coarse to
+    fine over the `levels` spacings; see MotionAnalyzer for `mask` and
+    `latency_budget`. `level_times` is the list of running estimates of
+    each level's cost, which may be shared between engines.
+
+    """
+
+    def __init__(self, fixed, mask=None, levels=None, latency_budget=None,
+                 interp="tri", level_times=None, bins=256):
+        super(ReferenceRegistration, self).__init__(fixed, fixed,
+                                                    from_bins=bins,
+                                                    from_mask=mask,
+                                                    interp=interp)
+        self.bins = bins
+        self.levels = levels
+        self.latency_budget = latency_budget
+        if level_times is None:
+            level_times = [None] * len(levels or [None])
+        self.level_times = level_times
+
+        # Subsample the reference for each level now
+        if mask is None:
+            corner, size = (0, 0, 0), None
+        else:
+            corner, size = smallest_bounding_box(mask)
+        self._fovs = {None: self._fov()}
+        for spacing in levels or []:
+            self.set_fov(spacing=spacing, corner=corner, size=size)
+            self._fovs[spacing] = self._fov()
+
+    def _fov(self):
+        """Return the sampled reference state set up by set_fov."""
+        return (self._from_data, self._from_npoints, self._from_affine,
+                self._vox_coords)
+
+    def _use_fov(self, spacing):
+        (self._from_data, self._from_npoints, self._from_affine,
+         self._vox_coords) = self._fovs[spacing]
+
+    def set_moving(self, moving):
+        """Make `moving` the image registered to the reference."""
+        to_img = as_xyz_image(moving)
+        data, to_bins = clamp(to_img.get_data(), self.bins)
+        self._to_data = -np.ones(np.array(to_img.shape) + 2,
+                                 dtype=CLAMP_DTYPE)
+        self._to_data[1:-1, 1:-1, 1:-1] = data
+        self._to_inv_affine = inverse_affine(xyz_affine(to_img))
+
+        if to_bins != self._joint_hist.shape[1]:
+            self._joint_hist = np.zeros([self._joint_hist.shape[0],
+                                         to_bins], dtype='double')
+            self._set_similarity(self._similarity)
+
+    def register(self, moving, init=None):
+        """Return the rigid transform from `moving` to the reference."""
+        if init is None:
+            # Same small rotation as MotionAnalyzer.compute_registration
+            init = Rigid((0, 0, 0, 0.01, 0.01, 0.01, 0, 0, 0, 0, 0, 0))
+        self.set_moving(moving)
+
+        T = init.inv()
+        start = time.time()
+        for i, spacing in enumerate(self.levels or [None]):
+            expected = self.level_times[i]
+            if (i and self.latency_budget is not None
+                    and expected is not None
+                    and time.time() - start + expected
+                    > self.latency_budget):
+                logger.debug("Skipping registration levels {} and finer "
+                             "to stay within budget".format(spacing))
+                break
+
+            tic = time.time()
+            self._use_fov(spacing)
+            with silent():
+                T = self.optimize(T)
+            took = time.time() - tic
+            if expected is None:
+                self.level_times[i] = took
+            else:
+                self.level_times[i] = .8 * expected + .2 * took
+
+        return T.inv()
+
+
+class GaussNewtonRegistration(object):
+    """Least-squares rigid registration of a series of volumes to one reference.
+
+    An alternative to ReferenceRegistration for same-session EPI, where
+    the volumes differ from the reference mostly by motion. The sum of
+    squared intensity differences is minimized with the inverse
+    compositional Gauss-Newton algorithm (Baker & Matthews, 2004): the
+    gradient of the reference, its Jacobian with respect to the rigid
+    parameters and the Gauss-Newton Hessian only depend on the reference,
+    so they are computed once, and each iteration only resamples the
+    moving image at the reference's voxels.
+
+    `mask`, `levels`, `latency_budget` and `level_times` are used as in
+    ReferenceRegistration. At a level with a spacing larger than one
+    voxel, both images are smoothed with a Gaussian of half the spacing
+    so the coarse levels see the larger motions.
+
+    """
+
+    def __init__(self, fixed, mask=None, levels=None, latency_budget=None,
+                 level_times=None, max_iter=20, tol=1e-3):
+        self.levels = levels
+        self.latency_budget = latency_budget
+        if level_times is None:
+            level_times = [None] * len(levels or [None])
+        self.level_times = level_times
+        self.max_iter = max_iter
+        self.tol = tol
+
+        data = np.asarray(fixed.get_data(), dtype=np.float64)
+        if mask is None:
+            mask = np.ones(data.shape, bool)
+        affine = fixed.affine
+
+        # Rotate about the middle of the voxels used
+        ijk = np.array(np.nonzero(mask)).T
+        self.center = apply_affine(affine, ijk.mean(axis=0))
+
+        self._levels = {}
+        for spacing in levels or [None]:
+            self._levels[spacing] = self._setup_level(data, mask, affine,
+                                                      spacing)
+
+    def _setup_level(self, data, mask, affine, spacing):
+        """Precompute the reference side of one level."""
+        sigma = self._sigma(spacing)
+        if any(sigma):
+            data = ndimage.gaussian_filter(data, sigma)
+
+        # Voxel gradient of the reference, taken to world coordinates
+        grad = np.array(np.gradient(data))
+        if spacing is None:
+            sub = mask
+        else:
+            sub = np.zeros_like(mask)
+            sub[tuple(slice(None, None, s) for s in spacing)] = True
+            sub &= mask
+        ijk = np.array(np.nonzero(sub))
+        grad = grad[(slice(None),) + tuple(ijk)].T
+        grad = grad.dot(np.linalg.inv(affine[:3, :3]))
+
+        # Steepest descent images for (translation, rotation vector)
+        xyz = apply_affine(affine, ijk.T)
+        J = np.hstack([grad, np.cross(xyz - self.center, grad)])
+        H = J.T.dot(J)
+        # A little damping keeps directions the data can't see in check
+        H += 1e-6 * np.trace(H) / 6 * np.eye(6)
+
+        return dict(sigma=sigma, xyz=np.c_[xyz, np.ones(len(xyz))].T,
+                    values=data[tuple(ijk)], J=J, H_inv=np.linalg.inv(H))
+
+    def _sigma(self, spacing):
+        if spacing is None:
+            return (0, 0, 0)
+        return tuple(s / 2 if s > 1 else 0 for s in spacing)
+
+    def _delta_affine(self, dp):
+        """Return the world affine of the rigid parameter update `dp`."""
+        affine = np.eye(4)
+        theta = np.linalg.norm(dp[3:])
+        if theta:
+            k = dp[3:] / theta
+            K = np.array([[0, -k[2], k[1]],
+                          [k[2], 0, -k[0]],
+                          [-k[1], k[0], 0]])
+            affine[:3, :3] += np.sin(theta) * K + (1 - np.cos(theta)) * K.dot(K)
+        affine[:3, 3] = dp[:3] + self.center - affine[:3, :3].dot(self.center)
+        return affine
+
+    def _optimize(self, level, moving, inv_affine, W):
+        """Run Gauss-Newton iterations at one level; return the new W."""
+        for _ in range(self.max_iter):
+            coords = inv_affine.dot(W).dot(level["xyz"])[:3]
+            warped = ndimage.map_coordinates(moving, coords, order=1,
+                                             mode="nearest")
+            dp = level["H_inv"].dot(level["J"].T.dot(warped
+                                                     - level["values"]))
+            W = W.dot(np.linalg.inv(self._delta_affine(dp)))
+            if (np.abs(dp[:3]).max() < self.tol
+                    and np.abs(dp[3:]).max() < self.tol / 100):
+                break
+        return W
+
+    def register(self, moving, init=None):
+        """Return the rigid transform from `moving` to the reference."""
+        data = np.asarray(moving.get_data(), dtype=np.float64)
+        inv_affine = np.linalg.inv(moving.affine)
+
+        # W takes reference coordinates to moving ones
+        W = np.eye(4) if init is None else np.linalg.inv(init.as_affine())
+        start = time.time()
+        for i, spacing in enumerate(self.levels or [None]):
+            expected = self.level_times[i]
+            if (i and self.latency_budget is not None
+                    and expected is not None
+                    and time.time() - start + expected
+                    > self.latency_budget):
+                logger.debug("Skipping registration levels {} and finer "
+                             "to stay within budget".format(spacing))
+                break
+
+            tic = time.time()
+            level = self._levels[spacing]
+            level_data = data
+            if any(level["sigma"]):
+                level_data = ndimage.gaussian_filter(data, level["sigma"])
+            W = self._optimize(level, level_data, inv_affine, W)
+            took = time.time() - tic
+            if expected is None:
+                self.level_times[i] = took
+            else:
+                self.level_times[i] = .8 * expected + .2 * took
+
+        return Rigid(np.linalg.inv(W))
+
+
+# The registration engine of a catch-up worker process
+_catch_up_engine = None
+
+
+def _init_catch_up_worker(data, affine, settings):
+    """Set up the engine of a catch-up worker for a reference volume."""
+    global _catch_up_engine
+    # A logging lock may have been held by another thread when we were
+    # forked (see MotionAnalyzer.open_pool); with logging disabled, the
+    # engines' logger calls return before taking any lock
+    logging.disable(logging.CRITICAL)
+    analyzer = MotionAnalyzer(None, None, **settings)
+    _catch_up_engine = analyzer.make_engine(nib.Nifti1Image(data, affine))
+
+
+def _register_catch_up(args):
+    """Register one volume in a catch-up worker; return the affine of T."""
+    data, affine, init = args
+    T = _catch_up_engine.register(nib.Nifti1Image(data, affine),
+                                  init=Rigid(init))
+    return T.as_affine()
+
+
+def brain_mask(img, frac=0.3, dilate=1):
+    """Return a rough brain mask of an EPI volume.
+
+    Voxels brighter than `frac` of the volume's robust maximum are kept,
+    and the mask is dilated by `dilate` voxels so the edges of the head,
+    where motion shows up most, stay in.
+    """
+    data = np.asanyarray(img.dataobj)
+    mask = data > frac * np.percentile(data, 98)
+    if dilate:
+        mask = ndimage.binary_dilation(mask, iterations=dilate)
+    return mask
 
 
 @contextlib.contextmanager
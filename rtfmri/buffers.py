@@ -0,0 +1,301 @@
+"""Reusable containers for moving data through the real-time pipeline."""
+from __future__ import print_function, division
+import multiprocessing
+from threading import Lock
+from Queue import Queue
+
+import numpy as np
+
+
+class BufferPool(object):
+    """A small pool of reusable bytearrays to read files into.
+
+    Slices from one series are all about the same size, so after the first
+    few files every read can go into a buffer that is already allocated
+    instead of growing a fresh one.
+
+    """
+
+    def __init__(self, max_buffers=8, granularity=2 ** 16):
+        self.max_buffers = max_buffers
+        # Round sizes up so files that differ by a few bytes share buffers
+        self.granularity = granularity
+        self.lock = Lock()
+        self.free = []
+        self.n_allocated = 0
+        self.n_reused = 0
+
+    def acquire(self, size=0):
+        """Return a bytearray of at least `size` bytes."""
+        with self.lock:
+            for i, buf in enumerate(self.free):
+                if len(buf) >= size:
+                    self.n_reused += 1
+                    return self.free.pop(i)
+            self.n_allocated += 1
+
+        n_blocks = max(1, -(-size // self.granularity))
+        return bytearray(n_blocks * self.granularity)
+
+    def release(self, buf):
+        """Give a buffer back to the pool."""
+        with self.lock:
+            if len(self.free) < self.max_buffers:
+                # Keep the list sorted so acquire finds the smallest fit
+                self.free.append(buf)
+                self.free.sort(key=len)
+
+
+class BoundedQueue(Queue):
+    """A Queue with a size limit and a policy for when it is full.
+
+    Policies
+    --------
+    block
+        put blocks until there is room (or raises Full after its timeout),
+        pushing back on the producer.
+    drop_oldest
+        put never blocks; the oldest items are dropped to make room.
+    latest
+        Only the newest item is kept, for consumers that always want the
+        freshest data (e.g. neurofeedback).
+
+    `n_dropped` counts the items dropped and `high_water` the most items
+    that were ever waiting at once.
+
+    """
+
+    policies = ("block", "drop_oldest", "latest")
+
+    def __init__(self, maxsize=0, policy="block"):
+        if policy not in self.policies:
+            raise ValueError("Unknown queue policy: {}".format(policy))
+        if policy == "latest":
+            maxsize = 1
+        Queue.__init__(self, maxsize)
+        self.policy = policy
+        self.n_dropped = 0
+        self.high_water = 0
+
+    def put(self, item, block=True, timeout=None):
+        """Put an item on the queue, following the queue's policy."""
+        if self.policy == "block" or self.maxsize <= 0:
+            return Queue.put(self, item, block, timeout)
+
+        with self.not_full:
+            while self._qsize() >= self.maxsize:
+                self._get()
+                self.n_dropped += 1
+                # Nobody will call task_done for the dropped item
+                self.unfinished_tasks -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def _put(self, item):
+        Queue._put(self, item)
+        self.high_water = max(self.high_water, self._qsize())
+
+    def stats(self):
+        """Return the size, limit and drop counts of the queue."""
+        return {"size": self.qsize(), "maxsize": self.maxsize,
+                "policy": self.policy, "dropped": self.n_dropped,
+                "high_water": self.high_water}
+
+
+class SliceBuffer(object):
+    """Slices of a scanner run waiting to be assembled into volumes.
+
+    Slices are kept by instance number. The buffer tracks which numbers
+    the current volume needs and how many of them are still missing, so
+    adding a slice and checking whether the volume is complete take
+    constant time. `legal_indices` restricts the needed slices to those
+    a dicom filter allows (slice positions, `number % slices_per_volume`).
+
+    """
+
+    def __init__(self, slices_per_volume, legal_indices=None):
+        self.slices_per_volume = slices_per_volume
+        self.legal_indices = legal_indices
+        self.slices = {}
+        # Instance number just before the current volume
+        self.volume_start = 0
+        self._set_needed()
+
+    def _set_needed(self):
+        """Work out which slices the current volume needs."""
+        spv = self.slices_per_volume
+        needed = range(self.volume_start + 1, self.volume_start + spv + 1)
+        if self.legal_indices is not None:
+            needed = [x for x in needed if x % spv in self.legal_indices]
+        self.needed = needed
+        self._needed_set = set(needed)
+        self.n_missing = len(self._needed_set.difference(self.slices))
+
+    def set_legal_indices(self, legal_indices):
+        """Only wait for the slices a dicom filter allows from now on."""
+        self.legal_indices = legal_indices
+        self._set_needed()
+
+    def add(self, number, dcm):
+        """Add the slice with instance number `number`."""
+        if number <= self.volume_start or number in self.slices:
+            # Late or duplicate slice
+            return
+        self.slices[number] = dcm
+        if number in self._needed_set:
+            self.n_missing -= 1
+
+    @property
+    def complete(self):
+        """Whether we have every slice the current volume needs."""
+        return bool(self.needed) and self.n_missing == 0
+
+    def missing(self):
+        """Return the instance numbers the current volume still needs."""
+        return [x for x in self.needed if x not in self.slices]
+
+    def pop_volume(self):
+        """Remove the current volume's slices, in order, and move on."""
+        volume = [self.slices.pop(x) for x in self.needed]
+        # Forget slices of this volume that we didn't need
+        for x in range(self.volume_start + 1,
+                       self.volume_start + self.slices_per_volume + 1):
+            self.slices.pop(x, None)
+        self.volume_start += self.slices_per_volume
+        self._set_needed()
+        return volume
+
+
+class VolumeStore(object):
+    """Preallocated ring of the most recent volumes of a run.
+
+    Volumes are copied into one 4D array (time first, so each volume is
+    a contiguous block) rather than kept as separate images. `last`
+    returns a view of the array unless the volumes asked for wrap around
+    the end of the ring, in which case it returns a copy. Views stay
+    valid until the ring wraps around them, i.e. for `length - N` more
+    volumes.
+
+    With `mirror`, each volume is written twice, `length` slots apart, so
+    the last N volumes are always a contiguous slice of the array and
+    `last` always returns a view, at the cost of twice the memory.
+
+    Pass `filename` to back the array with a memory-mapped file instead
+    of memory.
+
+    """
+
+    def __init__(self, shape, dtype, length, filename=None, mirror=False):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.length = length
+        self.filename = filename
+        self.mirror = mirror
+        full_shape = ((2 if mirror else 1) * length,) + self.shape
+        if filename is None:
+            self.data = np.empty(full_shape, self.dtype)
+        else:
+            self.data = np.memmap(filename, self.dtype, "w+",
+                                  shape=full_shape)
+        self.info = [None] * length
+        self.n_added = 0
+        self.lock = Lock()
+
+    def __len__(self):
+        return min(self.n_added, self.length)
+
+    def add(self, volume, info=None):
+        """Copy a volume (and a small dict about it) into the ring."""
+        slot = self.n_added % self.length
+        self.data[slot] = volume
+        if self.mirror:
+            self.data[slot + self.length] = volume
+        with self.lock:
+            self.info[slot] = info
+            self.n_added += 1
+
+    def _window(self, n):
+        """Return the slots [start, stop) of the last `n` volumes.
+
+        Without `mirror`, start is negative when the volumes wrap around
+        the end of the ring.
+        """
+        with self.lock:
+            n_added = self.n_added
+        n_stored = min(n_added, self.length)
+        n = n_stored if n is None else min(n, n_stored)
+        stop = (n_added - 1) % self.length + 1
+        if self.mirror:
+            stop += self.length
+        return stop - n, stop
+
+    def last(self, n=None):
+        """Return a (n, x, y, z) array of the last `n` volumes, oldest first.
+
+        With no `n`, return every volume still in the ring.
+        """
+        if not self.n_added:
+            return self.data[:0]
+        start, stop = self._window(n)
+        if start < 0:
+            return np.concatenate([self.data[start:], self.data[:stop]])
+        return self.data[start:stop]
+
+    def last_info(self, n=None):
+        """Return the info dicts of the last `n` volumes, oldest first."""
+        if not self.n_added:
+            return []
+        start, stop = self._window(n)
+        return [self.info[i % self.length] for i in range(start, stop)]
+
+
+class SharedVolumeRing(object):
+    """Shared-memory slots for handing arrays to another process.
+
+    The memory is allocated before the processes fork, so both sides see
+    the same slots. `put` copies an array into a free slot and returns a
+    small descriptor to send through a multiprocessing queue instead of
+    the array itself; `get` copies the array back out and frees the slot.
+    Waiting for a free slot holds the producer back when the consumer
+    falls behind. Arrays bigger than a slot are put in the descriptor
+    itself, which works but is pickled through the queue.
+
+    """
+
+    def __init__(self, n_slots=4, slot_bytes=2 ** 23):
+        self.n_slots = n_slots
+        self.slot_bytes = slot_bytes
+        self.memory = multiprocessing.RawArray("b", n_slots * slot_bytes)
+        self.view = np.ctypeslib.as_array(self.memory)
+        self.free = multiprocessing.Queue()
+        for slot in range(n_slots):
+            self.free.put(slot)
+
+    def put(self, data, timeout=None):
+        """Copy `data` into a free slot and return its descriptor.
+
+        Raises Queue.Empty if no slot frees up within `timeout`.
+        """
+        data = np.ascontiguousarray(data)
+        if data.nbytes > self.slot_bytes:
+            return {"data": data}
+
+        slot = self.free.get(timeout=timeout)
+        start = slot * self.slot_bytes
+        self.view[start:start + data.nbytes] = data.reshape(-1).view(np.int8)
+        return {"slot": slot, "shape": data.shape, "dtype": data.dtype.str}
+
+    def get(self, descriptor):
+        """Return the array a descriptor points to and free its slot."""
+        if "data" in descriptor:
+            return descriptor["data"]
+
+        dtype = np.dtype(descriptor["dtype"])
+        shape = descriptor["shape"]
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        start = descriptor["slot"] * self.slot_bytes
+        data = self.view[start:start + nbytes].view(dtype).reshape(shape)
+        data = data.copy()
+        self.free.put(descriptor["slot"])
+        return data
@@ -0,0 +1,72 @@
+"""Persistent caches for metadata read from the scanner."""
+from __future__ import print_function
+import json
+import sqlite3
+from datetime import datetime
+from threading import Lock
+
+
+class SeriesInfoCache(object):
+    """Cache of ScannerClient.series_info results in an SQLite file.
+
+    Entries are keyed by the scanner's hostname, its base directory and
+    the remote series directory, and remember the directory mtime they
+    were read at. The file can be shared by several
+    clients and processes, so a restarted session doesn't have to read
+    dicoms for series it has already seen.
+
+    """
+
+    datetime_format = "%Y%m%d%H%M%S"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = Lock()
+        # Connections are shared between the threads of a client pool,
+        # so we do our own locking
+        self.conn = sqlite3.connect(path, timeout=10,
+                                    check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS series_info ("
+                              "hostname TEXT, "
+                              "base_dir TEXT, "
+                              "series_dir TEXT, "
+                              "mtime INTEGER, "
+                              "info TEXT, "
+                              "PRIMARY KEY (hostname, base_dir, series_dir))")
+
+    def get(self, hostname, base_dir, series_dir):
+        """Return (mtime, info) for a series, or None if it isn't cached."""
+        with self.lock:
+            row = self.conn.execute("SELECT mtime, info FROM series_info "
+                                    "WHERE hostname = ? AND base_dir = ? "
+                                    "AND series_dir = ?",
+                                    (hostname, base_dir,
+                                     series_dir)).fetchone()
+        if row is None:
+            return None
+
+        mtime, info = row
+        info = json.loads(info)
+        info["DateTime"] = datetime.strptime(info["DateTime"],
+                                             self.datetime_format)
+        return mtime, info
+
+    def put(self, hostname, base_dir, series_dir, mtime, info):
+        """Store the info dict for a series read at directory `mtime`."""
+        info = dict(info)
+        info["DateTime"] = info["DateTime"].strftime(self.datetime_format)
+        # pydicom IS values are int subclasses; store them as plain ints
+        for key in ["Series", "NumTimepoints", "NumAcquisitions"]:
+            info[key] = int(info[key])
+
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO series_info "
+                              "VALUES (?, ?, ?, ?, ?)",
+                              (hostname, base_dir, series_dir, mtime,
+                               json.dumps(info)))
+
+    def close(self):
+        """Close the database connection."""
+        with self.lock:
+            self.conn.close()
@@ -8,23 +8,71 @@ import re
 import ftplib
 import socket
 import sys
+import time
 import cStringIO
+import contextlib
+import logging
+import pipes
 import os.path as op
 from datetime import datetime
+from Queue import Queue, Empty
+from threading import Thread, Event, Lock
 
 import libssh2
 import pydicom
 
 from utilities import alphanum_key
+from buffers import BufferPool
+from cache import SeriesInfoCache
+from decoder import SliceDecoder
+from timing import stamp
+
+logger = logging.getLogger(__name__)
+
+# (7FE0,0010) Pixel Data, as it appears in a little endian file
+PIXEL_DATA_TAG = b"\xe0\x7f\x10\x00"
+
+# Header fields series_info reads from the first dicom of a series
+SERIES_INFO_FIELDS = ["StudyDate", "StudyTime", "SeriesNumber",
+                      "SeriesDescription", "NumberOfTemporalPositions"]
 
 
 class ScannerClient(object):
     """Client to interface via ssh protocol with GE scanner in realtime."""
 
+    # Shell command run on the scanner by watch_dir. It prints the name of
+    # each new file in the directory, one per line, using inotifywait when
+    # it is installed and a `find -newer` loop otherwise. An empty line is
+    # printed every interval as a heartbeat: once the channel is gone the
+    # write fails (or raises SIGPIPE) and the command exits, as it does
+    # when the shell's parent (the ssh session) goes away.
+    watch_command = (
+        "cd {path} || exit 1; "
+        "trap 'exit 1' HUP PIPE TERM; "
+        "if command -v inotifywait >/dev/null 2>&1; then "
+        "inotifywait -m -q -e close_write -e moved_to --format %f . & "
+        "watcher=$!; "
+        "trap 'kill $watcher 2>/dev/null' EXIT; "
+        "while kill -0 $watcher 2>/dev/null && kill -0 $PPID 2>/dev/null "
+        "&& echo 2>/dev/null; do "
+        "sleep {interval}; "
+        "done; "
+        "else "
+        "stamp=$(mktemp) && trap 'rm -f $stamp' EXIT && "
+        "while kill -0 $PPID 2>/dev/null && echo 2>/dev/null; do "
+        "next=$(mktemp); "
+        "find . -maxdepth 1 -type f -newer $stamp; "
+        "mv -f $next $stamp; "
+        "sleep {interval}; "
+        "done; fi"
+    )
+
     def __init__(self, hostname="cnimr", port=22,
                  username="", password="",
                  base_dir="/export/home1/sdc_image_pool/images",
-                 private_key=None, public_key=None, lock=None):
+                 private_key=None, public_key=None, lock=None,
+                 cache_listings=True, reuse_buffers=True, series_cache=None,
+                 fast_decode=True, listing_cache=None):
         self.hostname = hostname
         self.username = username
         self.password = password
@@ -40,6 +88,34 @@ class ScannerClient(object):
 
         # Set the maximum buffer size for reading files via sftp
         self.max_buf_size = pow(2, 30)
+        self.min_read = pow(2, 16)
+
+        # Dicoms are read into reusable buffers sized from the listing
+        self.buffer_pool = BufferPool() if reuse_buffers else None
+
+        # Slices of the current series are decoded against the layout of
+        # its first slice (see SliceDecoder)
+        self.fast_decode = fast_decode
+        self._decoder = (None, None)
+
+        # Optional persistent cache of series_info results; either a
+        # SeriesInfoCache or the path of its database file
+        if isinstance(series_cache, basestring):
+            series_cache = SeriesInfoCache(series_cache)
+        self.series_cache = series_cache
+
+        # Directory listings are cached per remote path and revalidated
+        # with a stat of the directory (see _cached_listing). Clients can
+        # share them by passing in the same `listing_cache` dict.
+        self.cache_listings = cache_listings
+        self.listing_settle_time = 1.1
+        self._listing_cache = {} if listing_cache is None else listing_cache
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Index of the latest patient/exam/series (see _index_lookup)
+        self._index = {}
+        self.index_max_age = 0.5
 
         self.connect()
 
@@ -107,8 +183,44 @@ class ScannerClient(object):
         either alphanumerically if sort=='alpha' or based upon
         one of the attributes we get from sftp listdir which we put
         in a dictionary and pass to our parser.
-        """
 
+        With `cache_listings` on, the sorted result is memoized per
+        directory and only re-read when a stat of the directory says
+        it has changed. Sorting on an attribute (e.g. mtime) depends on
+        the entries themselves changing, which a stat of the directory
+        can't see, so those listings are always read fresh.
+        """
+        if not self.cache_listings or sort != 'alpha':
+            return self._parse_dir_output(self._read_dir(remote_path),
+                                          sort=sort)
+
+        entry = self._cached_listing(remote_path)
+        key = (sort, False)
+        if key not in entry["sorted"]:
+            entry["sorted"][key] = self._parse_dir_output(
+                list(entry["files"]), sort=sort)
+
+        return list(entry["sorted"][key])
+
+    def _list_paths(self, remote_path, sort='alpha'):
+        """Like list_dir, but return full paths (also memoized)."""
+        if not self.cache_listings:
+            return [op.join(remote_path, n)
+                    for n in self.list_dir(remote_path, sort=sort)]
+
+        names = self.list_dir(remote_path, sort=sort)
+        entry = self._listing_cache.get(remote_path)
+        if entry is None:
+            # Cleared since by a client sharing the cache
+            return [op.join(remote_path, n) for n in names]
+        key = (sort, True)
+        if key not in entry["sorted"]:
+            entry["sorted"][key] = [op.join(remote_path, n) for n in names]
+
+        return list(entry["sorted"][key])
+
+    def _read_dir(self, remote_path):
+        """Read the entries and attributes of a remote directory."""
         if self.lock is not None:
             self.lock.acquire()
         try:
@@ -131,7 +243,64 @@ class ScannerClient(object):
             if self.lock is not None:
                 self.lock.release()
 
-        return self._parse_dir_output(files, sort=sort)
+        return files
+
+    def _stat(self, remote_path):
+        """Return the sftp attributes of a remote path as a dictionary."""
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            size, uid, gid, mode, atime, mtime = self.sftp.get_stat(
+                remote_path)
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+        return {'size': size, 'uid': uid, 'gid': gid, 'mode': mode,
+                'atime': atime, 'mtime': mtime}
+
+    def _cached_listing(self, remote_path):
+        """Return the cache entry for a directory, re-reading it if needed.
+
+        Directory mtimes only have one second resolution, so a file written
+        in the same second as a listing would not change the stat. A cached
+        listing is therefore only trusted once it was read at least
+        `listing_settle_time` seconds after its mtime was first seen.
+        """
+        stat = self._stat(remote_path)
+        stat_key = (stat['size'], stat['mtime'])
+        now = time.time()
+
+        entry = self._listing_cache.get(remote_path)
+        if entry is not None and entry["stat"] == stat_key:
+            settled = (entry["listed_at"] - entry["stat_seen"]
+                       >= self.listing_settle_time)
+            if settled:
+                self.cache_hits += 1
+                return entry
+            stat_seen = entry["stat_seen"]
+        else:
+            stat_seen = now
+
+        self.cache_misses += 1
+        entry = {
+            "stat": stat_key,
+            "stat_seen": stat_seen,
+            "listed_at": now,
+            "files": self._read_dir(remote_path),
+            "sorted": {},
+        }
+        self._listing_cache[remote_path] = entry
+        return entry
+
+    def listing_cache_stats(self):
+        """Return the hit and miss counts of the directory listing cache."""
+        return {"hits": self.cache_hits, "misses": self.cache_misses,
+                "entries": len(self._listing_cache)}
+
+    def clear_listing_cache(self):
+        """Forget all cached directory listings."""
+        self._listing_cache.clear()
 
     def _parse_dir_output(self, file_list, sort='alpha'):
         """list_dir gives us a list of dictionaries for file names + stats.
@@ -189,17 +358,69 @@ class ScannerClient(object):
         who has most recently been scanned, assuming at least one scan
         has been performed.
         """
-        print(self.base_dir)
-        latest_patient = self._latest_entry(self.base_dir, sort='mtime')
-        print(latest_patient)
-        return self._latest_entry(latest_patient)
+        return self._index_lookup("exam")
 
     @property
     def latest_series(self):
         """Return a path to the most recent series directory."""
         # The series directory should always be three layers deep
-        return self._latest_entry(self.latest_exam)
+        return self._index_lookup("series")
 
+    def _index_lookup(self, level):
+        """Return the latest patient, exam or series path from the index.
+
+        The index keeps the latest entry at each level of the
+        patient/exam/series tree. A level is only looked up again once it
+        is older than `index_max_age` seconds or its parent changed, and
+        every level goes through the stat-gated listing cache (see
+        _latest_patient), so an unchanged tree costs a stat per level at
+        most.
+        """
+        now = time.time()
+        parent = self.base_dir
+        parent_changed = False
+
+        for name in ["patient", "exam", "series"]:
+            path, checked_at = self._index.get(name, (None, 0))
+
+            if (path is None or parent_changed
+                    or now - checked_at >= self.index_max_age):
+                if name == "patient":
+                    latest = self._latest_patient()
+                else:
+                    latest = self._latest_entry(parent)
+                parent_changed = latest != path
+                self._index[name] = (latest, now)
+                path = latest
+
+            if name == level:
+                return path
+            parent = path
+
+    def _latest_patient(self):
+        """Return a path to the most recently modified patient directory.
+
+        The patients are sorted by the mtimes in the listing of base_dir,
+        which is only read again when a stat of base_dir changes (i.e. a
+        patient was added), as for the other levels. A new exam for a
+        patient that was already listed is picked up once the index is
+        cleared (see clear_index).
+        """
+        if not self.cache_listings:
+            return self._latest_entry(self.base_dir, sort="mtime")
+
+        entry = self._cached_listing(self.base_dir)
+        key = ("mtime", False)
+        if key not in entry["sorted"]:
+            entry["sorted"][key] = self._parse_dir_output(
+                list(entry["files"]), sort="mtime")
+        return op.join(self.base_dir, entry["sorted"][key][-1])
+
+    def clear_index(self):
+        """Forget the indexed latest patient, exam and series."""
+        self._index = {}
+        # The patient mtimes in the base_dir listing may be out of date
+        self._listing_cache.pop(self.base_dir, None)
 
     def series_dirs(self, exam_dir=None):
         """Return a list of all series dirs for an exam."""
@@ -207,29 +428,41 @@ class ScannerClient(object):
             exam_dir = self.latest_exam
 
         # Get the list of entries in the exam dir
-        exam_contents = self.list_dir(exam_dir)
-        series_dirs = [op.join(exam_dir, n) for n in exam_contents]
-        return series_dirs
+        return self._list_paths(exam_dir)
 
     def series_files(self, series_dir=None):
         """Return a list of all files for a series."""
         if series_dir is None:
             series_dir = self.latest_series
 
-        # Get the list of entries in the exam dir
-        series_contents = self.list_dir(series_dir)
-        series_files = [op.join(series_dir, n) for n in series_contents]
-        return series_files
+        # Get the list of entries in the series dir
+        return self._list_paths(series_dir)
 
     def series_info(self, series_dir=None):
         """
         Return a dict with information about a series.
-        In practice, this function adds significant overhead if performing
-        neurofeedback, so we often will want to skip.
+        Only the header of the first dicom is fetched, but this still
+        costs a listing and a read, so we often will want to skip it
+        if performing neurofeedback.
         """
         if series_dir is None:
             series_dir = self.latest_series
 
+        if self.series_cache is not None:
+            mtime = self._stat(series_dir)['mtime']
+            cached = self.series_cache.get(self.hostname, self.base_dir,
+                                           series_dir)
+            if cached is not None:
+                cached_mtime, series_info = cached
+                if cached_mtime != mtime:
+                    # Files were added, but everything we read from the
+                    # dicom stays the same; just recount them
+                    series_info["NumAcquisitions"] = len(
+                        self.list_dir(series_dir))
+                    self.series_cache.put(self.hostname, self.base_dir,
+                                          series_dir, mtime, series_info)
+                return series_info
+
         # Get a list of all the files for this series
         series_files = self.list_dir(series_dir)
 
@@ -240,7 +473,7 @@ class ScannerClient(object):
         # Build the dictionary based off the first DICOM in the list
         filename = series_files[0]
         dicom_path = op.join(series_dir, filename)
-        first_dicom = self.retrieve_dicom(dicom_path)
+        first_dicom = self.retrieve_dicom_header(dicom_path)
         dicom_timestamp = first_dicom.StudyDate + first_dicom.StudyTime
         n_timepoints = getattr(first_dicom, "NumberOfTemporalPositions", 1)
 
@@ -253,43 +486,483 @@ class ScannerClient(object):
             "NumAcquisitions": len(series_files)
         }
 
+        # The first file may still have been being written; only cache what
+        # we read from a header that has everything
+        complete = all(hasattr(first_dicom, field)
+                       for field in SERIES_INFO_FIELDS)
+        if self.series_cache is not None and complete:
+            self.series_cache.put(self.hostname, self.base_dir, series_dir,
+                                  mtime, series_info)
+
         return series_info
 
     def retrieve_file(self, filename):
         """Return a file as a cstring buffer."""
+        buf, nbytes = self._read_into(filename, bytearray(
+            self._size_hint(filename)))
 
+        # cStringIO wraps the bytearray without copying it
+        return cStringIO.StringIO(memoryview(buf)[:nbytes])
+
+    def _read_into(self, filename, buf):
+        """Read a file into the bytearray `buf`, growing it if needed.
+
+        Returns the buffer and the number of bytes read into it.
+        """
         if self.lock is not None: self.lock.acquire()
-        buf = cStringIO.StringIO()
+        nbytes = 0
 
         try:
             handle = self.sftp.open(filename, 'r', self.max_buf_size)
             while True:
-                # In practice, we will read all the data, but SFTP can be slow
-                # when we read into a buffer smaller than the file.
-                data = self.sftp.read(handle, self.max_buf_size)
+                # Ask for the rest of the buffer in one request; SFTP can be
+                # slow when we read in pieces smaller than the file.
+                data = self.sftp.read(handle,
+                                      max(len(buf) - nbytes, self.min_read))
                 if not data:
                     break
-                buf.write(data)
-            buf.seek(0)
+                buf[nbytes:nbytes + len(data)] = data
+                nbytes += len(data)
             self.sftp.close(handle)
         finally:
             if self.lock is not None: self.lock.release()
 
-        return buf
-
+        return buf, nbytes
 
+    def _size_hint(self, filename):
+        """Return the size of a file from its cached listing, or 0."""
+        dirname, name = op.split(filename)
+        entry = self._listing_cache.get(dirname)
+        if entry is None:
+            return 0
+        if "sizes" not in entry:
+            entry["sizes"] = dict((f['name'], f['size'])
+                                  for f in entry["files"])
+        return entry["sizes"].get(name, 0)
 
     def retrieve_dicom(self, filename):
         """Return a file as a dicom object."""
         try:
-            return pydicom.read_file(self.retrieve_file(filename), force=True)
-        except Exception as e:
-            raise(e, "Exception {} raised with {}, {}".format(
-                  (filename, type(e).__name__)))
+            return self._retrieve_dicom(filename)
+        except Exception:
+            logger.exception("Could not retrieve {}".format(filename))
+            raise
+
+    def _retrieve_dicom(self, filename):
+        """Read and parse a dicom file."""
+        if self.fast_decode and self.buffer_pool is None:
+            # Decoded slices keep a view on their buffer instead of a copy
+            # of their pixels, so each gets its own buffer
+            buf, nbytes = self._read_into(filename, bytearray(
+                self._size_hint(filename)))
+            fetched = time.time()
+            dcm = self._slice_decoder(filename).decode(buf, nbytes)
+            stamp(dcm, "fetched", fetched)
+            stamp(dcm, "parsed")
+            return dcm
+
+        if self.buffer_pool is None:
+            fobj = self.retrieve_file(filename)
+            fetched = time.time()
+            dcm = pydicom.read_file(fobj, force=True)
+            stamp(dcm, "fetched", fetched)
+            stamp(dcm, "parsed")
+            return dcm
+
+        # Read into a pooled buffer and parse straight out of it; the
+        # dataset holds its own copies of the values, so the buffer can
+        # go back to the pool once parsing is done.
+        buf = self.buffer_pool.acquire(self._size_hint(filename))
+        try:
+            buf, nbytes = self._read_into(filename, buf)
+            fetched = time.time()
+            if self.fast_decode:
+                # Copying the pixels out lets the buffer go back
+                dcm = self._slice_decoder(filename).decode(
+                    buf, nbytes, copy_pixels=True)
+            else:
+                fobj = cStringIO.StringIO(memoryview(buf)[:nbytes])
+                dcm = pydicom.read_file(fobj, force=True)
+            stamp(dcm, "fetched", fetched)
+            stamp(dcm, "parsed")
+            return dcm
+        finally:
+            self.buffer_pool.release(buf)
 
+    def retrieve_dicom_if_ready(self, filename):
+        """Return a file as a dicom object, or None if it isn't ready.
 
+        This is for files we expect to appear soon. A file that can't be
+        opened yet, or whose pixel data is still being written, gives None
+        instead of an error.
+        """
+        try:
+            dcm = self._retrieve_dicom(filename)
+        except libssh2.Error:
+            return None
+        except Exception:
+            # A file cut off part way through its header can fail to parse
+            # in any number of ways (struct.error, EOFError, ...)
+            logger.debug("Could not parse {} yet".format(filename),
+                         exc_info=True)
+            return None
 
+        try:
+            n_pixel_bytes = (dcm.Rows * dcm.Columns * dcm.BitsAllocated // 8
+                             * getattr(dcm, "SamplesPerPixel", 1))
+            if len(dcm.PixelData) < n_pixel_bytes:
+                return None
+        except (AttributeError, TypeError, ValueError):
+            # Missing or cut off values
+            return None
+        return dcm
+
+    def _slice_decoder(self, filename):
+        """Return the SliceDecoder for the series a file belongs to."""
+        series_dir = op.dirname(filename)
+        if self._decoder[0] != series_dir:
+            self._decoder = (series_dir, SliceDecoder())
+        return self._decoder[1]
+
+    def retrieve_dicom_header(self, filename, max_bytes=2 ** 14):
+        """Return a dicom object with everything but the pixel data.
+
+        Only the first `max_bytes` of the file are fetched at first. The
+        range is doubled until it reaches the pixel data element (or the
+        end of the file), so most headers cost a single small read.
+        """
+        if self.lock is not None: self.lock.acquire()
+        buf = bytearray()
+        at_eof = False
 
+        try:
+            handle = self.sftp.open(filename, 'r', self.max_buf_size)
+            while True:
+                while not at_eof and len(buf) < max_bytes:
+                    data = self.sftp.read(handle, max_bytes - len(buf))
+                    if not data:
+                        at_eof = True
+                    else:
+                        buf += data
+
+                header = self._parse_header(buf, at_eof)
+                if header is not None:
+                    break
+                max_bytes *= 2
+            self.sftp.close(handle)
+        finally:
+            if self.lock is not None: self.lock.release()
 
+        return header
 
+    def _parse_header(self, buf, complete):
+        """Parse the dicom header out of the start of a file.
 
+        Returns None if `buf` doesn't reach the pixel data yet. pydicom
+        parses a truncated file without complaint, so we only trust a
+        parse that stopped right at a pixel data tag; other matches of the
+        tag bytes (e.g. inside private binary elements) are skipped.
+        """
+        data = bytes(buf)
+        start = 0
+        while True:
+            offset = data.find(PIXEL_DATA_TAG, start)
+            # Tag, VR, reserved bytes and a 4 byte length
+            if offset < 0 or offset + 12 > len(data):
+                break
+            fobj = cStringIO.StringIO(memoryview(buf)[:offset + 12])
+            header = pydicom.read_file(fobj, force=True,
+                                       stop_before_pixels=True)
+            if fobj.tell() == offset:
+                return header
+            start = offset + 1
+
+        if complete:
+            return pydicom.read_file(cStringIO.StringIO(data), force=True,
+                                     stop_before_pixels=True)
+        return None
+
+    def watch_dir(self, remote_path, interval=0.5):
+        """Return a DirectoryWatcher streaming new files in `remote_path`.
+
+        The watcher runs `watch_command` over an SSH exec channel on its own
+        session, since a libssh2 session can't be shared between threads.
+        This raises if the server refuses to execute commands, in which
+        case callers should keep polling with list_dir. Every `interval`
+        seconds the remote command checks that the session is still there
+        and, without inotifywait, looks for new files.
+        """
+        client = ScannerClient(hostname=self.hostname, port=self.port,
+                               username=self.username,
+                               password=self.password,
+                               base_dir=self.base_dir,
+                               private_key=self.private_key,
+                               public_key=self.public_key,
+                               cache_listings=False)
+        command = self.watch_command.format(path=pipes.quote(remote_path),
+                                            interval=interval)
+        try:
+            channel = client.session.open_session()
+            channel.execute(command)
+        except Exception:
+            client.close()
+            raise
+
+        return DirectoryWatcher(client, channel, remote_path)
+
+    def retrieve_files(self, filenames):
+        """Generate (filename, buffer) pairs for a batch of files.
+
+        A single libssh2 session only has one blocking request in flight at
+        a time, so this streams the batch in order as each file lands.
+        ScannerClientPool.retrieve_files spreads a batch over all of its
+        sessions instead, optionally yielding files as they complete.
+        """
+        for filename in filenames:
+            yield filename, self.retrieve_file(filename)
+
+    def retrieve_dicoms(self, filenames):
+        """Generate (filename, dicom) pairs for a batch of files, in order."""
+        for filename in filenames:
+            yield filename, self.retrieve_dicom(filename)
+
+
+class DirectoryWatcher(object):
+    """Stream the names of new files in a remote directory.
+
+    Lines printed by the remote watch command are read on a background
+    thread and turned into full paths. Each name is only reported once.
+    The watcher doesn't guarantee that a reported file is completely
+    written; consumers should treat it as a hint and still reconcile
+    against list_dir.
+
+    The background thread is the only one to touch the watcher's session:
+    it reads without blocking so it can notice close(), and it closes the
+    channel and session itself.
+
+    """
+
+    def __init__(self, client, channel, remote_path, poll_interval=0.01):
+        self.client = client
+        self.channel = channel
+        self.remote_path = remote_path
+        self.poll_interval = poll_interval
+        self.queue = Queue()
+        self.seen = set()
+        self.stop_event = Event()
+
+        self.thread = Thread(target=self._read_lines)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def active(self):
+        return self.thread.is_alive()
+
+    def _read_lines(self):
+        """Read the channel until EOF or close(), queueing new paths."""
+        pending = ""
+        try:
+            self.channel.setblocking(0)
+            while not self.stop_event.is_set():
+                # None when nothing has come in yet, or at EOF
+                data = self.channel.read(4096)
+                if not data:
+                    if self.channel.eof():
+                        break
+                    self.stop_event.wait(self.poll_interval)
+                    continue
+                lines = (pending + data).split("\n")
+                pending = lines.pop()
+                for line in lines:
+                    name = op.basename(line.strip())
+                    # The find -newer fallback can list a file twice
+                    if name and name not in self.seen:
+                        self.seen.add(name)
+                        self.queue.put(op.join(self.remote_path, name))
+        finally:
+            try:
+                self.channel.setblocking(1)
+                self.channel.close()
+            finally:
+                self.client.close()
+
+    def new_files(self, timeout=None):
+        """Return the paths reported since the last call.
+
+        If `timeout` is given, wait up to that long for the first one.
+        """
+        files = []
+        try:
+            files.append(self.queue.get(block=timeout is not None,
+                                        timeout=timeout))
+            while True:
+                files.append(self.queue.get(block=False))
+        except Empty:
+            pass
+        return files
+
+    def close(self, timeout=5):
+        """Stop the remote watcher and drop its session."""
+        self.stop_event.set()
+        self.thread.join(timeout)
+
+
+class ScannerClientPool(object):
+    """A fixed-size pool of ScannerClient sessions.
+
+    Each client in the pool owns its own libssh2 session and its own lock,
+    so threads that check out different clients can talk to the scanner at
+    the same time instead of queueing behind one global mutex.
+
+    The pool can stand in for a single ScannerClient: any client method or
+    attribute accessed on the pool is run on a client that is checked out
+    for the duration of that one operation.
+
+    """
+
+    def __init__(self, n_clients=2, lock=None, **kwargs):
+        """Open `n_clients` sessions with the ScannerClient kwargs.
+
+        If the local libssh2 is linked against a libgcrypt that is not
+        thread-safe, pass a shared threading.Lock as `lock` to serialize
+        all sessions as before.
+        """
+        self.n_clients = n_clients
+        self.clients = []
+        self._available = Queue()
+
+        # Share one series info cache connection between the sessions
+        if isinstance(kwargs.get("series_cache"), basestring):
+            kwargs["series_cache"] = SeriesInfoCache(kwargs["series_cache"])
+
+        # and one listing cache, so the session that fetches a file knows
+        # its size from whichever one listed it (see _size_hint)
+        self._listing_cache = {}
+        kwargs["listing_cache"] = self._listing_cache
+
+        try:
+            for _ in range(n_clients):
+                client_lock = lock if lock is not None else Lock()
+                client = ScannerClient(lock=client_lock, **kwargs)
+                self.clients.append(client)
+                self._available.put(client)
+        except Exception:
+            # Don't leak the sessions that did open
+            self.close()
+            raise
+
+        self.base_dir = self.clients[0].base_dir
+
+    @contextlib.contextmanager
+    def checkout(self, timeout=None):
+        """Context manager that lends out a client for exclusive use."""
+        client = self._available.get(timeout=timeout)
+        try:
+            yield client
+        finally:
+            self._available.put(client)
+
+    def close(self):
+        """Close every session in the pool."""
+        for client in self.clients:
+            client.close()
+
+    def listing_cache_stats(self):
+        """Return listing cache hit and miss counts summed over the pool."""
+        stats = {"hits": 0, "misses": 0,
+                 "entries": len(self._listing_cache)}
+        for client in self.clients:
+            stats["hits"] += client.cache_hits
+            stats["misses"] += client.cache_misses
+        return stats
+
+    def clear_listing_cache(self):
+        """Forget the cached directory listings of the pool."""
+        self._listing_cache.clear()
+
+    def clear_index(self):
+        """Forget the indexed latest patient, exam and series everywhere."""
+        for client in self.clients:
+            client.clear_index()
+
+    def retrieve_files(self, filenames, ordered=True):
+        """Generate (filename, buffer) pairs, fetching over every session.
+
+        Up to `n_clients` requests are kept in flight at once. Results are
+        yielded in the order of `filenames` if `ordered`, otherwise as soon
+        as each one completes.
+        """
+        return self._retrieve_many("retrieve_file", filenames, ordered)
+
+    def retrieve_dicoms(self, filenames, ordered=True):
+        """Generate (filename, dicom) pairs, fetching over every session.
+
+        As for retrieve_files, results come in the order of `filenames`
+        if `ordered`, otherwise as soon as each one completes.
+        """
+        return self._retrieve_many("retrieve_dicom", filenames, ordered)
+
+    def _retrieve_many(self, method, filenames, ordered):
+        """Run a client retrieval method over a batch in worker threads."""
+        filenames = list(filenames)
+        todo = Queue()
+        for item in enumerate(filenames):
+            todo.put(item)
+        done = Queue()
+        cancel = Event()
+
+        def worker():
+            with self.checkout() as client:
+                retrieve = getattr(client, method)
+                while not cancel.is_set():
+                    try:
+                        i, filename = todo.get(block=False)
+                    except Empty:
+                        break
+                    try:
+                        done.put((i, filename, retrieve(filename), None))
+                    except Exception as e:
+                        done.put((i, filename, None, e))
+
+        for _ in range(min(self.n_clients, len(filenames))):
+            thread = Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+
+        # Hold on to out-of-order results until their turn comes up
+        pending = {}
+        next_index = 0
+        try:
+            for _ in range(len(filenames)):
+                i, filename, result, error = done.get()
+                if error is not None:
+                    raise error
+                if not ordered:
+                    yield filename, result
+                    continue
+                pending[i] = (filename, result)
+                while next_index in pending:
+                    yield pending.pop(next_index)
+                    next_index += 1
+        finally:
+            # Stop the workers if the caller bails out early
+            cancel.set()
+
+    def __getattr__(self, name):
+        # Only called for attributes the pool doesn't define itself;
+        # forward them to a checked-out client.
+        if name.startswith("__") or name in ("clients", "_available",
+                                             "_listing_cache"):
+            raise AttributeError(name)
+
+        if callable(getattr(ScannerClient, name, None)):
+            def pooled_call(*args, **kwargs):
+                with self.checkout() as client:
+                    return getattr(client, name)(*args, **kwargs)
+            pooled_call.__name__ = name
+            return pooled_call
+
+        # Plain attributes and properties (e.g. latest_exam)
+        with self.checkout() as client:
+            return getattr(client, name)
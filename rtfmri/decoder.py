@@ -0,0 +1,243 @@
+"""Fast decoding of the dicom slices of a series.
+
+Every slice of a GE EPI series has the same header layout, and only a
+handful of values (UIDs, times, positions, the pixels) change from slice
+to slice. SliceDecoder parses the first slice of a series with pydicom and
+remembers where those values sit in the file. Later slices are checked
+against that layout and only their changing values are read; everything
+else is shared with the first slice. Anything that doesn't fit the layout
+is parsed by pydicom as before.
+"""
+from __future__ import print_function, division
+import cStringIO
+from struct import unpack
+
+import pydicom
+from pydicom.dataelem import DataElement_from_raw, RawDataElement
+from pydicom.dataset import Dataset, FileDataset
+from pydicom.filereader import read_dataset
+from pydicom.tag import Tag
+
+
+PIXEL_DATA = Tag(0x7fe0, 0x0010)
+SAMPLES_PER_PIXEL = Tag(0x0028, 0x0002)
+ROWS = Tag(0x0028, 0x0010)
+COLUMNS = Tag(0x0028, 0x0011)
+BITS_ALLOCATED = Tag(0x0028, 0x0100)
+
+# Explicit VRs that are followed by two reserved bytes and a 4 byte length
+LONG_VRS = set(["OB", "OD", "OF", "OL", "OV", "OW", "SQ", "UC", "UN",
+                "UR", "UT"])
+
+UNDEFINED_LENGTH = 0xffffffff
+
+
+class SliceDecoder(object):
+    """Decode the dicom slices of one series.
+
+    The first complete slice is parsed in full and becomes the template;
+    slices whose pixel data is cut short (e.g. still being written) are
+    parsed with pydicom and otherwise ignored. A slice
+    matches the template when it only differs from it in the values of the
+    elements known to change between slices; those values may change
+    length. Matching slices are decoded without pydicom's element parser,
+    and their PixelData is a view on the file buffer rather than a copy,
+    so the buffer must not be reused while the dataset is alive.
+
+    When a slice doesn't match, it is parsed with pydicom. If it has the
+    same elements as the template, the ones whose values differ are added
+    to the changing set so the following slices take the fast path.
+
+    With `copy_pixels`, the PixelData of matching slices is copied out of
+    the buffer instead, so the buffer can be reused (e.g. from a
+    BufferPool) as soon as decode returns.
+
+    """
+
+    def __init__(self):
+        self.template = None
+        self.n_fast = 0
+        self.n_full = 0
+
+    def decode(self, buf, nbytes, copy_pixels=False):
+        """Return the dicom in the first `nbytes` of bytearray `buf`."""
+        view = memoryview(buf)[:nbytes]
+
+        if self.template is not None:
+            dcm = self.template.decode(buf, view, copy_pixels)
+            if dcm is not None:
+                self.n_fast += 1
+                return dcm
+
+        self.n_full += 1
+        dcm = pydicom.read_file(cStringIO.StringIO(view), force=True)
+
+        if not _has_all_pixels(dcm):
+            return dcm
+        if self.template is None:
+            self.template = _Template(view.tobytes(), dcm)
+        else:
+            self.template.learn(view.tobytes(), dcm)
+        return dcm
+
+
+class _Template(object):
+    """Layout of a template slice and the elements that change per slice."""
+
+    def __init__(self, data, dcm):
+        self.data = data
+        self.preamble = dcm.preamble
+        self.is_implicit_VR = dcm.is_implicit_VR
+        self.is_little_endian = dcm.is_little_endian
+
+        # Grab the elements before anything converts them; unconverted
+        # elements are immutable and can be shared between slices.
+        self.meta_elements = _raw_meta_elements(data, dcm)
+        self.elements = _raw_elements(dcm)
+
+        self.changing = set()
+        if PIXEL_DATA in self.elements:
+            self.changing.add(PIXEL_DATA)
+        self._build_regions()
+
+    def learn(self, data, dcm):
+        """Mark the elements in which `dcm` differs from the template."""
+        meta_elements = _raw_meta_elements(data, dcm)
+        elements = _raw_elements(dcm)
+        if (set(meta_elements) != set(self.meta_elements)
+                or set(elements) != set(self.elements)):
+            return
+
+        for ours, theirs in [(self.meta_elements, meta_elements),
+                             (self.elements, elements)]:
+            for tag, elem in ours.items():
+                other = theirs[tag]
+                if (_is_fixed(elem) and _is_fixed(other)
+                        and elem.value != other.value):
+                    self.changing.add(tag)
+        self._build_regions()
+
+    def _build_regions(self):
+        """Find where each changing element's length and value sit.
+
+        Each region is (start, end, length format, element), where start
+        is the offset of the length field and end the end of the value in
+        the template data.
+        """
+        regions = []
+        for elements in [self.meta_elements, self.elements]:
+            for tag in self.changing.intersection(elements):
+                elem = elements[tag]
+                if not _is_fixed(elem):
+                    continue
+                if elem.is_implicit_VR or elem.VR in LONG_VRS:
+                    fmt = "I"
+                else:
+                    fmt = "H"
+                fmt = ("<" if elem.is_little_endian else ">") + fmt
+                start = elem.value_tell - (4 if fmt[1] == "I" else 2)
+                regions.append((start, elem.value_tell + elem.length,
+                                fmt, elem))
+        self.regions = sorted(regions, key=lambda r: r[0])
+
+    def decode(self, buf, view, copy_pixels=False):
+        """Return a dataset for `view` of `buf` if it matches, else None."""
+        data = memoryview(self.data)
+        changed = {}
+        pos = 0
+        tpos = 0
+
+        for start, end, fmt, elem in self.regions:
+            # Everything between two changing values must be identical
+            span = start - tpos
+            if view[pos:pos + span] != data[tpos:start]:
+                return None
+            pos += span
+
+            size = 4 if fmt[1] == "I" else 2
+            if pos + size > len(view):
+                return None
+            length, = unpack(fmt, view[pos:pos + size].tobytes())
+            pos += size
+            if length == UNDEFINED_LENGTH or pos + length > len(view):
+                return None
+
+            if elem.tag == PIXEL_DATA and not copy_pixels:
+                # numpy can't read from a memoryview in Python 2
+                value = buffer(buf, pos, length)
+            else:
+                value = view[pos:pos + length].tobytes()
+            changed[elem.tag] = elem._replace(length=length, value=value,
+                                              value_tell=pos)
+            pos += length
+            tpos = end
+
+        if view[pos:] != data[tpos:]:
+            return None
+
+        return self._dataset(changed)
+
+    def _dataset(self, changed):
+        """Build a dataset from the template and the changed elements."""
+        meta_elements = dict(self.meta_elements)
+        elements = dict(self.elements)
+        for tag, elem in changed.items():
+            if tag in elements:
+                elements[tag] = elem
+            else:
+                meta_elements[tag] = elem
+
+        return FileDataset(None, Dataset(elements), self.preamble,
+                           Dataset(meta_elements), self.is_implicit_VR,
+                           self.is_little_endian)
+
+
+def _raw_elements(dataset):
+    """Return {tag: element} for the top level of a dataset."""
+    return dict((tag, dataset.get_item(tag)) for tag in dataset.keys())
+
+
+def _raw_meta_elements(data, dcm):
+    """Return {tag: element} for the file meta group of a dicom file.
+
+    pydicom converts some of the file meta elements as it reads them, so
+    we read the group again from the file data.
+    """
+    if not len(dcm.file_meta):
+        return {}
+    fobj = cStringIO.StringIO(data)
+    # The file meta group follows the preamble and "DICM" when there is one
+    fobj.seek(0 if dcm.preamble is None else 132)
+    meta = read_dataset(fobj, is_implicit_VR=False, is_little_endian=True,
+                        stop_when=lambda tag, VR, length: tag.group != 2)
+    return _raw_elements(meta)
+
+
+def _has_all_pixels(dcm):
+    """Whether a dataset holds all of the pixel data its header calls for.
+
+    The values are read without converting the dataset's elements, which
+    the template keeps unconverted.
+    """
+    def value(tag, default=None):
+        elem = dcm.get_item(tag)
+        if elem is None:
+            return default
+        if isinstance(elem, RawDataElement):
+            elem = DataElement_from_raw(elem)
+        return elem.value
+
+    try:
+        n_bytes = (value(ROWS) * value(COLUMNS) * value(BITS_ALLOCATED) // 8
+                   * value(SAMPLES_PER_PIXEL, 1))
+        return len(value(PIXEL_DATA)) >= n_bytes
+    except (TypeError, ValueError):
+        # Missing or cut off values
+        return False
+
+
+def _is_fixed(elem):
+    """Whether an element is unconverted and has a defined length."""
+    return (isinstance(elem, RawDataElement)
+            and elem.value is not None
+            and elem.length != UNDEFINED_LENGTH)
@@ -16,11 +16,13 @@ class SessionFetcher(object):
        series, which will be saved to @outfile"""
 
     def __init__(self, hostname="cnimr", port=22, username="", password="",
-                 base_dir="/export/home1/sdc_image_pool/images", outfile=None):
+                 base_dir="/export/home1/sdc_image_pool/images", outfile=None,
+                 series_cache=None):
 
         self.client = ScannerClient(hostname=hostname, username=username,
                                     password=password, port=port,
-                                    base_dir=base_dir)
+                                    base_dir=base_dir,
+                                    series_cache=series_cache)
         self.outfile = outfile
         self.meta = None
 
@@ -83,7 +85,7 @@ class SessionFetcher(object):
         we assume src_paths is in alphanum order...
         """
 
-        dcm = self.client.retrieve_dicom(src_paths[0])
+        dcm = self.client.retrieve_dicom_header(src_paths[0])
         try:
             slices_per_volume = int(dcm[(0x0021, 0x104f)].value)
             ts = True
@@ -2,12 +2,17 @@
 import sys, os, time
 import signal
 import socket
-from Queue import Queue
+import traceback
+import multiprocessing
 from threading import Lock
+from Queue import Empty
 
+import nibabel as nib
 
-from .client import ScannerClient
-from .queuemanagers import SeriesFinder, DicomFinder, Volumizer
+from .buffers import BoundedQueue, SharedVolumeRing
+from .client import ScannerClientPool
+from .queuemanagers import SeriesFinder, DicomFinder, Volumizer, VolumeBus
+from .timing import LatencyTracker, stamp
 
 
 class ScannerInterface(object):
@@ -23,33 +28,50 @@ class ScannerInterface(object):
     """
     def __init__(self, hostname='localhost', username='', password='',
                  port=2124, base_dir='.', private_key=None, public_key=None,
-                 use_series_finder=True):
+                 use_series_finder=True, n_clients=2, shared_lock=False,
+                 use_watcher=False, series_cache=None, n_fetchers=0,
+                 prefetch=False, adaptive_polling=False, queue_limits=None):
         """Initialize the interface object.
 
         The positional and keyword arguments are passed through
-        to the underlying scanner client objects.
+        to the underlying scanner client objects. `n_clients` sets how
+        many SFTP sessions are kept in the client pool; `shared_lock`
+        serializes them behind one mutex (only needed if libssh2 is
+        built against a libgcrypt that is not thread-safe).
+        `use_watcher` makes the dicom finder discover new files through
+        a watcher process on the scanner rather than by polling.
+        `series_cache` is the path of an SQLite file used to cache
+        series information across sessions (see SeriesInfoCache).
+        `n_fetchers` runs that many threads downloading dicoms apart from
+        the one discovering them (see DicomFetcher). `prefetch` makes the
+        dicom finder ask for the slices it expects next before they show
+        up in a listing. `adaptive_polling` makes it poll the scanner
+        less often between volumes (see PollSchedule).
+        `queue_limits` maps "series", "dicom" and "volume" to a
+        (maxsize, policy) pair bounding the queue between those stages
+        (see BoundedQueue); queues not listed are unbounded. Dropping
+        policies are meant for the volume queue, since a dicom queue that
+        drops slices can't complete its volumes.
 
         """
-        # Keep two different FTP clients for the series and
-        # volume queues so they don't interfere with each other
+        # Keep a pool of SFTP sessions shared by the series and dicom
+        # finders; each operation checks out its own session so directory
+        # polling does not block slice downloads.
 
         #Track if we've started to avoid joining unstarted threads
         self.alive = False
         self.use_series_finder = use_series_finder
-        self.mutex = Lock()
+        self.mutex = Lock() if shared_lock else None
 
         try:
-            client1 = ScannerClient(hostname=hostname, username=username,
-                                 password=password, port=port,
-                                 base_dir=base_dir, private_key=private_key,
-                                 public_key=public_key, lock = self.mutex)
-
-            client2 = ScannerClient(hostname=hostname, username=username,
-                                 password=password, port=port,
-                                 base_dir=base_dir, private_key=private_key,
-                                 public_key=public_key, lock = self.mutex)
+            self.client_pool = ScannerClientPool(
+                n_clients=n_clients, lock=self.mutex,
+                hostname=hostname, username=username,
+                password=password, port=port,
+                base_dir=base_dir, private_key=private_key,
+                public_key=public_key, series_cache=series_cache)
             try:
-                client1.latest_exam
+                self.client_pool.latest_exam
                 self.has_sftp_connection = True
                 print("SFTP connection established successfully.")
             except Exception:
@@ -61,23 +83,44 @@ class ScannerInterface(object):
             raise(socket.error, "Login failed")
 
         # Initialize the queue objects
-        series_q = Queue()
-        dicom_q = Queue()
-        volume_q = Queue()
+        queue_limits = queue_limits or {}
+        self.queues = {}
+        for name in ["series", "dicom", "volume"]:
+            maxsize, policy = queue_limits.get(name, (0, "block"))
+            self.queues[name] = BoundedQueue(maxsize, policy)
+        series_q = self.queues["series"]
+        dicom_q = self.queues["dicom"]
+        volume_q = self.queues["volume"]
 
         # Initialize the queue manager threads
         if self.use_series_finder:
-            self.series_finder = SeriesFinder(client1, series_q, interval=1)
-
-        self.dicom_finder = DicomFinder(client2, series_q, dicom_q, interval=0.05)
+            self.series_finder = SeriesFinder(self.client_pool, series_q,
+                                              interval=1)
+
+        self.dicom_finder = DicomFinder(self.client_pool, series_q, dicom_q,
+                                        interval=0.05,
+                                        use_watcher=use_watcher,
+                                        n_fetchers=n_fetchers,
+                                        prefetch=prefetch,
+                                        adaptive_polling=adaptive_polling)
         self.volumizer = Volumizer(dicom_q, volume_q, interval=0.05)
 
+        # Per-volume latency records (see rtfmri.timing)
+        self.latency = LatencyTracker()
+
+        # Hands volumes to each subscriber once anything subscribes
+        self.bus = VolumeBus(volume_q, interval=0.05, latency=self.latency)
+
+        # New series wake the dicom finder instead of waiting for its
+        # next poll
+        if self.use_series_finder:
+            self.series_finder.listeners.append(self.dicom_finder)
+
     def use_newest_exam_series(self, predict=False):
 
         client = self.dicom_finder.client
-        latest_patient = client._latest_entry(client.base_dir, sort='mtime')
-        latest_exam = client._latest_entry(latest_patient)
-        newest_series = client._latest_entry(latest_exam)
+        client.clear_index()
+        newest_series = client.latest_series
         if predict:
             #add one to the current series number and use that
             path, file = os.path.split(newest_series)
@@ -90,6 +133,7 @@ class ScannerInterface(object):
         with self.dicom_finder.series_q.mutex:
             self.dicom_finder.series_q.queue.clear()
         self.dicom_finder.series_q.put(series)
+        self.dicom_finder.wake()
         print("Using series %s for the session only." % series)
 
     def set_dicom_filter(self, dcmf):
@@ -103,11 +147,65 @@ class ScannerInterface(object):
             self.series_finder.start()
         self.dicom_finder.start()
         self.volumizer.start()
+        if self.bus.subscribers:
+            self.bus.start()
         print("Interface initialized")
 
+    def subscribe(self, name, maxsize=0, policy="block"):
+        """Return a VolumeSubscription getting every volume from now on.
+
+        Once anything subscribes, volumes go to the subscribers and
+        get_volume raises, so several analyzers can run side by side, each
+        taking its subscription as the scanner it gets volumes from. That
+        stays so after the last subscriber leaves: the bus keeps taking
+        volumes off the volume queue, and drops them while nobody is
+        subscribed.
+        `maxsize` and `policy` set up the subscriber's queue (see
+        BoundedQueue and VolumeBus).
+        """
+        self.bus.subscribe(name, maxsize, policy)
+        if self.alive and self.bus.ident is None:
+            self.bus.start()
+        return VolumeSubscription(self, name)
+
+    def unsubscribe(self, name):
+        self.bus.unsubscribe(name)
+
     def get_volume(self, *args, **kwargs):
         """Semantic wrapper for pulling a volume off the volume queue."""
-        return self.volumizer.volume_q.get(*args, **kwargs)
+        if self.bus.subscribers or self.bus.ident is not None:
+            raise RuntimeError("Volumes go to the subscribers once anything "
+                               "has subscribed; use a subscription's "
+                               "get_volume")
+        volume = self.volumizer.volume_q.get(*args, **kwargs)
+        stamp(volume, "delivered")
+        self.latency.record(volume["timing"])
+        for name, q in self.queues.items():
+            self.latency.gauge(name + "_q", q.qsize())
+        return volume
+
+    def volume_done(self, volume):
+        """Record that an analyzer has finished with a volume."""
+        stamp(volume, "analyzed")
+        self.latency.record(volume["timing"], events=["analyzed"])
+
+    def queue_stats(self):
+        """Return the size and drop counts of the queues between stages."""
+        return dict((name, q.stats()) for name, q in self.queues.items())
+
+    def latency_stats(self):
+        """Return summary statistics of the per-volume latency records.
+
+        "stages" maps each step between two pipeline events (e.g.
+        "fetched->parsed") and the end-to-end "total->..." times to
+        {n, mean, p50, p90, p99, max} in seconds; "gauges" has the depth
+        of each queue as seen when volumes were delivered.
+        """
+        return self.latency.summary()
+
+    def bus_stats(self):
+        """Return the queue stats and lag of each subscriber (see VolumeBus)."""
+        return self.bus.stats()
 
     def shutdown(self):
         """Halt and join the threads so we can exit cleanly."""
@@ -116,12 +214,165 @@ class ScannerInterface(object):
             if self.use_series_finder:
                 self.series_finder.halt()
             self.dicom_finder.halt()
+            self.bus.halt()
 
             self.volumizer.join()
             if self.use_series_finder:
                 self.series_finder.join()
             self.dicom_finder.join()
+            if self.bus.ident is not None:
+                self.bus.join()
+
+            self.alive = False
+
+    def __del__(self):
+
+        self.shutdown()
+
+
+class VolumeSubscription(object):
+    """One subscriber's view of a ScannerInterface's volumes.
+
+    It has the get_volume and volume_done methods analyzers use, so it can
+    be handed to one in place of the interface. The delivered and analyzed
+    stages of its volumes are recorded in the interface's latency stats
+    under the subscriber's name, e.g. "motion:assembled->delivered".
+
+    """
+    def __init__(self, interface, name):
+
+        self.interface = interface
+        self.name = name
+
+    def get_volume(self, block=True, timeout=None):
+        """Pull the next volume off this subscriber's queue."""
+        volume = self.interface.bus.get(self.name, block, timeout)
+        stamp(volume, "delivered")
+        self.interface.latency.record(volume["timing"], events=["delivered"],
+                                      prefix=self.name + ":")
+        return volume
+
+    def volume_done(self, volume):
+        """Record that the subscriber has finished with a volume."""
+        stamp(volume, "analyzed")
+        self.interface.latency.record(volume["timing"], events=["analyzed"],
+                                      prefix=self.name + ":")
+
+    def stats(self):
+        """Return the queue stats and lag of this subscriber."""
+        return self.interface.bus_stats()[self.name]
+
+
+class ProcessScannerInterface(object):
+    """ScannerInterface that gets volumes off the scanner in another process.
+
+    The series finder, dicom finder and volumizer, i.e. the SFTP
+    transfers, dicom parsing and volume assembly, run in a child process
+    with their own interpreter, so they don't compete with the analysis
+    in this process for the GIL. Volume data comes back through shared
+    memory (see SharedVolumeRing); only the volume's metadata, affine and
+    header go through the queue.
+
+    The keyword arguments are passed to the ScannerInterface created in
+    the child process. `n_slots` and `slot_bytes` size the shared memory;
+    a slot must fit one volume. If the child process can't connect to
+    the scanner, or fails later on, get_volume raises a RuntimeError with
+    its traceback.
+
+    """
+    def __init__(self, n_slots=4, slot_bytes=2 ** 23, **kwargs):
 
+        self.alive = False
+        self.kwargs = kwargs
+        self.ring = SharedVolumeRing(n_slots, slot_bytes)
+        self.volume_q = multiprocessing.Queue()
+        self.control_q = multiprocessing.Queue()
+        self.halt_event = multiprocessing.Event()
+        self.process = multiprocessing.Process(
+            target=run_acquisition,
+            args=(kwargs, self.ring, self.volume_q, self.control_q,
+                  self.halt_event))
+        self.process.daemon = True
+        self.latency = LatencyTracker()
+
+    def use_newest_exam_series(self, predict=False):
+        self.control_q.put(("use_newest_exam_series", (predict,)))
+
+    def use_series(self, series):
+        self.control_q.put(("use_series", (series,)))
+
+    def set_dicom_filter(self, dcmf):
+        """Filter the dicoms like `dcmf`, a DicomFilter, would.
+
+        A DicomFilter can't be sent to another process, so an unfitted one
+        is made there from the mask, center and radius of its masker. It
+        is fitted in that process: `dcmf` itself is left as it is.
+        """
+        if dcmf.fitted:
+            raise ValueError("Can only forward a DicomFilter before it "
+                             "is fitted")
+        masker = dcmf.masker
+        if not isinstance(masker.mask_img, basestring):
+            raise ValueError("The DicomFilter's mask must be a file to "
+                             "forward it to the acquisition process")
+        self.control_q.put(("set_dicom_filter",
+                            (masker.mask_img, masker.center, masker.radius)))
+
+    def start(self):
+        """Start the acquisition process."""
+        self.alive = True
+        self.process.start()
+
+    def get_volume(self, block=True, timeout=None):
+        """Pull the next volume out of the acquisition process."""
+        volume = self._get(block, timeout)
+        if "error" in volume:
+            raise RuntimeError("The acquisition process failed:\n"
+                               + volume["error"])
+        image = volume["image"]
+        data = self.ring.get(image["data"])
+        volume["image"] = nib.Nifti1Image(data, image["affine"],
+                                          image["header"])
+        stamp(volume, "delivered")
+        self.latency.record(volume["timing"])
+        return volume
+
+    def _get(self, block, timeout):
+        """Get off the volume queue, checking the process is still there."""
+        if not block:
+            return self.volume_q.get(False)
+
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            wait = 0.5
+            if deadline is not None:
+                wait = min(wait, max(deadline - time.time(), 0))
+            try:
+                return self.volume_q.get(True, wait)
+            except Empty:
+                if not self.process.is_alive():
+                    raise RuntimeError("The acquisition process exited "
+                                       "with code {}"
+                                       .format(self.process.exitcode))
+                if deadline is not None and time.time() >= deadline:
+                    raise
+
+    def volume_done(self, volume):
+        """Record that an analyzer has finished with a volume."""
+        stamp(volume, "analyzed")
+        self.latency.record(volume["timing"], events=["analyzed"])
+
+    def latency_stats(self):
+        """Return summary statistics of the per-volume latency records."""
+        return self.latency.summary()
+
+    def shutdown(self):
+        """Stop the acquisition process so we can exit cleanly."""
+        if self.alive:
+            self.halt_event.set()
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
             self.alive = False
 
     def __del__(self):
@@ -129,6 +380,58 @@ class ScannerInterface(object):
         self.shutdown()
 
 
+def run_acquisition(kwargs, ring, volume_q, control_q, halt_event):
+    """Run a ScannerInterface and send its volumes through `ring`.
+
+    Errors, including failing to connect, are sent back on `volume_q`
+    as {"error": traceback} so get_volume can raise them.
+    """
+    scanner = None
+    try:
+        scanner = ScannerInterface(**kwargs)
+        scanner.start()
+        while not halt_event.is_set():
+            # Run the calls forwarded from the other process
+            try:
+                while True:
+                    method, args = control_q.get_nowait()
+                    if method == "set_dicom_filter":
+                        args = (_make_dicom_filter(*args),)
+                    getattr(scanner, method)(*args)
+            except Empty:
+                pass
+
+            try:
+                volume = scanner.get_volume(timeout=0.05)
+            except Empty:
+                continue
+
+            image = volume["image"]
+            descriptor = None
+            while descriptor is None and not halt_event.is_set():
+                try:
+                    descriptor = ring.put(image.dataobj, timeout=0.1)
+                except Empty:
+                    # The other process hasn't freed a slot yet
+                    pass
+            if descriptor is None:
+                break
+            volume["image"] = dict(data=descriptor, affine=image.affine,
+                                   header=image.header)
+            volume_q.put(volume)
+    except Exception:
+        volume_q.put(dict(error=traceback.format_exc()))
+    finally:
+        if scanner is not None:
+            scanner.shutdown()
+
+
+def _make_dicom_filter(mask_img, center, radius):
+    """Make a DicomFilter in the acquisition process."""
+    from .masker import Masker, DicomFilter
+    return DicomFilter(Masker(mask_img, center, radius))
+
+
 def setup_exit_handler(scanner, analyzer):
     """Method that will let us ctrl-c the object and kill threads."""
     def exit(signum, stack):
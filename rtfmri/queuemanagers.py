@@ -3,21 +3,32 @@ from __future__ import print_function, division
 
 import time
 import os
+import re
 import pdb
 from threading import Thread, Event, Lock
-from Queue import Empty
+from contextlib import closing
+from collections import OrderedDict
+from Queue import Queue, Empty, Full
 import logging
 
 import numpy as np
+import nibabel as nib
 from dcmstack import DicomStack
 from dcmstack.extract import default_extractor
 
+from .buffers import BoundedQueue, SliceBuffer, VolumeStore
+from .timing import EVENTS, LatencyTracker, stamp, volume_timing
+
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 logger.setLevel(logging.WARNING)
 logging.basicConfig(format='%(asctime)s %(message)s')
 
+# Splits a dicom filename around its last number (the instance number in
+# GE names like MR.1.2.840.113619.2.283.4120.7575399.15401.1363019204.11.dcm)
+NUMBERED_NAME = re.compile(r"^(.*?)(\d+)(\D*)$")
+
 def time_it(tic, message, level='debug'):
     """Logging conveninece Function. Message should describe the timed event."""
     toc = time.time()
@@ -41,9 +52,46 @@ class Finder(Thread):
         self.daemon = True
         self.stop_event = Event()
 
+        # Set to cut a wait short, e.g. when an upstream stage has
+        # produced something for us
+        self.wakeup = Event()
+        self.listeners = []
+
     def halt(self):
         """Make it so the thread will halt within a run method."""
         self.stop_event.set()
+        self.wakeup.set()
+
+    def wake(self):
+        """Cut short the current or next wait of this thread."""
+        self.wakeup.set()
+
+    def wait(self, timeout=None):
+        """Sleep for `timeout` seconds (the interval by default) or until
+        woken up."""
+        if timeout is None:
+            timeout = self.interval
+        self.wakeup.wait(timeout)
+        self.wakeup.clear()
+
+    def put(self, queue, item):
+        """Put an item on a downstream queue, waiting while it is full.
+
+        Bounded queues (see BoundedQueue) push back on us here. Returns
+        False if the thread was halted before the item could be queued.
+        """
+        while True:
+            try:
+                queue.put(item, timeout=self.interval)
+                return True
+            except Full:
+                if not self.is_alive:
+                    return False
+
+    def notify_listeners(self):
+        """Wake up the threads waiting on output from this one."""
+        for listener in self.listeners:
+            listener.wake()
 
     @property
     def is_alive(self):
@@ -103,8 +151,9 @@ class SeriesFinder(Finder):
                     if latest_info["NumTimepoints"] > 6:
                         logger.debug(("Series appears to be 4D; "
                                       "adding to series queue"))
-                        self.queue.put(series, timeout=self.interval)
-                        self.nqueued += 1
+                        if self.put(self.queue, series):
+                            self.nqueued += 1
+                        self.notify_listeners()
 
                 self.current_series = series
             else:
@@ -126,10 +175,11 @@ class SeriesFinder(Finder):
                     if latest_info["NumTimepoints"] > 1:
                         logger.debug(("Series appears to be 4D; "
                                       "adding to series queue"))
-                        self.queue.put(latest_series, timeout=self.interval)
-                        self.nqueued += 1
+                        if self.put(self.queue, latest_series):
+                            self.nqueued += 1
+                        self.notify_listeners()
 
-            time.sleep(self.interval)
+            self.wait()
 
 
 class DicomFinder(Finder):
@@ -148,8 +198,37 @@ class DicomFinder(Finder):
 
     """
 
-    def __init__(self, client, series_q, dicom_q, interval=0.05):
-        """Initialize the queue."""
+    def __init__(self, client, series_q, dicom_q, interval=0.05,
+                 use_watcher=False, reconcile_interval=1., n_fetchers=0,
+                 prefetch=False, prefetch_depth=8, prefetch_timeout=0.05,
+                 adaptive_polling=False, max_interval=1.):
+        """Initialize the queue.
+
+        With `use_watcher`, new files are discovered through a watcher
+        running on the scanner (see ScannerClient.watch_dir) instead of
+        by listing the series directory on every iteration. A full
+        listing is still made every `reconcile_interval` seconds, and
+        polling takes over if the watcher can't be started or dies.
+
+        With `n_fetchers`, this thread only discovers files and hands
+        them to that many DicomFetcher threads, which download them
+        concurrently with clients checked out of `client`; it must then
+        be a ScannerClientPool.
+
+        With `prefetch`, the finder learns how the slices of a series are
+        numbered and asks for the next `prefetch_depth` expected files
+        directly, retrying each for up to `prefetch_timeout` seconds, so
+        slices are fetched as soon as they are written rather than after
+        the next listing. Retries are only made while the poll schedule
+        expects slices (see PollSchedule.expecting).
+
+        With `adaptive_polling`, the time between polls follows the
+        repetition time of the scan (see PollSchedule): `interval` while
+        a volume is due and up to `max_interval` in between.
+        """
+        if n_fetchers and not hasattr(client, "checkout"):
+            raise ValueError("Fetch workers need a ScannerClientPool")
+
         super(DicomFinder, self).__init__(interval)
 
         # Referneces to the external objects we need to talk to
@@ -166,29 +245,70 @@ class DicomFinder(Finder):
         # the queue). We use a set because the relevant operations are
         # quite a bit faster than they would be with lists.
         self.dicom_files = set()
+        # When each file was first seen, for the latency records
+        self.discovery_times = {}
 
         # keep track of dicoms queued for timing evaluation.
         self.nqueued = 0
         self.dicom_filter = None
 
+        # Headers fetched to fit the dicom filter, by filename
+        self.filter_headers = OrderedDict()
+
+        # Optional push-based discovery
+        self.use_watcher = use_watcher
+        self.reconcile_interval = reconcile_interval
+        self.watcher = None
+        self.last_listing_time = 0
+
+        # Optional fetch workers, fed through fetch_q
+        self.fetch_q = Queue()
+        self.queue_lock = Lock()
+        self.fetchers = [DicomFetcher(self, interval)
+                         for _ in range(n_fetchers)]
+
+        # Optional prefetching of the files we expect next
+        self.prefetch = prefetch
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_timeout = prefetch_timeout
+        self.prefetch_retry = 0.005
+        self.name_pattern = None
+        self.nprefetched = 0
+
+        # Optional TR-aware polling
+        self.adaptive_polling = adaptive_polling
+        self.schedule = PollSchedule(interval, max_interval)
+
+    def halt(self):
+        """Halt this thread and its fetch workers."""
+        super(DicomFinder, self).halt()
+        for fetcher in self.fetchers:
+            fetcher.halt()
+
     #@profile
     def run(self):
         """This function gets looped over repeatedly while thread is alive."""
         # Keep track of when we last grabbed a dicom so that if dicoms stop
         # appearing we can kill the thread.
         self.last_dicom_time = time.time()
+        for fetcher in self.fetchers:
+            fetcher.start()
+
         while self.is_alive:
 
             tic = time.time()
+            prefetched = False
             if self.current_series is not None:
                 # Find all the dicom files in this series
-                series_files = self.client.series_files(self.current_series)
+                series_files, reported = self._discover_files()
+                discovered = time.time()
                 time_it(tic, "DicomSeries: Grabbed the series dicoms ")
                 tic = time.time()
                 # Compare against the set of files we've already placed
                 # in the queue, keep only the new ones
                 new_files = [f for f in series_files
                              if f not in self.dicom_files]
+                self._learn_names(new_files)
 
                 if not new_files:
                     if time.time() - self.last_dicom_time > 5:
@@ -204,41 +324,35 @@ class DicomFinder(Finder):
                     logger.debug(("Putting {:d} files into dicom queue"
                                   .format(len(new_files))))
 
-                # Place each new file onto the queue
-                filtered_files = set(new_files)
-
+                # Update the set of files on the queue (before fetching,
+                # so fetch workers can take back files they failed on)
+                self.dicom_files.update(set(new_files))
                 for fname in new_files:
-                    # do not fetch unwanted files if using a dicom filter.
-                    if fname not in filtered_files:
-                        continue
-
-                    if not self.is_alive:
-                        break
-
-
-                    dcm = self.client.retrieve_dicom(fname)
-                    self.last_dicom_time = time.time()
+                    self.discovery_times[fname] = discovered
+
+                # Place each new file onto the queue. While a dicom filter
+                # is still being fitted we only fetch headers, so we never
+                # pull slices it rules out; otherwise the whole batch is
+                # fetched over the client's sessions at once, or handed to
+                # the fetch workers.
+                if (self.dicom_filter is not None
+                        and not self.dicom_filter.fitted):
+                    retrieved = self._retrieve_while_fitting(new_files)
+                else:
+                    retrieved = self._fetch(new_files, if_ready=reported)
 
-                    if self.dicom_filter is not None and not self.dicom_filter.fitted:
-                        # then we're collecting first volume to setup filter
-                        logger.debug("Updating dicom filter...")
-                        volume_number = int(dcm[(0x0020, 0x0100)].value)
-                        with self.dicom_filter.lock:
-                            self.dicom_filter.update(fname, dcm)
+                with closing(retrieved):
+                    for fname, dcm in retrieved:
+                        if not self.is_alive:
+                            break
 
-                        if self.dicom_filter.fitted:
-                            logger.info("Dicom filter ready.")
-                            filtered_files = self.dicom_filter.filter(
-                                new_files)
-                            # print(filtered_files)
+                        self._queue_dicom(dcm, fname)
+                        time_it(tic, "Dicom series: Retrieved a dicom ")
+                        tic = time.time()
 
-                    self.dicom_q.put(dcm, timeout=self.interval)
-                    self.nqueued += 1
-                    time_it(tic, "Dicom series: Retrieved a dicom ")
-                    tic = time.time()
-
-                # Update the set of files on the queue
-                self.dicom_files.update(set(new_files))
+                # Try to grab the next slices as soon as they are written
+                if self.prefetch:
+                    prefetched = self._prefetch()
 
             if not self.series_q.empty():
                 # Grab the next series path off the queue
@@ -251,8 +365,402 @@ class DicomFinder(Finder):
                 # the next series, we don't need to track these any more
                 # and this keeps it from growing too large
                 self.dicom_files = set()
+                self.discovery_times = {}
+                self.filter_headers = OrderedDict()
+                self.name_pattern = None
+                self.schedule = PollSchedule(self.schedule.min_interval,
+                                             self.schedule.max_interval)
+                self._start_watcher()
+
+            # The watcher blocks for new files itself, and after a
+            # successful prefetch the next slices are likely on their way
+            if not prefetched and (self.watcher is None
+                                   or not self.watcher.active):
+                if self.adaptive_polling:
+                    self.wait(self.schedule.interval())
+                else:
+                    self.wait()
+
+        if self.watcher is not None:
+            self.watcher.close()
+        for fetcher in self.fetchers:
+            fetcher.halt()
+            fetcher.join()
+
+    def _queue_dicom(self, dcm, fname):
+        """Put a retrieved dicom on the dicom queue."""
+        discovered = self.discovery_times.pop(fname, None)
+        if discovered is not None:
+            stamp(dcm, "discovered", discovered)
+        stamp(dcm, "queued")
+        if not self.put(self.dicom_q, dcm):
+            return
+        with self.queue_lock:
+            self.last_dicom_time = time.time()
+            self.nqueued += 1
+            self.schedule.update(dcm, self.last_dicom_time)
+        self.notify_listeners()
+
+    def _fetch(self, filenames, if_ready=False):
+        """Generate (filename, dicom) pairs for `filenames`.
+
+        With fetch workers the files are handed to them instead, and
+        nothing is generated here. With `if_ready` (for files the watcher
+        reported, which may still be being written), files that aren't
+        complete yet are forgotten rather than queued, so the next full
+        listing offers them again.
+        """
+        if self.fetchers:
+            for fname in filenames:
+                self.fetch_q.put((fname, if_ready))
+            return
+
+        if if_ready:
+            for fname in filenames:
+                dcm = self.client.retrieve_dicom_if_ready(fname)
+                if dcm is None:
+                    self._forget(fname)
+                    continue
+                yield fname, dcm
+            return
+
+        retrieved = self.client.retrieve_dicoms(filenames)
+        with closing(retrieved):
+            for fname, dcm in retrieved:
+                yield fname, dcm
+
+    def _forget(self, fname):
+        """Drop a file we couldn't fetch, so it is discovered again."""
+        self.dicom_files.discard(fname)
+        self.discovery_times.pop(fname, None)
+
+    def _learn_names(self, filenames):
+        """Keep track of how files in the current series are numbered.
+
+        The pattern is (prefix, suffix, highest number, count) for the
+        names that look like the first one we saw.
+        """
+        for fname in filenames:
+            m = NUMBERED_NAME.match(os.path.basename(fname))
+            if m is None:
+                continue
+            prefix, number, suffix = m.groups()
+            if self.name_pattern is None:
+                self.name_pattern = (prefix, suffix, int(number), 1)
+                continue
+
+            known_prefix, known_suffix, last, count = self.name_pattern
+            if (prefix, suffix) == (known_prefix, known_suffix):
+                self.name_pattern = (prefix, suffix, max(last, int(number)),
+                                     count + 1)
+
+    def _predicted_files(self):
+        """Return the paths of the next files we expect in the series."""
+        if self.name_pattern is None or self.name_pattern[3] < 2:
+            return []
+        if self.dicom_filter is not None and not self.dicom_filter.fitted:
+            return []
+
+        prefix, suffix, last, count = self.name_pattern
+        paths = [os.path.join(self.current_series,
+                              "{}{:d}{}".format(prefix, n, suffix))
+                 for n in range(last + 1, last + 1 + self.prefetch_depth)]
+        if self.dicom_filter is not None:
+            paths = list(self.dicom_filter.filter(paths))
+        return [p for p in paths if p not in self.dicom_files]
+
+    def _prefetch(self):
+        """Fetch the next expected files as soon as they are complete.
+
+        Each expected file is retried until `prefetch_timeout` runs out,
+        but only while the schedule expects slices; between volumes it is
+        tried once. We stop at the first one that doesn't show up, since
+        the files after it won't be there either. Returns whether anything was
+        fetched; after a fruitless probe the caller still waits as usual.
+        """
+        fetched = False
+        for fname in self._predicted_files():
+            deadline = time.time() + self.prefetch_timeout
+            attempt = time.time()
+            dcm = self.client.retrieve_dicom_if_ready(fname)
+            while (dcm is None and time.time() < deadline and self.is_alive
+                   and self.schedule.expecting()):
+                time.sleep(self.prefetch_retry)
+                attempt = time.time()
+                dcm = self.client.retrieve_dicom_if_ready(fname)
+            if dcm is None:
+                break
+
+            # The file showed up during the attempt that got it
+            self.discovery_times[fname] = attempt
+            self.dicom_files.add(fname)
+            self._learn_names([fname])
+            self._queue_dicom(dcm, fname)
+            self.nprefetched += 1
+            fetched = True
+        return fetched
+
+    def _start_watcher(self):
+        """Start watching the current series directory, if requested."""
+        if self.watcher is not None:
+            self.watcher.close()
+            self.watcher = None
+        self.last_listing_time = 0
+
+        if not self.use_watcher:
+            return
+        try:
+            self.watcher = self.client.watch_dir(self.current_series)
+        except Exception as e:
+            logger.warning(("Could not start a remote watcher ({}); "
+                            "polling the series directory instead"
+                            .format(e)))
+
+    def _discover_files(self):
+        """Return candidate dicom paths for the current series.
+
+        Without a live watcher this lists the whole series directory.
+        Otherwise it returns the files the watcher reported, waiting up to
+        one interval for news, and only re-lists the directory every
+        `reconcile_interval` seconds to catch anything the watcher missed
+        (or reported before it was completely written). Also returns
+        whether the paths came from the watcher.
+        """
+        now = time.time()
+        if (self.watcher is not None and self.watcher.active
+                and now - self.last_listing_time < self.reconcile_interval):
+            reported = self.watcher.new_files(timeout=self.interval)
+            return list(OrderedDict.fromkeys(reported)), True
+
+        self.last_listing_time = now
+        return self.client.series_files(self.current_series), False
+
+    def _retrieve_while_fitting(self, new_files):
+        """Generate (filename, dicom) pairs while fitting the dicom filter.
+
+        Only dicom headers are fetched until the filter has seen a whole
+        volume. Once it is fitted, the files it allows (including ones
+        seen in earlier polls) are fetched in full.
+        """
+        for fname in new_files:
+            if self.dicom_filter.fitted:
+                break
+            if fname in self.filter_headers:
+                continue
+
+            # then we're collecting first volume to setup filter
+            logger.debug("Updating dicom filter...")
+            header = self.client.retrieve_dicom_header(fname)
+            self.last_dicom_time = time.time()
+            self.filter_headers[fname] = header
+            with self.dicom_filter.lock:
+                self.dicom_filter.update(fname, header)
+
+        if not self.dicom_filter.fitted:
+            return
+
+        logger.info("Dicom filter ready.")
+        candidates = OrderedDict.fromkeys(list(self.filter_headers)
+                                          + list(new_files))
+        self.filter_headers = OrderedDict()
+
+        wanted = list(self.dicom_filter.filter(list(candidates)))
+        retrieved = self._fetch(wanted)
+        with closing(retrieved):
+            for fname, dcm in retrieved:
+                yield fname, dcm
+
+
+class PollSchedule(object):
+    """Polling intervals that follow the volume rate of a scan.
+
+    The slices of a volume show up close together, once every repetition
+    time (TR). From the TR in the dicoms and the time the last volume
+    started to arrive, we poll every `min_interval` while a volume is
+    arriving and from `lead` TRs before the next one is due, and wait up
+    to `max_interval` at a time otherwise. Without a TR we always poll
+    every `min_interval`; once a volume is more than a TR late the scan
+    has likely stopped and we poll every `max_interval`.
+
+    """
+
+    def __init__(self, min_interval, max_interval=1., lead=0.25):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.lead = lead
+        self.tr = None
+        self.volume_start = None
+        self.last_arrival = None
+
+    def update(self, dcm, now=None):
+        """Note the arrival of a slice."""
+        if now is None:
+            now = time.time()
+
+        tr = getattr(dcm, "RepetitionTime", None)
+        if tr:
+            self.tr = float(tr) / 1000
+
+        # A gap between slices means a new volume has started
+        if (self.last_arrival is None or self.tr is None
+                or now - self.last_arrival > self.lead * self.tr):
+            self.volume_start = now
+        self.last_arrival = now
+
+    def expecting(self, now=None):
+        """Return whether slices are arriving or due about now."""
+        if self.tr is None or self.last_arrival is None:
+            return True
+        if now is None:
+            now = time.time()
+
+        # The rest of the current volume may still be coming
+        if now - self.last_arrival < self.lead * self.tr:
+            return True
+
+        # From `lead` TRs before the next volume is due until it is a
+        # TR late, after which the scan has probably stopped
+        due = self.volume_start + self.tr
+        return due - self.lead * self.tr <= now <= due + self.tr
+
+    def interval(self, now=None):
+        """Return how long to wait before polling again."""
+        if now is None:
+            now = time.time()
+        if self.expecting(now):
+            return self.min_interval
+
+        due = self.volume_start + self.tr
+        until_window = due - self.lead * self.tr - now
+        if until_window > 0:
+            return max(self.min_interval, min(until_window,
+                                              self.max_interval))
+        return self.max_interval
+
+
+class DicomFetcher(Finder):
+    """Download dicoms for a DicomFinder.
+
+    Takes filenames off the finder's fetch queue, retrieves each one with
+    a client checked out of the finder's client pool and hands the dicom
+    back to the finder to be queued. Several fetchers can run at once, so
+    dicoms may be queued out of order. Files the watcher reported are
+    only queued once they are completely written.
+
+    """
+
+    def __init__(self, finder, interval=0.05):
+        """Initialize the fetcher."""
+        super(DicomFetcher, self).__init__(interval)
+        self.finder = finder
 
-            time.sleep(self.interval)
+    def run(self):
+        """This function gets looped over repeatedly while thread is alive."""
+        while self.is_alive:
+            try:
+                fname, if_ready = self.finder.fetch_q.get(
+                    timeout=self.interval)
+            except Empty:
+                continue
+
+            try:
+                with self.finder.client.checkout() as client:
+                    if if_ready:
+                        dcm = client.retrieve_dicom_if_ready(fname)
+                    else:
+                        dcm = client.retrieve_dicom(fname)
+            except Exception as e:
+                # Forget the file so the next listing offers it again
+                logger.warning("Could not fetch {} ({}); will retry"
+                               .format(fname, e))
+                self.finder._forget(fname)
+                continue
+            if dcm is None:
+                # Still being written
+                self.finder._forget(fname)
+                continue
+
+            self.finder._queue_dicom(dcm, fname)
+
+
+class VolumeLayout(object):
+    """How the slices of one acquisition fit into a volume.
+
+    Every volume of an acquisition has the same geometry, so we only need
+    DicomStack to work it out once. The layout keeps the affine and header
+    of the first stacked volume and where each slice position ended up in
+    it; later volumes are written slice by slice into a fresh array.
+    `learn` returns None when the stacked volume isn't a plain stack of
+    the slice pixels (e.g. rescaled data), in which case DicomStack stays
+    in charge.
+
+    """
+
+    def __init__(self, image, orientation, index, transpose):
+        self.affine = image.affine
+        self.header = image.header.copy()
+        self.shape = image.shape
+        self.dtype = image.get_data_dtype()
+        self.orientation = orientation
+        self.normal = np.cross(orientation[:3], orientation[3:])
+        self.index = index
+        self.transpose = transpose
+
+    @classmethod
+    def learn(cls, slices, image):
+        """Return the layout of `image`, stacked from `slices`, or None."""
+        n_slices = len(slices)
+        if len(image.shape) != 3 or image.shape[2] != n_slices:
+            return None
+
+        orientation = [float(x) for x in slices[0].ImageOrientationPatient]
+        normal = np.cross(orientation[:3], orientation[3:])
+        data = np.asanyarray(image.dataobj)
+
+        # Find the one slice of the volume each dicom's pixels went to
+        for transpose in [True, False]:
+            index = {}
+            for dcm in slices:
+                pixels = dcm.pixel_array.T if transpose else dcm.pixel_array
+                if pixels.shape != data.shape[:2]:
+                    break
+                matches = [k for k in range(n_slices)
+                           if np.array_equal(data[:, :, k], pixels)]
+                if len(matches) != 1:
+                    break
+                index[cls._position(dcm, normal)] = matches[0]
+            else:
+                if len(set(index.values())) == n_slices:
+                    return cls(image, orientation, index, transpose)
+        return None
+
+    @staticmethod
+    def _position(dcm, normal):
+        """Return the (rounded) position of a slice along the normal."""
+        position = [float(x) for x in dcm.ImagePositionPatient]
+        return round(np.dot(normal, position), 3)
+
+    def assemble(self, slices):
+        """Return an image of `slices`, or None if they don't fit."""
+        if len(slices) != self.shape[2]:
+            return None
+
+        data = np.empty(self.shape, self.dtype)
+        filled = set()
+        for dcm in slices:
+            orientation = [float(x) for x in dcm.ImageOrientationPatient]
+            k = self.index.get(self._position(dcm, self.normal))
+            if orientation != self.orientation or k is None or k in filled:
+                return None
+            pixels = dcm.pixel_array
+            if self.transpose:
+                pixels = pixels.T
+            if pixels.shape != self.shape[:2]:
+                return None
+            data[:, :, k] = pixels
+            filled.add(k)
+
+        return nib.Nifti1Image(data, self.affine, self.header)
 
 
 class Volumizer(Finder):
@@ -263,8 +771,24 @@ class Volumizer(Finder):
 
     """
 
-    def __init__(self, dicom_q, volume_q, interval=0.01, keep_vols=True):
-        """Initialize the queue."""
+    def __init__(self, dicom_q, volume_q, interval=0.01, keep_vols=True,
+                 fast_assembly=True, validate_assembly=False,
+                 store_length=None, store_dir=None):
+        """Initialize the queue.
+
+        With `keep_vols`, the data of each assembled volume is also kept
+        in `volume_store` (see VolumeStore), which holds the last
+        `store_length` volumes of the current acquisition (by default
+        its NumberOfTemporalPositions, so the store never wraps around
+        and its windows are always views). With `store_dir`, each
+        acquisition's store is memory-mapped to a file in that directory.
+
+        With `fast_assembly`, only the first volume of an acquisition is
+        stacked with DicomStack; the rest are assembled straight from the
+        slice pixels using its layout (see VolumeLayout).
+        `validate_assembly` stacks every volume with DicomStack as well
+        and checks the two agree.
+        """
         super(Volumizer, self).__init__(interval)
 
         # The external queue objects we are talking to
@@ -275,11 +799,19 @@ class Volumizer(Finder):
 
         #whether to store all volumes assembled in the volumizer.
         self.keep_vols = keep_vols
-        self.assembled_volumes = []
+        self.store_length = store_length
+        self.store_dir = store_dir
+        self.volume_store = None
+        self.store_esa = None
         self.last_assembled_time = time.time()
 
         self.dicom_filter = None
 
+        # Layout of the volumes of the current acquisition
+        self.fast_assembly = fast_assembly
+        self.validate_assembly = validate_assembly
+        self.layout = (None, None)
+
     def dicom_esa(self, dcm):
         """Extract the exam, series, and acquisition metadata.
 
@@ -335,24 +867,31 @@ class Volumizer(Finder):
     #@profile
     def assemble_volume(self, slices):
         """Put each dicom slice together into a nibabel nifti image object."""
-        # Build a DicomStack from each of the slices
         tic = time.time()
-
-        meta = default_extractor(slices[0])
-
-        stack = DicomStack()
-        for f in slices:
-            # without new_meta, this takes 99% of time in this function by
-            # wasting cycles on looking up redundant data.
-            new_meta = self._get_meta(f, meta)
-            stack.add_dcm(f, new_meta)
-
-        # Convert into a Nibabel Nifti object
-        nii_img = stack.to_nifti(voxel_order="")
+        esa = self.dicom_esa(slices[0])
+
+        nii_img = None
+        layout_esa, layout = self.layout
+        if self.fast_assembly and layout_esa == esa and layout is not None:
+            nii_img = layout.assemble(slices)
+
+        if nii_img is None or self.validate_assembly:
+            stacked = self.stack_volume(slices)
+            if nii_img is None:
+                nii_img = stacked
+            elif not (np.array_equal(nii_img.get_data(), stacked.get_data())
+                      and np.array_equal(nii_img.affine, stacked.affine)):
+                logger.warning("Fast volume assembly disagrees with "
+                               "DicomStack; using DicomStack")
+                nii_img = stacked
+                self.layout = (esa, None)
+
+            if self.fast_assembly and layout_esa != esa:
+                self.layout = (esa, VolumeLayout.learn(slices, stacked))
 
         # Build the volume dictionary we will put in the dicom queue
         dcm = slices[0]
-        exam, series, acquisition = self.dicom_esa(dcm)
+        exam, series, acquisition = esa
         volume = dict(
             exam=exam,
             series=series,
@@ -362,30 +901,62 @@ class Volumizer(Finder):
             tr=float(dcm.RepetitionTime) / 1000,
             ntp=float(dcm.NumberOfTemporalPositions),
             image=nii_img,
+            timing=volume_timing(slices),
         )
+        stamp(volume, "assembled")
         time_it(tic, "Assembled a volume", level='info')
 
         if self.keep_vols:
-            self.assembled_volumes.append(volume)
+            self.store_volume(volume)
         self.last_assembled_time = time.time()
         return volume
 
-    def missing_slices(self, need, have):
-        return set(list(need)) - set(list(have))
+    def store_volume(self, volume):
+        """Copy a volume's data into the store for its acquisition."""
+        esa = volume["exam"], volume["series"], volume["acquisition"]
+        image = volume["image"]
+        store = self.volume_store
+        if (store is None or self.store_esa != esa
+                or store.shape != image.shape
+                or store.dtype != image.get_data_dtype()):
+            length = self.store_length or max(int(volume["ntp"]), 1)
+            filename = None
+            if self.store_dir is not None:
+                filename = os.path.join(self.store_dir,
+                                        "e{}_s{}_a{}.dat".format(*esa))
+            store = VolumeStore(image.shape, image.get_data_dtype(), length,
+                                filename)
+            self.volume_store = store
+            self.store_esa = esa
+
+        info = dict((k, v) for k, v in volume.items() if k != "image")
+        info["affine"] = image.affine
+        store.add(np.asanyarray(image.dataobj), info)
+
+    def stack_volume(self, slices):
+        """Stack dicom slices into a nibabel image with DicomStack."""
+        meta = default_extractor(slices[0])
+
+        stack = DicomStack()
+        for f in slices:
+            # without new_meta, this takes 99% of time in this function by
+            # wasting cycles on looking up redundant data.
+            new_meta = self._get_meta(f, meta)
+            stack.add_dcm(f, new_meta)
+
+        # Convert into a Nibabel Nifti object
+        return stack.to_nifti(voxel_order="")
 
     # @profile
     def run(self):
         """This function gets looped over repetedly while thread is alive."""
-        # Initialize the list we'll using to track progress
-        instance_numbers_needed = []  # None
-        instance_numbers_gathered = []
+        # Slices of the current scanner run waiting to become volumes
+        slice_buffer = None
         current_esa = None
-        current_slices = []
 
         last_assembled = time.time()
-        trigger_times_acquired = []
 
-        #whether or not we've updated instance_numbers_needed with dicom filter
+        #whether or not we've updated the slice buffer with dicom filter
         self.filtered = False
 
         while self.is_alive:
@@ -396,20 +967,11 @@ class Volumizer(Finder):
                 time_it(tic, "grabbed a dicom in volumizer:")
                 self.n_gotten += 1
             except Empty:
-                print
-                # condition where dicom queue is empty but we
-                # can assemble the next slice
-
-                slices_missing = self.missing_slices(instance_numbers_needed,
-                                                     instance_numbers_gathered)
                 if time.time() - self.last_assembled_time > 20:
                     print("More than 10 seconds since last volume, halting...")
                     self.halt()
-                if len(instance_numbers_needed) and not slices_missing:
-                    pass
-                else:
-                    time.sleep(self.interval)
-                    continue
+                # The get above already waited for an interval
+                continue
 
             try:
                 # This is the dicom tag for "Number of locations"
@@ -428,8 +990,10 @@ class Volumizer(Finder):
             this_esa = self.dicom_esa(dcm)
             if current_esa is None or this_esa != current_esa:
                 # Begin tracking the slices we need for the first volume
-                # from this acquisition
-                instance_numbers_needed = np.arange(slices_per_volume) + 1
+                # from this acquisition. Instance numbers start over, so
+                # leftover slices from the last run are dropped.
+                slice_buffer = SliceBuffer(slices_per_volume)
+                self.filtered = False
                 current_esa = this_esa
                 logger.debug(("Collecting slices for new scanner run - "
                               "\n(exam: {}\n series: {}\n acquisition: {})"
@@ -441,58 +1005,131 @@ class Volumizer(Finder):
             # not sequential acquisitisions) so we can trust it to put
             # the volumes in the correct order.
             current_slice = int(dcm.InstanceNumber)
-
-            # Add this slice index and dicom object to current list
-
-            instance_numbers_gathered.append(current_slice)
-
-            current_slices.append(dcm)
+            slice_buffer.add(current_slice, dcm)
 
             if self.dicom_filter is not None and not self.filtered:
                 """If we are using a filter, we will only need to gather
                 instance numbers if their slice number is allowed by the filter"""
                 if self.dicom_filter.fitted:
-                    instance_numbers_needed = [
-                        x for x in instance_numbers_needed
-                        if x % slices_per_volume in self.dicom_filter.legal_indices
-                    ]
-                    instance_numbers_needed = np.array(instance_numbers_needed)
+                    slice_buffer.set_legal_indices(
+                        self.dicom_filter.legal_indices)
                     self.filtered = True
 
             #If you really need to debug the dicom_filter...
-            print("Missing:",self.missing_slices(instance_numbers_needed,instance_numbers_gathered))
-            print(("Have: {}".format(instance_numbers_gathered)))
-
-            if set(instance_numbers_needed) <= set(instance_numbers_gathered):
-                # Files are not guaranteed to enter the DICOM queue in any
-                # particular order. If we get here, then we have picked up
-                # all the slices we need for this volume, but they might be
-                # out of order, and we might have other slices that belong to
-                # the next volume. So we need to figure out the correct order
-                # and then extract what we need, leaving the rest to be dealt
-                # with later.
-
-                volume_slices = []
-
-                for slice_number in instance_numbers_needed:
-                    # print(sorted_indices)
-                    slice_index = instance_numbers_gathered.index(slice_number)
-                    #print(slice_index, slice_number)
-                    volume_slices.append(current_slices.pop(slice_index))
-                    instance_numbers_gathered.pop(slice_index)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Missing: {}".format(slice_buffer.missing()))
+
+            # Files are not guaranteed to enter the DICOM queue in any
+            # particular order, so the buffer may already hold slices of
+            # the next volumes too; assemble every volume that is ready.
+            while slice_buffer.complete:
+                needed = slice_buffer.needed
+                volume_slices = slice_buffer.pop_volume()
 
                 # Assemble all the slices together into a nibabel object
                 logger.debug(("Assembling full volume for slices {:d}-{:d}"
-                              .format(min(instance_numbers_needed),
-                                      max(instance_numbers_needed))))
+                              .format(needed[0], needed[-1])))
                 tic = time.time()
                 volume = self.assemble_volume(volume_slices)
 
                 # Put that object on the dicom queue
-                self.volume_q.put(volume, timeout=self.interval)
-                self.nqueued += 1
+                if self.put(self.volume_q, volume):
+                    self.nqueued += 1
                 time_it(last_assembled, "Volumizer: Assemble and queue volume")
                 last_assembled = time.time()
 
-                # Update the array of slices we need for the next volume
-                instance_numbers_needed += slices_per_volume
+
+# Pipeline events before a volume is handed to a consumer
+UPSTREAM_EVENTS = EVENTS[:EVENTS.index("delivered")]
+
+
+class VolumeBus(Finder):
+    """Hand every volume off the volume queue to each of several consumers.
+
+    Each subscriber has its own queue (see BoundedQueue), so analyzers can
+    take volumes at their own pace. They all get the same image, with its
+    data made read-only, in a volume dict of their own so the results
+    and timing an analyzer adds to it don't show up in the others'.
+
+    A subscriber queue with the "block" policy holds the bus up while it
+    is full, and so every other subscriber with it; give slow or optional
+    consumers "drop_oldest" or "latest" queues. How long volumes wait for
+    each subscriber is kept in `lag` (see stats).
+
+    The stages a volume went through before the bus are added to
+    `latency` (a LatencyTracker) once, as it is published; subscribers
+    record their own later stages.
+
+    """
+
+    def __init__(self, volume_q, interval=0.05, latency=None):
+        super(VolumeBus, self).__init__(interval)
+        self.volume_q = volume_q
+        self.latency = latency
+        self.lock = Lock()
+        self.subscribers = OrderedDict()
+        self.n_published = 0
+        self.lag = LatencyTracker()
+
+    def subscribe(self, name, maxsize=0, policy="block"):
+        """Add a subscriber that gets every volume published from now on."""
+        with self.lock:
+            if name in self.subscribers:
+                raise ValueError("Already subscribed: {}".format(name))
+            self.subscribers[name] = BoundedQueue(maxsize, policy)
+
+    def unsubscribe(self, name):
+        """Stop handing volumes to a subscriber."""
+        with self.lock:
+            self.subscribers.pop(name, None)
+
+    def publish(self, volume):
+        """Put a volume on every subscriber's queue."""
+        data = volume["image"].dataobj
+        if isinstance(data, np.ndarray):
+            data.flags.writeable = False
+        if self.latency is not None and "timing" in volume:
+            self.latency.record(volume["timing"], events=UPSTREAM_EVENTS)
+
+        with self.lock:
+            subscribers = list(self.subscribers.values())
+        for queue in subscribers:
+            copy = dict(volume)
+            if "timing" in volume:
+                copy["timing"] = dict(volume["timing"])
+            self.put(queue, (time.time(), copy))
+        self.n_published += 1
+
+    def get(self, name, block=True, timeout=None):
+        """Pull the next volume off a subscriber's queue."""
+        queue = self.subscribers[name]
+        published, volume = queue.get(block, timeout)
+        self.lag.add(name, time.time() - published)
+        self.lag.gauge(name, queue.qsize())
+        return volume
+
+    def stats(self):
+        """Return the queue stats and lag of each subscriber.
+
+        "lag" summarizes the seconds volumes waited in the subscriber's
+        queue (see LatencyTracker.summary) and "waiting" the number of
+        volumes that were left in it when it took one.
+        """
+        summary = self.lag.summary()
+        with self.lock:
+            subscribers = list(self.subscribers.items())
+        stats = {}
+        for name, queue in subscribers:
+            stats[name] = queue.stats()
+            stats[name].update(lag=summary["stages"].get(name),
+                               waiting=summary["gauges"].get(name))
+        return stats
+
+    def run(self):
+        """This function gets looped over repetedly while thread is alive."""
+        while self.is_alive:
+            try:
+                volume = self.volume_q.get(timeout=self.interval)
+            except Empty:
+                continue
+            self.publish(volume)
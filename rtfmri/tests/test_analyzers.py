@@ -70,6 +70,40 @@ class TestMotionAnalyzer(object):
         T = a.compute_registration(self.eim1, self.eim2, "rigid")
         npt.assert_array_almost_equal(T.translation, [0, -5, 0], 1)
 
+    def test_compute_fast_registration(self):
+
+        # The test images only have one slice, so don't skip any
+        a = anal.MotionAnalyzer(None, None, fast=True, levels=((2, 2, 1),))
+        mask = anal.brain_mask(self.eim2)
+        T = a.compute_fast_registration(self.eim1, self.eim2, mask=mask)
+        # z is barely constrained by a single slice
+        npt.assert_array_almost_equal(T.translation[:2], [0, -5], 1)
+        nt.assert_less(abs(T.translation[2]), .5)
+        assert a.level_times[0] is not None
+
+    def test_gauss_newton_registration(self):
+
+        for fast in [False, True]:
+            a = anal.MotionAnalyzer(None, None, fast=fast,
+                                    levels=((2, 2, 1),),
+                                    engine="gauss_newton")
+            engine = a.make_engine(self.eim2)
+            T = engine.register(self.eim1, init=Rigid(np.eye(4)))
+            npt.assert_array_almost_equal(T.translation, [0, -5, 0], 1)
+            npt.assert_array_almost_equal(T.rotation, [0, 0, 0], 3)
+
+        with nt.assert_raises(ValueError):
+            anal.MotionAnalyzer(None, None, engine="spline")
+
+    def test_brain_mask(self):
+
+        data = np.zeros((10, 10, 10))
+        data[3:7, 3:7, 3:7] = 100
+        mask = anal.brain_mask(nib.Nifti1Image(data, np.eye(4)))
+        # The cube grows by a voxel across each face
+        nt.assert_equal(mask.sum(), 4 ** 3 + 6 * 4 ** 2)
+        assert not mask[0, 0, 0]
+
     def test_volume_center(self):
 
         a = anal.MotionAnalyzer(None, None)
@@ -148,3 +182,43 @@ class TestMotionAnalyzer(object):
 
             a.halt()
             a.join()
+
+    def test_catch_up(self):
+
+        volume_q = Queue()
+
+        class ScannerInterface(object):
+            """Mock the ScannerInterface with just the queue we need."""
+            def get_volume(self, *args, **kwargs):
+
+                return volume_q.get(*args, **kwargs)
+
+        result_q = Queue()
+        a = anal.MotionAnalyzer(ScannerInterface(), result_q, skip_vols=0,
+                                engine="gauss_newton", catch_up=2)
+
+        # A backlog behind the reference volume
+        for image in [self.eim1, self.eim2, self.eim1, self.eim2]:
+            volume_q.put(dict(exam=1, series=1, acquisition=1, image=image))
+
+        try:
+            a.start()
+
+            results = [result_q.get(timeout=10) for _ in range(4)]
+            nt.assert_equal([r["vol_number"] for r in results], [0, 1, 2, 3])
+            assert a.pool is not None
+
+            for result in results[1::2]:
+                npt.assert_almost_equal(result["trans_y"], 5, 1)
+                npt.assert_almost_equal(result["rms_ref"], 5, 1)
+            npt.assert_almost_equal(results[2]["trans_y"], 0, 1)
+
+            # Each displacement from the previous volume is ~5 mm
+            for result in results[1:]:
+                npt.assert_almost_equal(result["rms_pre"], 5, 1)
+
+        finally:
+
+            a.halt()
+            a.join()
+        assert a.pool is None
@@ -0,0 +1,211 @@
+from __future__ import print_function
+from Queue import Empty, Full
+
+import os
+import multiprocessing
+import shutil
+import tempfile
+
+import numpy as np
+import numpy.testing as npt
+import nose.tools as nt
+
+from .. import buffers
+
+
+class TestBufferPool(object):
+
+    def test_acquire_release(self):
+
+        pool = buffers.BufferPool(granularity=1024)
+
+        buf = pool.acquire(1500)
+        nt.assert_equal(len(buf), 2048)
+        nt.assert_equal(pool.n_allocated, 1)
+
+        pool.release(buf)
+        nt.assert_is(pool.acquire(2000), buf)
+        nt.assert_equal(pool.n_reused, 1)
+
+        # Nothing free that is big enough
+        nt.assert_equal(len(pool.acquire(4000)), 4096)
+        nt.assert_equal(pool.n_allocated, 2)
+
+    def test_smallest_fit(self):
+
+        pool = buffers.BufferPool(granularity=1)
+        big, small = bytearray(100), bytearray(10)
+        pool.release(big)
+        pool.release(small)
+
+        nt.assert_is(pool.acquire(5), small)
+        nt.assert_is(pool.acquire(5), big)
+
+    def test_max_buffers(self):
+
+        pool = buffers.BufferPool(max_buffers=2)
+        for _ in range(3):
+            pool.release(bytearray(10))
+        nt.assert_equal(len(pool.free), 2)
+
+
+class TestBoundedQueue(object):
+
+    def test_block(self):
+
+        q = buffers.BoundedQueue(2)
+        q.put(1)
+        q.put(2)
+        with nt.assert_raises(Full):
+            q.put(3, timeout=0.01)
+        nt.assert_equal(q.get(), 1)
+        nt.assert_equal(q.n_dropped, 0)
+        nt.assert_equal(q.high_water, 2)
+
+    def test_drop_oldest(self):
+
+        q = buffers.BoundedQueue(2, "drop_oldest")
+        for i in range(5):
+            q.put(i)
+        nt.assert_equal([q.get(), q.get()], [3, 4])
+        nt.assert_equal(q.n_dropped, 3)
+        nt.assert_equal(q.stats()["high_water"], 2)
+
+    def test_latest(self):
+
+        q = buffers.BoundedQueue(10, "latest")
+        for i in range(3):
+            q.put(i)
+        nt.assert_equal(q.qsize(), 1)
+        nt.assert_equal(q.get(), 2)
+        with nt.assert_raises(Empty):
+            q.get(block=False)
+
+    def test_unknown_policy(self):
+
+        with nt.assert_raises(ValueError):
+            buffers.BoundedQueue(2, "sometimes")
+
+
+class TestSliceBuffer(object):
+
+    def test_volumes(self):
+
+        buf = buffers.SliceBuffer(4)
+        # Slices of the first two volumes, out of order
+        for number in [2, 6, 1, 4, 5]:
+            buf.add(number, "slice{}".format(number))
+            assert not buf.complete
+        nt.assert_equal(buf.missing(), [3])
+
+        buf.add(3, "slice3")
+        assert buf.complete
+        nt.assert_equal(buf.pop_volume(), ["slice1", "slice2",
+                                           "slice3", "slice4"])
+
+        nt.assert_equal(buf.needed, [5, 6, 7, 8])
+        nt.assert_equal(buf.n_missing, 2)
+
+        # Late and duplicate slices are ignored
+        buf.add(2, "again")
+        buf.add(5, "again")
+        nt.assert_equal(buf.n_missing, 2)
+
+    def test_legal_indices(self):
+
+        buf = buffers.SliceBuffer(4)
+        buf.add(1, "slice1")
+        buf.set_legal_indices(set([2, 3]))
+        nt.assert_equal(buf.needed, [2, 3])
+
+        buf.add(3, "slice3")
+        buf.add(2, "slice2")
+        nt.assert_equal(buf.pop_volume(), ["slice2", "slice3"])
+
+        # The unneeded slice went with its volume
+        nt.assert_equal(buf.slices, {})
+        nt.assert_equal(buf.needed, [6, 7])
+
+
+class TestVolumeStore(object):
+
+    def test_ring(self):
+
+        store = buffers.VolumeStore((2, 3, 4), np.int16, 3)
+        for i in range(5):
+            store.add(np.full((2, 3, 4), i, np.int16), {"index": i})
+        nt.assert_equal(store.data.shape, (3, 2, 3, 4))
+        npt.assert_array_equal(store.last()[:, 0, 0, 0], [2, 3, 4])
+        nt.assert_equal([info["index"] for info in store.last_info()],
+                        [2, 3, 4])
+
+        # Volumes that don't wrap around the ring are a view
+        assert store.last(1).base is store.data
+
+    def test_mirror(self):
+
+        store = buffers.VolumeStore((2, 3, 4), np.int16, 3, mirror=True)
+        nt.assert_equal(len(store), 0)
+        nt.assert_equal(store.last().shape, (0, 2, 3, 4))
+
+        for i in range(5):
+            store.add(np.full((2, 3, 4), i, np.int16), {"index": i})
+
+        nt.assert_equal(len(store), 3)
+        last = store.last()
+        npt.assert_array_equal(last[:, 0, 0, 0], [2, 3, 4])
+        npt.assert_array_equal(store.last(2)[:, 0, 0, 0], [3, 4])
+        nt.assert_equal([info["index"] for info in store.last_info(2)],
+                        [3, 4])
+
+        # The window is a view, even across the end of the ring
+        assert last.base is store.data
+        assert last.flags.c_contiguous
+
+    def test_memmap(self):
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "volumes.dat")
+            store = buffers.VolumeStore((2, 2, 2), np.float32, 2, filename)
+            store.add(np.ones((2, 2, 2)))
+            assert isinstance(store.data, np.memmap)
+            nt.assert_equal(os.path.getsize(filename), 2 * 8 * 4)
+            npt.assert_array_equal(store.last(), np.ones((1, 2, 2, 2)))
+            del store
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def put_arrays(ring, out_q):
+    for i in range(3):
+        out_q.put(ring.put(np.full((4, 5), i, np.float32), timeout=5))
+
+
+class TestSharedVolumeRing(object):
+
+    def test_put_get(self):
+
+        ring = buffers.SharedVolumeRing(n_slots=2, slot_bytes=128)
+        out_q = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=put_arrays, args=(ring, out_q))
+        proc.start()
+
+        # The child waits for us to free a slot before the third array
+        for i in range(3):
+            descriptor = out_q.get(timeout=5)
+            nt.assert_in("slot", descriptor)
+            data = ring.get(descriptor)
+            npt.assert_array_equal(data, np.full((4, 5), i, np.float32))
+        proc.join()
+
+        # Arrays that don't fit in a slot travel in the descriptor
+        big = np.arange(100.)
+        descriptor = ring.put(big)
+        nt.assert_not_in("slot", descriptor)
+        npt.assert_array_equal(ring.get(descriptor), big)
+
+        ring.put(np.zeros(2))
+        ring.put(np.zeros(2))
+        with nt.assert_raises(Empty):
+            ring.put(np.zeros(2), timeout=0.01)
@@ -0,0 +1,71 @@
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import nose.tools as nt
+
+from .. import cache
+
+
+class TestSeriesInfoCache(object):
+
+    info = {
+        "Dicomdir": "test_data/p004/e4120/4120_11_1_dicoms",
+        "DateTime": datetime(2013, 3, 11, 9, 26, 44),
+        "Series": 11,
+        "Description": "EPI 2mm",
+        "NumTimepoints": 120,
+        "NumAcquisitions": 4800,
+    }
+
+    key = ("localhost", "test_data")
+
+    def setup(self):
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "series.sqlite")
+
+    def teardown(self):
+
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+
+        c = cache.SeriesInfoCache(self.path)
+        series_dir = self.info["Dicomdir"]
+        nt.assert_is_none(c.get(*self.key + (series_dir,)))
+
+        c.put(*self.key + (series_dir, 100, self.info))
+        mtime, info = c.get(*self.key + (series_dir,))
+        nt.assert_equal(mtime, 100)
+        nt.assert_equal(info, self.info)
+
+        # Newer entries replace older ones
+        c.put(*self.key + (series_dir, 200,
+                           dict(self.info, NumAcquisitions=4840)))
+        mtime, info = c.get(*self.key + (series_dir,))
+        nt.assert_equal(mtime, 200)
+        nt.assert_equal(info["NumAcquisitions"], 4840)
+
+    def test_scanner_key(self):
+
+        c = cache.SeriesInfoCache(self.path)
+        series_dir = self.info["Dicomdir"]
+        c.put(*self.key + (series_dir, 100, self.info))
+
+        # The same path on another scanner, or under another base
+        # directory, is another series
+        nt.assert_is_none(c.get("cnimr", "test_data", series_dir))
+        nt.assert_is_none(c.get("localhost", "other_data", series_dir))
+
+    def test_persistence(self):
+
+        series_dir = self.info["Dicomdir"]
+        c = cache.SeriesInfoCache(self.path)
+        c.put(*self.key + (series_dir, 100, self.info))
+        c.close()
+
+        c = cache.SeriesInfoCache(self.path)
+        nt.assert_equal(c.get(*self.key + (series_dir,)), (100, self.info))
@@ -1,7 +1,13 @@
+import os
+import shutil
+import tempfile
+import threading
 import os.path as op
 from datetime import datetime
 
 import dicom
+import pydicom
+from pydicom import data
 
 from nose import SkipTest
 import nose.tools as nt
@@ -144,6 +150,33 @@ class TestScannerClient(object):
         nt.assert_equal(alpha_listed, alpha_sorted)
         nt.assert_equal(mtime_listed, mtime_sorted)
 
+    def test_listing_cache(self):
+
+        if self.no_server:
+            raise SkipTest
+
+        series_dir = self.client.latest_series
+        self.client.clear_listing_cache()
+        settle_time = self.client.listing_settle_time
+        self.client.listing_settle_time = 0
+        try:
+            before = self.client.listing_cache_stats()
+            first = self.client.list_dir(series_dir)
+            second = self.client.list_dir(series_dir)
+            after = self.client.listing_cache_stats()
+        finally:
+            self.client.listing_settle_time = settle_time
+
+        nt.assert_equal(first, second)
+        nt.assert_equal(after["misses"] - before["misses"], 1)
+        nt.assert_equal(after["hits"] - before["hits"], 1)
+
+        self.client.cache_listings = False
+        try:
+            nt.assert_equal(self.client.list_dir(series_dir), first)
+        finally:
+            self.client.cache_listings = True
+
     def test_latest_entry(self):
 
         if self.no_server:
@@ -167,6 +200,38 @@ class TestScannerClient(object):
         nt.assert_equal(self.client.latest_series,
                         "test_data/p004/e4120/4120_11_1_dicoms")
 
+    def test_latest_index(self):
+
+        if self.no_server:
+            raise SkipTest
+
+        self.client.clear_index()
+        series_dir = self.client.latest_series
+        nt.assert_equal(self.client._index["series"][0], series_dir)
+        nt.assert_equal(self.client._index["exam"][0],
+                        self.client.latest_exam)
+
+        # A fresh index is answered without listing anything
+        before = self.client.listing_cache_stats()
+        nt.assert_equal(self.client.latest_series, series_dir)
+        after = self.client.listing_cache_stats()
+        nt.assert_equal(after["misses"], before["misses"])
+        nt.assert_equal(after["hits"], before["hits"])
+
+        # Once it expires, every level of the unchanged tree (patients
+        # included) is answered from the listing cache
+        self.client._index = dict((name, (path, 0)) for name, (path, _)
+                                  in self.client._index.items())
+        settle_time = self.client.listing_settle_time
+        self.client.listing_settle_time = 0
+        try:
+            nt.assert_equal(self.client.latest_series, series_dir)
+        finally:
+            self.client.listing_settle_time = settle_time
+        expired = self.client.listing_cache_stats()
+        nt.assert_equal(expired["misses"], after["misses"])
+        nt.assert_equal(expired["hits"], after["hits"] + 3)
+
     def test_series_dirs(self):
 
         if self.no_server:
@@ -225,3 +290,259 @@ class TestScannerClient(object):
         binary_data = self.client.retrieve_file(filename)
         dcm2 = dicom.filereader.read_file(binary_data)
         nt.assert_equal(dcm1.PixelData, dcm2.PixelData)
+
+        # Without the buffer pool we should get the same data
+        buffer_pool, self.client.buffer_pool = self.client.buffer_pool, None
+        try:
+            dcm3 = self.client.retrieve_dicom(filename)
+        finally:
+            self.client.buffer_pool = buffer_pool
+        nt.assert_equal(dcm1.PixelData, dcm3.PixelData)
+
+    def test_partial_dicom(self):
+
+        fname = data.get_testdata_files("MR_small.dcm")[0]
+        with open(fname, "rb") as f:
+            contents = f.read()
+        want = pydicom.read_file(fname)
+
+        fast_decode = self.client.fast_decode
+        try:
+            for fast in [False, True]:
+                self.client.fast_decode = fast
+                # Cut off inside the file meta header, the dataset and the
+                # pixel data, as if the scanner were still writing it
+                for nbytes in [145, 152, 1412, 9000]:
+                    self.client._decoder = (None, None)
+                    buf = bytearray(contents[:nbytes])
+                    self.client._read_into = lambda f, b: (buf, len(buf))
+                    dcm = self.client.retrieve_dicom_if_ready("s1/MR.1.dcm")
+                    nt.assert_is_none(dcm)
+
+                buf = bytearray(contents)
+                dcm = self.client.retrieve_dicom_if_ready("s1/MR.1.dcm")
+                nt.assert_equal(dcm.PixelData, want.PixelData)
+        finally:
+            del self.client._read_into
+            self.client.fast_decode = fast_decode
+            self.client._decoder = (None, None)
+
+    def test_watch_dir(self):
+
+        if self.no_server:
+            raise SkipTest
+
+        # The test server serves the current directory
+        watch_dir = op.relpath(tempfile.mkdtemp(dir="."))
+        try:
+            watcher = self.client.watch_dir(watch_dir)
+            try:
+                with open(op.join(watch_dir, "MR.1.dcm"), "w") as f:
+                    f.write("dicom")
+                new_files = watcher.new_files(timeout=2)
+                nt.assert_equal(new_files, [op.join(watch_dir, "MR.1.dcm")])
+                nt.assert_equal(watcher.new_files(), [])
+            finally:
+                watcher.close()
+        finally:
+            shutil.rmtree(watch_dir)
+
+    def test_header_retrieval(self):
+
+        if self.no_server:
+            raise SkipTest
+
+        series_dir = self.client.latest_series
+        filename = self.client.series_files(series_dir)[0]
+        dcm = self.client.retrieve_dicom(filename)
+
+        # A tiny initial range forces the read to grow
+        for max_bytes in [64, 2 ** 14]:
+            header = self.client.retrieve_dicom_header(filename, max_bytes)
+            nt.assert_not_in("PixelData", header)
+            nt.assert_equal(header.SOPInstanceUID, dcm.SOPInstanceUID)
+            nt.assert_equal(header.SeriesDescription, dcm.SeriesDescription)
+            nt.assert_equal(header[(0x0021, 0x104f)].value,
+                            dcm[(0x0021, 0x104f)].value)
+
+    def test_batch_retrieval(self):
+
+        if self.no_server:
+            raise SkipTest
+
+        series_dir = self.client.latest_series
+        filenames = self.client.series_files(series_dir)[:5]
+
+        batch = list(self.client.retrieve_dicoms(filenames))
+        nt.assert_equal([f for f, _ in batch], filenames)
+        for filename, dcm in batch:
+            want = self.client.retrieve_dicom(filename)
+            nt.assert_equal(dcm.SOPInstanceUID, want.SOPInstanceUID)
+
+
+class TestDirectoryWatcher(object):
+
+    class Channel(object):
+        """Stand in for a libssh2 channel running the watch command."""
+        def __init__(self, chunks):
+
+            self.chunks = list(chunks)
+            self.closed_by = None
+
+        def setblocking(self, mode):
+
+            pass
+
+        def read(self, size):
+
+            if self.chunks:
+                return self.chunks.pop(0)
+
+        def eof(self):
+
+            return False
+
+        def close(self):
+
+            self.closed_by = threading.current_thread()
+
+    class Client(object):
+
+        def close(self):
+
+            pass
+
+    def test_new_files(self):
+
+        # find -newer can list a file again in the next round
+        channel = self.Channel(["./MR.1.dcm\n./MR.2", ".dcm\n",
+                                "./MR.2.dcm\n./MR.3.dcm\n"])
+        watcher = client.DirectoryWatcher(self.Client(), channel, "s1")
+        try:
+            files = []
+            for _ in range(10):
+                files.extend(watcher.new_files(timeout=.1))
+            nt.assert_equal(files, ["s1/MR.1.dcm", "s1/MR.2.dcm",
+                                    "s1/MR.3.dcm"])
+            assert watcher.active
+        finally:
+            watcher.close()
+
+        # The reading thread closes the channel, not us
+        assert not watcher.active
+        nt.assert_is(channel.closed_by, watcher.thread)
+
+
+class TestScannerClientPool(object):
+
+    @classmethod
+    def setup_class(cls):
+
+        cls.host = "localhost"
+        cls.port = 2124
+        cls.base_dir = "test_data"
+
+        cls.pool = client.ScannerClientPool(n_clients=2,
+                                            hostname=cls.host,
+                                            port=cls.port,
+                                            base_dir=cls.base_dir)
+        cls.no_server = cls.pool.clients[0].sftp is None
+
+    @classmethod
+    def teardown_class(cls):
+
+        if not cls.no_server:
+            cls.pool.close()
+
+    def test_checkout(self):
+
+        if self.no_server:
+            raise SkipTest
+
+        with self.pool.checkout() as c1:
+            with self.pool.checkout() as c2:
+                nt.assert_is_not(c1, c2)
+                nt.assert_is_not(c1.lock, c2.lock)
+
+    def test_forwarding(self):
+
+        if self.no_server:
+            raise SkipTest
+
+        nt.assert_equal(self.pool.base_dir, self.base_dir)
+        nt.assert_equal(self.pool.latest_exam, "test_data/p004/e4120")
+
+        with self.pool.checkout() as c:
+            want = c.list_dir(self.base_dir)
+        nt.assert_equal(self.pool.list_dir(self.base_dir), want)
+
+    def test_batch_retrieval(self):
+
+        if self.no_server:
+            raise SkipTest
+
+        series_dir = self.pool.latest_series
+        filenames = self.pool.series_files(series_dir)[:10]
+
+        ordered = list(self.pool.retrieve_dicoms(filenames))
+        nt.assert_equal([f for f, _ in ordered], filenames)
+
+        unordered = list(self.pool.retrieve_dicoms(filenames, ordered=False))
+        nt.assert_equal(sorted(f for f, _ in unordered), sorted(filenames))
+
+        uids = dict((f, d.SOPInstanceUID) for f, d in ordered)
+        for filename, dcm in unordered:
+            nt.assert_equal(dcm.SOPInstanceUID, uids[filename])
+
+
+def test_pool_failed_session():
+
+    closed = []
+
+    class Client(object):
+        n_opened = 0
+
+        def __init__(self, **kwargs):
+            # The third session can't log in
+            if Client.n_opened == 2:
+                raise RuntimeError("Login failed")
+            Client.n_opened += 1
+
+        def close(self):
+            closed.append(self)
+
+    scanner_client = client.ScannerClient
+    client.ScannerClient = Client
+    try:
+        with nt.assert_raises(RuntimeError):
+            client.ScannerClientPool(n_clients=3)
+    finally:
+        client.ScannerClient = scanner_client
+
+    # The sessions that did open were closed
+    nt.assert_equal(len(closed), 2)
+
+
+def test_pool_listing_cache():
+
+    class Client(client.ScannerClient):
+
+        def connect(self):
+            self.session = None
+
+    scanner_client = client.ScannerClient
+    client.ScannerClient = Client
+    try:
+        pool = client.ScannerClientPool(n_clients=2)
+    finally:
+        client.ScannerClient = scanner_client
+
+    # A file listed by one session is fetched by another
+    first, second = pool.clients
+    first._listing_cache["series"] = {"files": [{"name": "MR.1.dcm",
+                                                 "size": 1000}]}
+    nt.assert_equal(second._size_hint("series/MR.1.dcm"), 1000)
+
+    pool.clear_listing_cache()
+    nt.assert_equal(second._size_hint("series/MR.1.dcm"), 0)
+    nt.assert_is(first._listing_cache, second._listing_cache)
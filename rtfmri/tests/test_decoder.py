@@ -0,0 +1,105 @@
+from __future__ import print_function
+from io import BytesIO
+
+import numpy.testing as npt
+import nose.tools as nt
+import pydicom
+from pydicom import data
+
+from .. import decoder
+
+
+def make_slices(n_slices):
+    """Return the bytes of dicom slices that differ in the usual places."""
+    slices = []
+    for i in range(n_slices):
+        dcm = pydicom.read_file(data.get_testdata_files("MR_small.dcm")[0])
+        dcm.InstanceNumber = i + 1
+        # Vary the length of the UID too
+        dcm.SOPInstanceUID = dcm.SOPInstanceUID + ".{}".format(10 ** i)
+        dcm.file_meta.MediaStorageSOPInstanceUID = dcm.SOPInstanceUID
+        dcm.SliceLocation = -i * 2.5
+        dcm.PixelData = (dcm.pixel_array + i).tobytes()
+
+        fobj = BytesIO()
+        dcm.save_as(fobj)
+        slices.append(bytearray(fobj.getvalue()))
+    return slices
+
+
+class TestSliceDecoder(object):
+
+    def test_decode(self):
+
+        dec = decoder.SliceDecoder()
+        for buf in make_slices(5):
+            dcm = dec.decode(buf, len(buf))
+            ref = pydicom.read_file(BytesIO(bytes(buf)))
+
+            nt.assert_equal(sorted(dcm.keys()), sorted(ref.keys()))
+            nt.assert_equal(dcm.SOPInstanceUID, ref.SOPInstanceUID)
+            nt.assert_equal(dcm.InstanceNumber, ref.InstanceNumber)
+            nt.assert_equal(dcm.SliceLocation, ref.SliceLocation)
+            nt.assert_equal(dcm.file_meta.MediaStorageSOPInstanceUID,
+                            ref.file_meta.MediaStorageSOPInstanceUID)
+            npt.assert_array_equal(dcm.pixel_array, ref.pixel_array)
+
+        # The first slice is the template and the second one teaches the
+        # decoder which elements change; the rest take the fast path
+        nt.assert_equal(dec.n_full, 2)
+        nt.assert_equal(dec.n_fast, 3)
+
+    def test_copy_pixels(self):
+
+        dec = decoder.SliceDecoder()
+        slices = make_slices(3)
+        for buf in slices[:2]:
+            dec.decode(buf, len(buf))
+
+        buf = slices[2]
+        want = pydicom.read_file(BytesIO(bytes(buf))).pixel_array
+        dcm = dec.decode(buf, len(buf), copy_pixels=True)
+        nt.assert_equal(dec.n_fast, 1)
+
+        # The buffer can be reused once the pixels are copied out
+        buf[:] = b"\0" * len(buf)
+        npt.assert_array_equal(dcm.pixel_array, want)
+
+    def test_fallback(self):
+
+        dec = decoder.SliceDecoder()
+        first, second = make_slices(2)
+        dec.decode(first, len(first))
+
+        # A slice with an extra element doesn't fit the layout
+        dcm = pydicom.read_file(BytesIO(bytes(second)))
+        dcm.ImageComments = "different layout"
+        fobj = BytesIO()
+        dcm.save_as(fobj)
+        buf = bytearray(fobj.getvalue())
+
+        decoded = dec.decode(buf, len(buf))
+        nt.assert_equal(decoded.ImageComments, "different layout")
+        nt.assert_equal(dec.n_fast, 0)
+        nt.assert_equal(dec.n_full, 2)
+
+        # Truncated files are parsed in full too
+        dec.decode(second, len(second) - 10)
+        nt.assert_equal(dec.n_fast, 0)
+
+    def test_truncated_template(self):
+
+        dec = decoder.SliceDecoder()
+        slices = make_slices(5)
+
+        # A first slice caught part way through its pixel data
+        end = slices[0].find(b"\xe0\x7f\x10\x00") + 1000
+        dec.decode(slices[0], end)
+        nt.assert_is_none(dec.template)
+
+        # The first complete slice becomes the template instead
+        for buf in slices[1:]:
+            dcm = dec.decode(buf, len(buf))
+        ref = pydicom.read_file(BytesIO(bytes(slices[-1])))
+        npt.assert_array_equal(dcm.pixel_array, ref.pixel_array)
+        nt.assert_greater(dec.n_fast, 0)
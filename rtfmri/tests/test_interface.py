@@ -5,6 +5,8 @@ import nose.tools as nt
 from nose import SkipTest
 
 from .. import interface
+from ..buffers import BoundedQueue
+from ..queuemanagers import VolumeBus
 
 
 class TestScannerInterface(object):
@@ -54,3 +56,36 @@ class TestScannerInterface(object):
         assert vol
 
 
+
+
+def test_unsubscribe():
+
+    # Only the volume bus is needed, so don't connect to a scanner
+    scanner = interface.ScannerInterface.__new__(interface.ScannerInterface)
+    scanner.bus = VolumeBus(BoundedQueue(), interval=0.01)
+    scanner.alive = True
+    try:
+        subscription = scanner.subscribe("motion")
+        nt.assert_equal(subscription.name, "motion")
+        scanner.unsubscribe("motion")
+
+        # The bus still owns the volume queue
+        with nt.assert_raises(RuntimeError):
+            scanner.get_volume(timeout=0.1)
+    finally:
+        scanner.bus.halt()
+        scanner.bus.join()
+        scanner.alive = False
+
+
+def test_process_interface_startup_error():
+
+    # Nothing listens on this port, so the acquisition process can't log in
+    scanner = interface.ProcessScannerInterface(hostname="localhost", port=1,
+                                                use_series_finder=False)
+    scanner.start()
+    try:
+        with nt.assert_raises(RuntimeError):
+            scanner.get_volume(timeout=10)
+    finally:
+        scanner.shutdown()
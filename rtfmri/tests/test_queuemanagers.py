@@ -1,13 +1,18 @@
 from __future__ import print_function
 import re
+import time
 from Queue import Queue, Empty
 
 from nose import SkipTest
 import nose.tools as nt
+import numpy.testing as npt
+import pydicom
+from pydicom import data
 
-from .. import client, queuemanagers as qm
+from .. import buffers, client, timing, queuemanagers as qm
 
 import numpy as np
+import nibabel as nib
 
 
 class TestFinder(object):
@@ -22,6 +27,233 @@ class TestFinder(object):
 
         nt.assert_equal(f.interval, 2)
 
+    def test_wake(self):
+
+        f = qm.Finder(interval=5)
+        start = time.time()
+        f.wake()
+        f.wait()
+        nt.assert_less(time.time() - start, 1)
+
+        # Halting wakes the thread up too
+        f.halt()
+        f.wait()
+        nt.assert_less(time.time() - start, 1)
+
+    def test_put(self):
+
+        f = qm.Finder(interval=0.01)
+        q = buffers.BoundedQueue(1)
+        assert f.put(q, 1)
+
+        # A full queue holds us up until we are halted
+        f.halt()
+        assert not f.put(q, 2)
+        nt.assert_equal(q.qsize(), 1)
+
+    def test_predicted_files(self):
+
+        f = qm.DicomFinder(None, None, None, prefetch=True, prefetch_depth=3)
+        f.current_series = "exam/series"
+        nt.assert_equal(f._predicted_files(), [])
+
+        f._learn_names(["exam/series/MR.1.2.840.7.dcm",
+                        "exam/series/MR.1.2.840.9.dcm",
+                        "exam/series/other.txt"])
+        f.dicom_files.add("exam/series/MR.1.2.840.11.dcm")
+        nt.assert_equal(f._predicted_files(),
+                        ["exam/series/MR.1.2.840.10.dcm",
+                         "exam/series/MR.1.2.840.12.dcm"])
+
+    def test_fetch_if_ready(self):
+
+        class Client(object):
+            def retrieve_dicom_if_ready(self, fname):
+                # The second file is still being written
+                return None if fname.endswith("2.dcm") else fname
+
+        f = qm.DicomFinder(Client(), None, None)
+        names = ["series/MR.1.dcm", "series/MR.2.dcm"]
+        f.dicom_files.update(names)
+        retrieved = list(f._fetch(names, if_ready=True))
+        nt.assert_equal(retrieved, [(names[0], names[0])])
+
+        # The incomplete file is left for the next listing
+        nt.assert_equal(f.dicom_files, set(names[:1]))
+
+    def test_prefetch_backoff(self):
+
+        class Client(object):
+            listings = []
+            probes = []
+
+            def series_files(self, series):
+                self.listings.append(time.time())
+                return ["s/MR.1.dcm", "s/MR.2.dcm"]
+
+            def retrieve_dicoms(self, filenames):
+                for fname in filenames:
+                    dcm = pydicom.Dataset()
+                    dcm.RepetitionTime = "100"
+                    yield fname, dcm
+
+            def retrieve_dicom_if_ready(self, fname):
+                # The scan stopped after two slices
+                self.probes.append(time.time())
+                return None
+
+        series_q, dicom_q = Queue(), Queue()
+        series_q.put("s")
+        f = qm.DicomFinder(Client(), series_q, dicom_q, interval=0.01,
+                           prefetch=True, prefetch_timeout=0.01,
+                           adaptive_polling=True, max_interval=0.2)
+        start = time.time()
+        f.start()
+        time.sleep(1)
+        f.halt()
+        f.join()
+
+        # Once the next volume is well overdue, the finder polls every
+        # max_interval even though each poll probes for the next slices
+        nt.assert_equal(dicom_q.qsize(), 2)
+        late = [t for t in Client.listings if t - start > 0.3]
+        nt.assert_less(len(late), 8)
+
+        # and no longer retries the probe between volumes
+        late_probes = [t for t in Client.probes if t - start > 0.3]
+        nt.assert_less_equal(len(late_probes), len(late))
+
+
+class TestPollSchedule(object):
+
+    class Slice(object):
+        RepetitionTime = "2000"
+
+    def test_interval(self):
+
+        schedule = qm.PollSchedule(0.05, max_interval=0.5)
+        nt.assert_equal(schedule.interval(now=0), 0.05)
+
+        # A volume arrives at t=10; TR is 2s and the lead half a second
+        for t in [10, 10.1, 10.2]:
+            schedule.update(self.Slice(), now=t)
+        nt.assert_equal(schedule.volume_start, 10)
+
+        # Still taking in the volume
+        nt.assert_equal(schedule.interval(now=10.3), 0.05)
+        # Wait for the window before the next one, at most max_interval
+        nt.assert_equal(schedule.interval(now=10.8), 0.5)
+        nt.assert_almost_equal(schedule.interval(now=11.3), 0.2)
+        # Poll hard while it is due
+        nt.assert_equal(schedule.interval(now=11.6), 0.05)
+        nt.assert_equal(schedule.interval(now=12.5), 0.05)
+        # The scan seems to have stopped
+        nt.assert_equal(schedule.interval(now=14.5), 0.5)
+
+        # Prefetch retries follow the same window
+        nt.assert_true(schedule.expecting(now=10.3))
+        nt.assert_false(schedule.expecting(now=10.8))
+        nt.assert_true(schedule.expecting(now=12.5))
+        nt.assert_false(schedule.expecting(now=14.5))
+
+        schedule.update(self.Slice(), now=12.05)
+        nt.assert_equal(schedule.volume_start, 12.05)
+
+
+class TestVolumeBus(object):
+
+    def test_publish(self):
+
+        volume_q = Queue()
+        latency = timing.LatencyTracker()
+        bus = qm.VolumeBus(volume_q, interval=0.01, latency=latency)
+        bus.subscribe("motion")
+        bus.subscribe("feedback", policy="latest")
+        with nt.assert_raises(ValueError):
+            bus.subscribe("motion")
+
+        images = []
+        for i in range(3):
+            images.append(nib.Nifti1Image(np.zeros((2, 2, 2)), np.eye(4)))
+            volume_q.put(dict(image=images[-1],
+                              timing=dict(queued=i, assembled=i + 1)))
+
+        try:
+            bus.start()
+            motion = [bus.get("motion", timeout=1) for _ in range(3)]
+        finally:
+            bus.halt()
+            bus.join()
+
+        # The slow subscriber only keeps the newest volume
+        feedback = bus.get("feedback", timeout=1)
+        with nt.assert_raises(Empty):
+            bus.get("feedback", block=False)
+        nt.assert_is(feedback["image"], images[2])
+        nt.assert_equal(bus.n_published, 3)
+
+        # Both share the image but not the volume dict
+        nt.assert_equal([v["image"] for v in motion], images)
+        assert motion[2] is not feedback
+        motion[2]["timing"]["analyzed"] = 1
+        nt.assert_not_in("analyzed", feedback["timing"])
+        assert not images[0].get_data().flags.writeable
+
+        stats = bus.stats()
+        nt.assert_equal(stats["motion"]["lag"]["n"], 3)
+        nt.assert_equal(stats["feedback"]["dropped"], 2)
+        nt.assert_equal(stats["feedback"]["waiting"]["last"], 0)
+
+        # Stages before the bus are recorded once, not per subscriber
+        stages = latency.summary()["stages"]
+        nt.assert_equal(stages["queued->assembled"]["n"], 3)
+
+        bus.unsubscribe("feedback")
+        nt.assert_equal(list(bus.subscribers), ["motion"])
+
+
+class TestVolumeLayout(object):
+
+    def make_volume(self, offset=0):
+        """Return the slices of a small volume, shuffled."""
+        slices = []
+        for k in [2, 0, 3, 1]:
+            dcm = pydicom.read_file(data.get_testdata_files("MR_small.dcm")[0])
+            # dcmstack's meta extractor chokes on empty numbers
+            del dcm.PatientSize, dcm.EchoTrainLength
+            position = [float(x) for x in dcm.ImagePositionPatient]
+            position[2] += 5 * k
+            dcm.ImagePositionPatient = position
+            dcm.InstanceNumber = k + 1
+            # Volumizer reads these from each slice of a GE series
+            dcm.ContentTime = dcm.AcquisitionTime = "120000"
+            dcm.InStackPositionNumber = k + 1
+            dcm.LargestImagePixelValue = 4000
+            dcm.WindowCenter, dcm.WindowWidth = 2000, 4000
+            dcm.TriggerTime = 0
+            dcm.PixelData = (dcm.pixel_array + 10 * k + offset).tobytes()
+            slices.append(dcm)
+        return slices
+
+    def test_assemble(self):
+
+        v = qm.Volumizer(None, None)
+        first = self.make_volume()
+        layout = qm.VolumeLayout.learn(first, v.stack_volume(first))
+        assert layout is not None
+
+        slices = self.make_volume(offset=1)
+        image = layout.assemble(slices)
+        stacked = v.stack_volume(slices)
+        npt.assert_array_equal(image.get_data(), stacked.get_data())
+        npt.assert_array_equal(image.affine, stacked.affine)
+        nt.assert_equal(image.header, stacked.header)
+
+        # Volumes that don't fit the layout are left to DicomStack
+        nt.assert_is_none(layout.assemble(slices[:-1]))
+        slices[0].ImagePositionPatient = [0, 0, 1000]
+        nt.assert_is_none(layout.assemble(slices))
+
 
 class TestFinders(object):
 
@@ -98,6 +330,44 @@ class TestFinders(object):
             f.halt()
             f.join()
 
+    def test_dicom_finder_fetchers(self):
+
+        if self.no_server:
+            raise SkipTest
+
+        test_series = "test_data/p004/e4120/4120_1_1_dicoms"
+        series_files = self.client.series_files(test_series)[:10]
+        want_instances = set(re.search("MR\.([\d\.]+)\.dcm", f).group(1)
+                             for f in series_files)
+
+        series_q = Queue()
+        series_q.put(test_series)
+
+        dicom_q = Queue()
+        pool = client.ScannerClientPool(n_clients=3, hostname=self.host,
+                                        port=self.port,
+                                        base_dir=self.base_dir)
+        f = qm.DicomFinder(pool, series_q, dicom_q, n_fetchers=2)
+        f.start()
+
+        # Fetchers can queue dicoms out of order
+        try:
+            got_instances = set()
+            while not want_instances <= got_instances:
+                got_dcm = dicom_q.get(timeout=2)
+                got_instances.add(got_dcm[(0x0008, 0x0018)].value)
+
+        finally:
+            f.halt()
+            f.join()
+            pool.close()
+
+        for fetcher in f.fetchers:
+            assert not fetcher.isAlive()
+
+        with nt.assert_raises(ValueError):
+            qm.DicomFinder(self.client, series_q, dicom_q, n_fetchers=2)
+
 
     def test_volumizer_volume_assembly(self):
 
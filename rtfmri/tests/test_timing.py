@@ -0,0 +1,93 @@
+from __future__ import print_function
+import time
+from datetime import datetime
+
+import nose.tools as nt
+import numpy.testing as npt
+from pydicom.dataset import Dataset
+
+from .. import timing
+
+
+def test_stamp():
+
+    dcm = Dataset()
+    timing.stamp(dcm, "fetched", 10.)
+    timing.stamp(dcm, "parsed", 11.)
+    nt.assert_equal(dcm.timing, {"fetched": 10., "parsed": 11.})
+    nt.assert_not_in("timing", dcm.dir())
+
+    volume = {}
+    when = timing.stamp(volume, "assembled")
+    nt.assert_equal(volume["timing"], {"assembled": when})
+
+
+def test_scanner_time():
+
+    dcm = Dataset()
+    nt.assert_is_none(timing.scanner_time(dcm))
+
+    dcm.AcquisitionDate = "20150321"
+    dcm.AcquisitionTime = "101500"
+    expected = time.mktime(datetime(2015, 3, 21, 10, 15).timetuple())
+    nt.assert_equal(timing.scanner_time(dcm), expected)
+
+    # ContentTime wins, fractions of a second included
+    dcm.ContentDate = "20150321"
+    dcm.ContentTime = "101501.25"
+    nt.assert_equal(timing.scanner_time(dcm), expected + 1.25)
+
+
+def test_volume_timing():
+
+    slices = []
+    for i in range(3):
+        dcm = Dataset()
+        timing.stamp(dcm, "fetched", 10. + i)
+        timing.stamp(dcm, "parsed", 20. - i)
+        slices.append(dcm)
+
+    # A volume is ready when its last slice is
+    nt.assert_equal(timing.volume_timing(slices),
+                    {"fetched": 12., "parsed": 20.})
+
+
+class TestLatencyTracker(object):
+
+    def test_record(self):
+
+        tracker = timing.LatencyTracker()
+        for i in range(4):
+            tracker.record(dict(discovered=0., fetched=0.1 * i,
+                                assembled=1., delivered=1.5))
+        tracker.record(dict(discovered=0., delivered=1.5, analyzed=2.),
+                       events=["analyzed"])
+
+        stages = tracker.summary()["stages"]
+        nt.assert_equal(sorted(stages),
+                        ["assembled->delivered", "delivered->analyzed",
+                         "discovered->fetched",
+                         "fetched->assembled", "total->analyzed",
+                         "total->delivered"])
+        nt.assert_equal(stages["discovered->fetched"]["n"], 4)
+        npt.assert_almost_equal(stages["discovered->fetched"]["max"], 0.3)
+        npt.assert_almost_equal(stages["total->delivered"]["p50"], 1.5)
+        nt.assert_equal(stages["total->analyzed"]["mean"], 2.)
+
+        counts, edges = tracker.histogram("discovered->fetched", bins=3)
+        nt.assert_equal(counts.sum(), 4)
+
+        tracker.record(dict(assembled=1., delivered=1.5),
+                       events=["delivered"], prefix="motion:")
+        stages = tracker.summary()["stages"]
+        nt.assert_equal(stages["motion:assembled->delivered"]["n"], 1)
+        nt.assert_equal(stages["assembled->delivered"]["n"], 4)
+
+    def test_gauge(self):
+
+        tracker = timing.LatencyTracker()
+        for depth in [0, 4, 2]:
+            tracker.gauge("dicom_q", depth)
+
+        nt.assert_equal(tracker.summary()["gauges"]["dicom_q"],
+                        dict(last=2, max=4, mean=2.))
@@ -0,0 +1,146 @@
+"""Per-volume latency records for the real-time pipeline.
+
+Each slice carries a `timing` dict of event name -> time.time() stamped
+as it moves through the pipeline (found on the scanner, fetched, parsed,
+queued). The Volumizer folds the slices of a volume into the volume's
+own `timing` dict, keeping the latest time of each event since a volume
+is only as early as its last slice, and adds when the scanner acquired
+it and when it was assembled. The interface and the analyzers stamp the
+rest, and a LatencyTracker turns the records into per-stage summaries.
+"""
+from __future__ import print_function, division
+import time
+from collections import deque
+from datetime import datetime
+from threading import Lock
+
+import numpy as np
+from pydicom.dataset import Dataset
+
+
+# Pipeline events, in the order a volume goes through them
+EVENTS = ["acquired", "discovered", "fetched", "parsed", "queued",
+          "assembled", "delivered", "analyzed"]
+
+
+def stamp(obj, event, when=None):
+    """Record the time of `event` on a dicom or volume dict."""
+    when = time.time() if when is None else when
+    if isinstance(obj, Dataset):
+        timing = getattr(obj, "timing", None)
+        if timing is None:
+            timing = {}
+            obj.timing = timing
+        timing[event] = when
+    else:
+        obj.setdefault("timing", {})[event] = when
+    return when
+
+
+def scanner_time(dcm):
+    """Return when the scanner made a slice as a time.time() value.
+
+    Uses the ContentDate/Time of the slice, or its AcquisitionDate/Time.
+    These come from the scanner's clock, so any skew between it and ours
+    shows up in the acquired -> discovered stage. Returns None if the
+    slice doesn't say.
+    """
+    for date_kw, time_kw in [("ContentDate", "ContentTime"),
+                             ("AcquisitionDate", "AcquisitionTime")]:
+        date = getattr(dcm, date_kw, "")
+        tm = getattr(dcm, time_kw, "")
+        if not date or not tm:
+            continue
+        try:
+            tm = str(tm).strip()
+            whole, _, fraction = tm.partition(".")
+            dt = datetime.strptime(str(date).strip() + whole, "%Y%m%d%H%M%S")
+        except ValueError:
+            continue
+        return time.mktime(dt.timetuple()) + float("0." + (fraction or "0"))
+    return None
+
+
+def volume_timing(slices):
+    """Return the timing dict of a volume made of `slices`."""
+    timing = {}
+    for dcm in slices:
+        for event, when in (getattr(dcm, "timing", None) or {}).items():
+            timing[event] = max(when, timing.get(event, when))
+
+    acquired = [t for t in map(scanner_time, slices) if t is not None]
+    if acquired:
+        timing["acquired"] = max(acquired)
+    return timing
+
+
+class LatencyTracker(object):
+    """Collect latency records and queue depths and summarize them.
+
+    Each stage is the time between two consecutive events present in a
+    record; "total" runs from the first event to the last. The most
+    recent `max_samples` values of each stage are kept. Gauges keep the
+    last and largest value seen and a running mean.
+
+    """
+
+    def __init__(self, max_samples=1000):
+        self.max_samples = max_samples
+        self.lock = Lock()
+        self.samples = {}
+        self.gauges = {}
+
+    def add(self, stage, seconds):
+        """Add one sample of a stage's latency."""
+        with self.lock:
+            if stage not in self.samples:
+                self.samples[stage] = deque(maxlen=self.max_samples)
+            self.samples[stage].append(seconds)
+
+    def record(self, timing, events=EVENTS, prefix=""):
+        """Add the stages of a volume's timing dict.
+
+        Only stages ending in one of `events` are added, so a record can
+        be added again once a later event has been stamped on it. Stage
+        names start with `prefix`, e.g. to keep each consumer's own.
+        """
+        present = [e for e in EVENTS if e in timing]
+        for first, second in zip(present[:-1], present[1:]):
+            if second in events:
+                self.add("{}{}->{}".format(prefix, first, second),
+                         timing[second] - timing[first])
+        if len(present) > 1 and present[-1] in events:
+            self.add(prefix + "total->" + present[-1],
+                     timing[present[-1]] - timing[present[0]])
+
+    def gauge(self, name, value):
+        """Record the current value of a gauge, e.g. a queue's depth."""
+        with self.lock:
+            last, peak, total, n = self.gauges.get(name, (0, value, 0, 0))
+            self.gauges[name] = (value, max(peak, value), total + value,
+                                 n + 1)
+
+    def histogram(self, stage, bins=10):
+        """Return numpy (counts, bin edges) for a stage's samples."""
+        with self.lock:
+            samples = list(self.samples.get(stage, []))
+        return np.histogram(samples, bins)
+
+    def summary(self):
+        """Return summary statistics of every stage and gauge."""
+        with self.lock:
+            samples = dict((k, np.array(v)) for k, v in self.samples.items())
+            gauges = dict(self.gauges)
+
+        stages = {}
+        for stage, values in samples.items():
+            if not len(values):
+                continue
+            p50, p90, p99 = np.percentile(values, [50, 90, 99])
+            stages[stage] = dict(n=len(values), mean=values.mean(),
+                                 p50=p50, p90=p90, p99=p99,
+                                 max=values.max())
+
+        gauges = dict((name, dict(last=last, max=peak, mean=total / n))
+                      for name, (last, peak, total, n) in gauges.items())
+        return dict(stages=stages, gauges=gauges)